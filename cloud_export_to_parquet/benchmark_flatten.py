@@ -0,0 +1,90 @@
+import argparse
+import time
+
+import temporalio.api.export.v1 as export
+
+from cloud_export_to_parquet.data_trans_activities import (
+    convert_proto_to_parquet_flatten,
+)
+from cloud_export_to_parquet.history_schema import convert_proto_to_arrow_schema
+from cloud_export_to_parquet.proto_flatten import (
+    Projection,
+    convert_proto_to_arrow_flatten,
+)
+from cloud_export_to_parquet.synthetic_export import make_workflow_executions
+
+
+def main() -> None:
+    """Compare the pandas and Arrow flatteners on a synthetic export file.
+
+    The Arrow flattener also runs with payload fields projected out, which on
+    payload-heavy histories (large --payload-size and --memo-size) shows what
+    not walking those fields saves, and with the fixed schema of
+    history_schema.py.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--workflows", type=int, default=100)
+    parser.add_argument("--activities", type=int, default=5)
+    parser.add_argument("--payload-size", type=int, default=256)
+    parser.add_argument("--memo-size", type=int, default=0)
+    parser.add_argument(
+        "--exclude",
+        nargs="*",
+        default=[],
+        help="Field paths to project out as well as payload fields",
+    )
+    parser.add_argument("--skip-pandas", action="store_true")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Round trip through bytes so both engines see a freshly parsed file, like
+    # the activity does after downloading it
+    data = make_workflow_executions(
+        args.workflows, args.activities, args.payload_size, memo_size=args.memo_size
+    ).SerializeToString()
+    wfs = export.WorkflowExecutions.FromString(data)
+    num_events = sum(len(wf.history.events) for wf in wfs.items)
+    print(
+        f"Synthetic export: {len(data) / 1e6:.1f} MB, {args.workflows} workflows, "
+        f"{num_events} events"
+    )
+
+    projection = Projection(exclude=args.exclude, exclude_payload_fields=True)
+    engines = [
+        ("pandas", convert_proto_to_parquet_flatten),
+        ("arrow", convert_proto_to_arrow_flatten),
+        (
+            "arrow-projected",
+            lambda wfs: convert_proto_to_arrow_flatten(wfs, projection),
+        ),
+        ("arrow-schema", convert_proto_to_arrow_schema),
+    ]
+    if args.skip_pandas:
+        engines = engines[1:]
+
+    results = {}
+    for name, fn in engines:
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            output = fn(wfs)
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+        print(
+            f"{name:>15}: {best:8.3f}s ({num_events / best:,.0f} events/s, "
+            f"{len(output.columns)} columns)"
+        )
+    if "pandas" in results:
+        print(f"{'speedup':>15}: {results['pandas'] / results['arrow']:.1f}x")
+    print(
+        f"{'projection':>15}: {results['arrow'] / results['arrow-projected']:.1f}x "
+        "faster than arrow"
+    )
+    print(
+        f"{'fixed schema':>15}: {results['arrow'] / results['arrow-schema']:.1f}x "
+        "faster than arrow"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, List
+
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet.data_trans_activities import (
+    DataTransAndLandActivityInput,
+    GetObjectKeysActivityInput,
+    data_trans_and_land_files,
+    get_object_keys,
+)
+from cloud_export_to_parquet.storage import (
+    ExportStorage,
+    LocalStorage,
+    configure_storage,
+)
+from cloud_export_to_parquet.synthetic_export import write_synthetic_export
+
+EXPORT_BUCKET = "export-bucket"
+OUTPUT_BUCKET = "output-bucket"
+EXPORT_PATH = "temporal-workflow-history/export/benchmark/2024/01/01/00/00"
+WRITE_PATH = "temporal-workflow-history/parquet/benchmark/2024/01/01/00/00"
+
+
+@dataclass
+class PipelineResult:
+    files: int
+    input_bytes: int
+    output_files: int
+    output_bytes: int
+    seconds: float
+    # Peak resident set size of the pipeline process and of the largest
+    # conversion process, if any
+    peak_rss_bytes: int
+    peak_child_rss_bytes: int
+
+
+def _run_activity(fn: Callable, *args: Any) -> Any:
+    return ActivityEnvironment().run(fn, *args)
+
+
+def _total_size(storage: ExportStorage, bucket: str, prefix: str) -> List[int]:
+    sizes: List[int] = []
+    for page in storage.iter_pages(bucket, prefix):
+        sizes.extend(obj.size for obj in page)
+    return sizes
+
+
+def _max_rss_bytes(who: int) -> int:
+    # Linux reports kilobytes, macOS bytes
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run_pipeline(
+    root: str,
+    workers: int,
+    processes: bool,
+    streaming: bool,
+    row_group_size: int,
+    partition_by_event_type: bool,
+) -> PipelineResult:
+    """List the export files and convert each one, as the workflow would."""
+    storage = LocalStorage(root)
+    configure_storage(storage)
+    input_sizes = _total_size(storage, EXPORT_BUCKET, EXPORT_PATH)
+
+    executor: Executor
+    if processes:
+        executor = ProcessPoolExecutor(
+            workers, initializer=configure_storage, initargs=(storage,)
+        )
+    else:
+        executor = ThreadPoolExecutor(workers)
+    start = time.perf_counter()
+    with executor:
+        keys = _run_activity(
+            get_object_keys, GetObjectKeysActivityInput(EXPORT_BUCKET, EXPORT_PATH)
+        )
+        inputs = [
+            DataTransAndLandActivityInput(
+                EXPORT_BUCKET,
+                key,
+                OUTPUT_BUCKET,
+                WRITE_PATH,
+                streaming=streaming,
+                row_group_size=row_group_size,
+                partition_by_event_type=partition_by_event_type,
+            )
+            for key in keys
+        ]
+        list(
+            executor.map(
+                _run_activity, [data_trans_and_land_files] * len(inputs), inputs
+            )
+        )
+    seconds = time.perf_counter() - start
+
+    output_sizes = _total_size(storage, OUTPUT_BUCKET, WRITE_PATH)
+    return PipelineResult(
+        files=len(keys),
+        input_bytes=sum(input_sizes),
+        output_files=len(output_sizes),
+        output_bytes=sum(output_sizes),
+        seconds=seconds,
+        peak_rss_bytes=_max_rss_bytes(resource.RUSAGE_SELF),
+        peak_child_rss_bytes=_max_rss_bytes(resource.RUSAGE_CHILDREN),
+    )
+
+
+def main() -> None:
+    """Benchmark the export pipeline end to end on local storage."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--file-size-mb", type=float, default=10)
+    parser.add_argument("--activities", type=int, default=5)
+    parser.add_argument("--payload-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Convert on a process pool instead of threads",
+    )
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--row-group-size", type=int, default=100_000)
+    parser.add_argument("--partition-by-event-type", action="store_true")
+    parser.add_argument(
+        "--root",
+        help="Storage directory, kept afterwards. Existing export files in it "
+        "are reused. Defaults to a temporary directory.",
+    )
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="export-benchmark-")
+    try:
+        storage = LocalStorage(root)
+        if not _total_size(storage, EXPORT_BUCKET, EXPORT_PATH):
+            write_synthetic_export(
+                storage,
+                EXPORT_BUCKET,
+                EXPORT_PATH,
+                args.files,
+                int(args.file_size_mb * 1024 * 1024),
+                args.activities,
+                args.payload_size,
+            )
+        shutil.rmtree(storage.path(OUTPUT_BUCKET, WRITE_PATH), ignore_errors=True)
+
+        # Run in a freshly spawned process so the peak RSS only covers the
+        # pipeline, not generating its input
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(
+                run_pipeline,
+                root,
+                args.workers,
+                args.processes,
+                args.streaming,
+                args.row_group_size,
+                args.partition_by_event_type,
+            ).result()
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    mb = 1024 * 1024
+    print(f"   input: {result.files} files, {result.input_bytes / mb:.1f} MB")
+    print(f"  output: {result.output_files} files, {result.output_bytes / mb:.1f} MB")
+    print(
+        f"    time: {result.seconds:.2f}s, {result.files / result.seconds:.2f} "
+        f"files/s, {result.input_bytes / mb / result.seconds:.1f} MB/s"
+    )
+    print(f"peak RSS: {result.peak_rss_bytes / mb:.0f} MB", end="")
+    if args.processes:
+        print(
+            f" (largest conversion process {result.peak_child_rss_bytes / mb:.0f} MB)"
+        )
+    else:
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+import hashlib
+import io
+import posixpath
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Dict, List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from temporalio import activity
+
+from cloud_export_to_parquet.data_trans_activities import heartbeat
+from cloud_export_to_parquet.history_schema import history_event_schema
+from cloud_export_to_parquet.incremental import (
+    is_marker_key,
+    markers_by_data_key,
+    read_marker,
+    write_marker,
+)
+from cloud_export_to_parquet.metrics import activity_metric_meter
+from cloud_export_to_parquet.storage import StoredObject, get_storage
+
+# Directory for files being compacted. Like _processed, Hive-style readers
+# skip it because it starts with an underscore.
+COMPACTION_DIR = "_compaction"
+
+DEFAULT_TARGET_FILE_SIZE = 256 * 1024 * 1024
+# Large row groups keep scans sequential; sized on disk, so with compression
+# a row group is several times larger in memory
+DEFAULT_ROW_GROUP_SIZE_BYTES = 64 * 1024 * 1024
+
+SORT_COLUMNS = ("WorkflowId", "eventTime", "eventId")
+
+
+@dataclass
+class PlanCompactionActivityInput:
+    bucket: str
+    write_path: str
+    target_file_size: int = DEFAULT_TARGET_FILE_SIZE
+
+
+@dataclass
+class CompactionGroup:
+    """Parquet files of one directory to be merged into a single file."""
+
+    directory: str
+    keys: List[str]
+    sizes: List[int]
+    total_bytes: int
+    # Incremental export markers that point at any of the keys
+    marker_keys: List[str] = field(default_factory=list)
+
+
+@dataclass
+class CompactFilesActivityInput:
+    bucket: str
+    write_path: str
+    group: CompactionGroup
+    row_group_size_bytes: int = DEFAULT_ROW_GROUP_SIZE_BYTES
+
+
+@dataclass
+class CompactionResult:
+    """A merged file written to its staging key, waiting to be committed."""
+
+    bucket: str
+    write_path: str
+    staging_key: str
+    output_key: str
+    input_keys: List[str]
+    marker_keys: List[str]
+    bytes_merged: int
+    output_bytes: int
+    rows: int
+
+
+def _is_data_file(write_path: str, key: str) -> bool:
+    relative = key[len(write_path) + 1 :]
+    return key.endswith(".parquet") and not any(
+        part.startswith("_") for part in relative.split("/")
+    )
+
+
+def _pack(
+    objects: List[StoredObject], target_file_size: int
+) -> List[List[StoredObject]]:
+    """Split files, in key order, into runs of about ``target_file_size``.
+
+    Files already at the target size are left alone, as is a run that ends up
+    with a single file since there is nothing to merge it with.
+    """
+    groups = []
+    current: List[StoredObject] = []
+    current_size = 0
+    for obj in objects:
+        if obj.size >= target_file_size:
+            continue
+        if current and current_size + obj.size > target_file_size:
+            groups.append(current)
+            current = []
+            current_size = 0
+        current.append(obj)
+        current_size += obj.size
+    groups.append(current)
+    return [group for group in groups if len(group) > 1]
+
+
+@activity.defn
+def plan_compaction(
+    activity_input: PlanCompactionActivityInput,
+) -> List[CompactionGroup]:
+    """Function that group an output path's small files into compaction groups.
+
+    Files are only merged with files of the same directory, so Hive partitions
+    stay separate.
+    """
+    storage = get_storage()
+    write_path = activity_input.write_path
+    directories: Dict[str, List[StoredObject]] = {}
+    marker_keys = []
+    for page in storage.iter_pages(activity_input.bucket, write_path + "/"):
+        for obj in page:
+            if _is_data_file(write_path, obj.key):
+                directories.setdefault(posixpath.dirname(obj.key), []).append(obj)
+            elif is_marker_key(write_path, obj.key):
+                marker_keys.append(obj.key)
+        heartbeat()
+    # Markers are read once here rather than for every group's commit
+    markers = markers_by_data_key(storage, activity_input.bucket, marker_keys)
+
+    groups = []
+    for directory, objects in sorted(directories.items()):
+        for group in _pack(objects, activity_input.target_file_size):
+            keys = [obj.key for obj in group]
+            groups.append(
+                CompactionGroup(
+                    directory,
+                    keys,
+                    [obj.size for obj in group],
+                    sum(obj.size for obj in group),
+                    sorted({m for key in keys for m in markers.get(key, [])}),
+                )
+            )
+    activity.logger.info(
+        "Planned %d compaction groups under %s", len(groups), activity_input.write_path
+    )
+    return groups
+
+
+def _history_typed(schema: pa.Schema, history: pa.Schema) -> pa.Schema:
+    """The schema with every column the history schema has given its type.
+
+    Files converted with ``fixed_schema=False``, or before it existed, infer
+    strings for columns the history schema types as integers, timestamps,
+    durations and enums, so files of both kinds only merge once typed alike.
+    """
+    return pa.schema(
+        [
+            history.field(f.name) if history.get_field_index(f.name) >= 0 else f
+            for f in schema
+        ],
+        metadata=schema.metadata,
+    )
+
+
+def _cast_column(column: pa.ChunkedArray, to: pa.DataType) -> pa.ChunkedArray:
+    if pa.types.is_duration(to) and pa.types.is_string(column.type):
+        # Inferred durations are in the proto JSON format, such as "1.5s"
+        seconds = pc.cast(pc.utf8_rtrim(column, characters="s"), pa.float64())
+        micros = pc.round(pc.multiply(seconds, 1_000_000))
+        return pc.cast(pc.cast(micros, pa.int64()), to)
+    return pc.cast(column, to)
+
+
+def _cast_to(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Cast a table's columns to the types they have in the schema."""
+    if table.schema.equals(schema):
+        return table
+    columns = [
+        (
+            _cast_column(column, schema.field(name).type)
+            if column.type != schema.field(name).type
+            else column
+        )
+        for name, column in zip(table.column_names, table.columns)
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def sort_events(table: pa.Table) -> pa.Table:
+    """Sort flattened events by workflow ID, then event time and ID."""
+    keys = {}
+    for name in SORT_COLUMNS:
+        if name not in table.column_names:
+            continue
+        column = table[name]
+        if name == "eventTime" and pa.types.is_string(column.type):
+            column = pc.cast(column, pa.timestamp("ns", tz="UTC"))
+        elif name == "eventId" and pa.types.is_string(column.type):
+            column = pc.cast(column, pa.int64())
+        keys[name] = column
+    if not keys:
+        return table
+    indices = pc.sort_indices(
+        pa.table(keys),
+        sort_keys=[(name, "ascending") for name in keys],
+    )
+    return table.take(indices)
+
+
+class _RangeFile(io.RawIOBase):
+    """Seekable read-only view of a stored object, read with ranged reads.
+
+    Parquet readers fetch the footer and then one row group's column chunks
+    at a time, so a file is never held in memory whole.
+    """
+
+    def __init__(self, bucket: str, key: str, size: int) -> None:
+        self._bucket = bucket
+        self._key = key
+        self._size = size
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer: Any) -> int:
+        end = min(self._position + len(buffer), self._size)
+        data = get_storage().read_range(self._bucket, self._key, self._position, end)
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def _staging_name(keys: List[str]) -> str:
+    # Named after the inputs so a retried attempt overwrites its own staging
+    # file instead of leaving another one behind
+    digest = hashlib.sha256("\n".join(sorted(keys)).encode()).hexdigest()[:32]
+    return f"compacted-{digest}.parquet"
+
+
+@activity.defn
+def compact_files(activity_input: CompactFilesActivityInput) -> CompactionResult:
+    """Function that merge a compaction group into one staging file.
+
+    Inputs are streamed a row group at a time, so memory is bounded by the
+    output row group size rather than the size of the group. Rows are sorted
+    within each output row group. Nothing under the output path changes until
+    the result is committed with commit_compaction. Reports bytes merged and
+    the time taken as metrics.
+    """
+    start = time.monotonic()
+    group = activity_input.group
+    storage = get_storage()
+    files = [
+        pq.ParquetFile(_RangeFile(activity_input.bucket, key, size), pre_buffer=True)
+        for key, size in zip(group.keys, group.sizes)
+    ]
+    # Files converted at different times may have different columns, and
+    # different types for the columns they share
+    history = history_event_schema()
+    file_schemas = [_history_typed(f.schema_arrow, history) for f in files]
+    schema = pa.unify_schemas(file_schemas, promote_options="default")
+    rows = sum(f.metadata.num_rows for f in files)
+    # Size row groups from the bytes per row of the inputs, which have the
+    # same compression as the output
+    rows_per_group = max(
+        1, activity_input.row_group_size_bytes * rows // max(1, group.total_bytes)
+    )
+    # Concatenating onto an empty table of the merged schema fills in the
+    # columns a file doesn't have
+    buffered = [schema.empty_table()]
+    buffered_rows = 0
+
+    name = _staging_name(group.keys)
+    staging_key = f"{activity_input.write_path}/{COMPACTION_DIR}/{name}"
+    sink = storage.open_write(activity_input.bucket, staging_key)
+    try:
+        sorting_columns = (
+            [pq.SortingColumn(schema.get_field_index("WorkflowId"))]
+            if "WorkflowId" in schema.names
+            else None
+        )
+        with pq.ParquetWriter(
+            sink,
+            schema,
+            compression="snappy",
+            sorting_columns=sorting_columns,
+        ) as writer:
+            for key, parquet_file, file_schema in zip(group.keys, files, file_schemas):
+                for batch in parquet_file.iter_batches():
+                    buffered.append(
+                        _cast_to(pa.Table.from_batches([batch]), file_schema)
+                    )
+                    buffered_rows += batch.num_rows
+                    while buffered_rows >= rows_per_group:
+                        table = pa.concat_tables(buffered, promote_options="default")
+                        writer.write_table(
+                            sort_events(table.slice(0, rows_per_group)),
+                            row_group_size=rows_per_group,
+                        )
+                        buffered = [schema.empty_table(), table.slice(rows_per_group)]
+                        buffered_rows -= rows_per_group
+                heartbeat(key)
+            if buffered_rows:
+                table = pa.concat_tables(buffered, promote_options="default")
+                writer.write_table(sort_events(table), row_group_size=rows_per_group)
+        output_bytes = sink.tell()
+        sink.close()
+    except BaseException:
+        sink.abort()  # type: ignore[attr-defined]
+        raise
+
+    elapsed = time.monotonic() - start
+    meter = activity_metric_meter()
+    meter.create_counter(
+        "parquet_compaction_bytes_merged", "Bytes of Parquet files merged", "By"
+    ).add(group.total_bytes)
+    meter.create_counter(
+        "parquet_compaction_files_merged", "Number of Parquet files merged"
+    ).add(len(group.keys))
+    meter.create_histogram_timedelta(
+        "parquet_compaction_duration", "Time to merge one compaction group"
+    ).record(timedelta(seconds=elapsed))
+    activity.logger.info(
+        "Merged %d files (%d bytes) in %s into %s in %.1fs",
+        len(group.keys),
+        group.total_bytes,
+        group.directory,
+        staging_key,
+        elapsed,
+    )
+    return CompactionResult(
+        activity_input.bucket,
+        activity_input.write_path,
+        staging_key,
+        f"{group.directory}/{name}",
+        group.keys,
+        group.marker_keys,
+        group.total_bytes,
+        output_bytes,
+        rows,
+    )
+
+
+@activity.defn
+def commit_compaction(result: CompactionResult) -> None:
+    """Function that swap a merged file in for the files it was merged from.
+
+    The merged file is published with a single move, incremental export
+    markers that pointed at the inputs are pointed at it, and the inputs are
+    then deleted. Every step is safe to repeat, so a retried commit finishes
+    the swap instead of duplicating or losing rows.
+    """
+    storage = get_storage()
+    if storage.exists(result.bucket, result.staging_key):
+        storage.move(result.bucket, result.staging_key, result.output_key)
+    elif not storage.exists(result.bucket, result.output_key):
+        raise FileNotFoundError(
+            f"Neither {result.staging_key} nor {result.output_key} exists"
+        )
+    input_keys = set(result.input_keys)
+    for key in result.marker_keys:
+        # The object may have been converted again since, replacing its marker
+        if not storage.exists(result.bucket, key):
+            continue
+        marker = read_marker(storage, result.bucket, key)
+        if marker.replace_compacted(input_keys, result.output_key):
+            write_marker(storage, result.bucket, result.write_path, marker)
+    for key in result.input_keys:
+        storage.delete(result.bucket, key)
@@ -12,6 +12,8 @@ from temporalio.client import (
 )
 
 from cloud_export_to_parquet.workflows import (
+    CompactParquet,
+    CompactParquetWorkflowInput,
     ProtoToParquet,
     ProtoToParquetWorkflowInput,
 )
@@ -59,6 +61,30 @@ async def main() -> None:
     except WorkflowFailureError:
         print("Got exception: ", traceback.format_exc())
 
+    # Compact each hour's output an hour after it was converted
+    compaction_input = CompactParquetWorkflowInput(
+        num_delay_hour=wf_input.num_delay_hour + 1,
+        namespace=wf_input.namespace,
+        output_s3_bucket=wf_input.output_s3_bucket,
+    )
+    try:
+        await client.create_schedule(
+            "hourly-parquet-compaction-wf-schedule",
+            Schedule(
+                action=ScheduleActionStartWorkflow(
+                    CompactParquet.run,
+                    compaction_input,
+                    id=f"parquet-compaction-{datetime.now()}",
+                    task_queue="DATA_TRANSFORMATION_TASK_QUEUE",
+                ),
+                spec=ScheduleSpec(
+                    intervals=[ScheduleIntervalSpec(every=timedelta(hours=1))]
+                ),
+            ),
+        )
+    except WorkflowFailureError:
+        print("Got exception: ", traceback.format_exc())
+
 
 if __name__ == "__main__":
     asyncio.run(main())
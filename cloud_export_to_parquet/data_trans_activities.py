@@ -1,19 +1,55 @@
+import contextvars
 import json
 import uuid
-from dataclasses import dataclass
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
-import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import temporalio.api.export.v1 as export
 from google.protobuf.json_format import MessageToJson
 from temporalio import activity
+from temporalio.common import MetricMeter
+from temporalio.exceptions import ApplicationError, CancelledError
+
+from cloud_export_to_parquet.history_schema import SchemaFlattener
+from cloud_export_to_parquet.incremental import (
+    ProcessedMarker,
+    delete_marker,
+    find_markers,
+    is_processed,
+    list_processed,
+    normalize_etag,
+    output_name,
+    write_marker,
+)
+from cloud_export_to_parquet.metrics import StageMetrics, TimedReader, TimedWriter
+from cloud_export_to_parquet.partitioning import (
+    EVENT_TYPE_COLUMN,
+    WORKFLOW_TYPE_FIELD_PATH,
+    partition_table,
+)
+from cloud_export_to_parquet.proto_flatten import ArrowFlattener, Projection
+from cloud_export_to_parquet.storage import ExportStorage, StoredObject, get_storage
+from cloud_export_to_parquet.streaming import (
+    iter_workflow_executions_with_offsets,
+    write_parquet_stream,
+)
+
+# Bytes of a key manifest read at a time, hundreds of keys
+MANIFEST_READ_SIZE = 64 * 1024
 
 
 @dataclass
 class GetObjectKeysActivityInput:
     bucket: str
     path: str
+    # When set, keys whose current ETag is already in the processed-key
+    # manifest of this output location are left out, see incremental.py
+    processed_bucket: Optional[str] = None
+    processed_write_path: Optional[str] = None
 
 
 @dataclass
@@ -22,57 +58,722 @@ class DataTransAndLandActivityInput:
     object_key: str
     output_s3_bucket: str
     write_path: str
+    # Decode and upload incrementally so memory is bounded by the row group
+    # size (in history events) rather than the file size
+    streaming: bool = False
+    row_group_size: int = 100_000
+    # Write Hive-style partitions (eventType=.../workflowType=...) instead of
+    # one file with the columns of every event type
+    partition_by_event_type: bool = False
+    partition_by_workflow_type: bool = False
+    # Name output after the object key, skip objects whose ETag is already
+    # in the processed-key manifest and record new ones there
+    incremental: bool = False
+    # Field paths to keep or drop, and whether to drop every payload field,
+    # see proto_flatten.Projection. Dropped fields are never decoded.
+    include_fields: Optional[List[str]] = None
+    exclude_fields: Optional[List[str]] = None
+    exclude_payload_fields: bool = False
+    # In streaming mode, finish the open files and checkpoint progress every
+    # this many row groups so a retry can resume there. 0 disables it.
+    checkpoint_row_groups: int = 10
+    # Write every file with the schema derived from the history protos, see
+    # history_schema.py, instead of columns and types inferred from its events
+    fixed_schema: bool = True
+    # In streaming mode, most partitions with a file open at once, each with
+    # its own upload buffer. 0 for no limit.
+    max_open_partitions: int = 16
+
+
+@dataclass
+class ConversionCheckpoint:
+    """Progress of data_trans_and_land_files, sent with every heartbeat.
+
+    A retried attempt continues from the last checkpoint its predecessor
+    heartbeated, as long as the export object still has the same ETag.
+    """
+
+    file_name: str
+    etag: str
+    executions_converted: int = 0
+    # Offset in the export object at which the next execution starts
+    byte_offset: int = 0
+    # Number of parts whose files are all uploaded, and those files
+    parts: int = 0
+    output_keys: List[str] = field(default_factory=list)
+    complete: bool = False
+
+
+@dataclass
+class DataTransAndLandBatchActivityInput:
+    """Input of data_trans_and_land_batch, which converts many small files into
+    one output file. Options mean the same as in DataTransAndLandActivityInput.
+    """
+
+    export_s3_bucket: str
+    object_keys: List[str]
+    output_s3_bucket: str
+    write_path: str
+    # Files downloaded and flattened at once within the batch
+    max_workers: int = 4
+    partition_by_event_type: bool = False
+    partition_by_workflow_type: bool = False
+    include_fields: Optional[List[str]] = None
+    exclude_fields: Optional[List[str]] = None
+    exclude_payload_fields: bool = False
+    fixed_schema: bool = True
+
+
+@dataclass
+class BatchKeyResult:
+    key: str
+    executions: int = 0
+    events: int = 0
+    # Why the file couldn't be converted, in which case none of its rows are
+    # in the output
+    error: Optional[str] = None
+
+
+@dataclass
+class BatchConversionResult:
+    output_keys: List[str]
+    # One per input key, in input order
+    results: List[BatchKeyResult]
+
+
+_ConversionInput = Union[
+    DataTransAndLandActivityInput, DataTransAndLandBatchActivityInput
+]
+
+
+@dataclass
+class CreateObjectKeyManifestActivityInput:
+    bucket: str
+    path: str
+    manifest_bucket: str
+    manifest_key: str
+    batch_size: int = 1000
+    processed_bucket: Optional[str] = None
+    processed_write_path: Optional[str] = None
+
+
+@dataclass
+class ObjectKeyManifest:
+    """Reference to a newline-delimited list of object keys in storage.
+
+    Batches of ``batch_size`` keys are read from a byte offset, and each tells
+    where the next one starts, so the reference has the same size however
+    many keys the manifest holds.
+    """
+
+    bucket: str
+    key: str
+    total_keys: int
+    batch_size: int
+    # Size of the manifest in bytes, where the batch after the last would start
+    size: int
+
+
+@dataclass
+class GetObjectKeysBatchActivityInput:
+    manifest: ObjectKeyManifest
+    # Byte offset of the batch's first key
+    offset: int = 0
+
+
+@dataclass
+class ObjectKeysBatch:
+    keys: List[str]
+    # Byte offset of the next batch, the manifest's size after the last batch
+    next_offset: int
+
+
+def heartbeat(*details: Any) -> None:
+    """Heartbeat and stop if the activity has been cancelled.
+
+    Activities on a thread pool have cancellation raised into them, but on a
+    process pool it is only visible through activity.is_cancelled().
+    """
+    activity.heartbeat(*details)
+    if activity.is_cancelled():
+        raise CancelledError("Activity cancelled")
+
+
+def _load_processed(
+    storage: ExportStorage, bucket: Optional[str], write_path: Optional[str]
+) -> Optional[Set[Tuple[str, str]]]:
+    if not bucket or not write_path:
+        return None
+    return list_processed(storage, bucket, write_path)
+
+
+def _unprocessed_objects(
+    page: List[StoredObject], processed: Optional[Set[Tuple[str, str]]]
+) -> List[StoredObject]:
+    return [
+        obj
+        for obj in page
+        if not processed or not is_processed(processed, obj.key, obj.etag)
+    ]
+
+
+def _list_unprocessed(activity_input: GetObjectKeysActivityInput) -> List[StoredObject]:
+    objects = []
+    total_objects = 0
+    storage = get_storage()
+    processed = _load_processed(
+        storage, activity_input.processed_bucket, activity_input.processed_write_path
+    )
+    for page in storage.iter_pages(activity_input.bucket, activity_input.path):
+        total_objects += len(page)
+        objects.extend(_unprocessed_objects(page, processed))
+        heartbeat(len(objects))
+    if total_objects == 0:
+        raise FileNotFoundError(
+            f"No files found in {activity_input.bucket}/{activity_input.path}"
+        )
+    if processed:
+        activity.logger.info(
+            "Skipping %d already processed files", total_objects - len(objects)
+        )
+    return objects
 
 
 @activity.defn
 def get_object_keys(activity_input: GetObjectKeysActivityInput) -> List[str]:
     """Function that list objects by key."""
-    object_keys = []
-    s3 = boto3.client("s3")
-    response = s3.list_objects_v2(
-        Bucket=activity_input.bucket, Prefix=activity_input.path
+    return [obj.key for obj in _list_unprocessed(activity_input)]
+
+
+@activity.defn
+def get_objects(activity_input: GetObjectKeysActivityInput) -> List[StoredObject]:
+    """Function that list objects with their sizes, for planning batches."""
+    return _list_unprocessed(activity_input)
+
+
+def batch_objects(
+    objects: List[StoredObject], target_bytes: int, max_keys: int
+) -> List[List[str]]:
+    """Group keys, in listing order, into batches of about ``target_bytes``.
+
+    A batch closes once adding the next object would take it over the target
+    or it has ``max_keys`` keys, so small files share a batch while a file of
+    the target size or larger gets a batch of its own.
+    """
+    batches: List[List[str]] = []
+    current: List[str] = []
+    current_size = 0
+    for obj in objects:
+        if current and (
+            current_size + obj.size > target_bytes or len(current) >= max_keys
+        ):
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(obj.key)
+        current_size += obj.size
+    if current:
+        batches.append(current)
+    return batches
+
+
+@activity.defn
+def create_object_key_manifest(
+    activity_input: CreateObjectKeyManifestActivityInput,
+) -> ObjectKeyManifest:
+    """Function that list objects by key into a manifest object.
+
+    Keys are streamed page by page into the manifest, so neither the activity
+    nor its result grows with the number of objects under the prefix.
+    """
+    storage = get_storage()
+    manifest = storage.open_write(
+        activity_input.manifest_bucket, activity_input.manifest_key
     )
-    for obj in response.get("Contents", []):
-        object_keys.append(obj["Key"])
-    if len(object_keys) == 0:
-        raise FileNotFoundError(
-            f"No files found in {activity_input.bucket}/{activity_input.path}"
+    total_keys = 0
+    total_objects = 0
+    try:
+        processed = _load_processed(
+            storage,
+            activity_input.processed_bucket,
+            activity_input.processed_write_path,
         )
+        for page in storage.iter_pages(activity_input.bucket, activity_input.path):
+            total_objects += len(page)
+            for obj in _unprocessed_objects(page, processed):
+                manifest.write(f"{obj.key}\n".encode())
+                total_keys += 1
+            heartbeat(total_keys)
+        if total_objects == 0:
+            raise FileNotFoundError(
+                f"No files found in {activity_input.bucket}/{activity_input.path}"
+            )
+        size = manifest.tell()
+        manifest.close()
+    except Exception as e:
+        activity.logger.error(f"Error writing key manifest: {e}")
+        manifest.abort()  # type: ignore[attr-defined]
+        raise e
 
-    return object_keys
+    activity.logger.info(
+        "Wrote %d keys to manifest %s", total_keys, activity_input.manifest_key
+    )
+    return ObjectKeyManifest(
+        activity_input.manifest_bucket,
+        activity_input.manifest_key,
+        total_keys,
+        activity_input.batch_size,
+        size,
+    )
+
+
+@activity.defn
+def get_object_keys_batch(
+    activity_input: GetObjectKeysBatchActivityInput,
+) -> ObjectKeysBatch:
+    """Function that read one batch of keys from a key manifest."""
+    manifest = activity_input.manifest
+    data = bytearray()
+    lines = 0
+    try:
+        body = get_storage().open_read(
+            manifest.bucket, manifest.key, activity_input.offset
+        )
+        try:
+            while lines < manifest.batch_size:
+                chunk = body.read(MANIFEST_READ_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+                lines += chunk.count(b"\n")
+        finally:
+            body.close()
+    except Exception as e:
+        activity.logger.error(f"Error reading key manifest: {e}")
+        raise e
+    # Leave what was read past the batch for the next one
+    end = 0
+    for _ in range(manifest.batch_size):
+        newline = data.find(b"\n", end)
+        if newline < 0:
+            end = len(data)
+            break
+        end = newline + 1
+    return ObjectKeysBatch(
+        data[:end].decode().splitlines(), activity_input.offset + end
+    )
+
+
+def _partitioner(
+    activity_input: _ConversionInput,
+) -> Optional[Callable[[pa.Table], List[Tuple[str, pa.Table]]]]:
+    if not (
+        activity_input.partition_by_event_type
+        or activity_input.partition_by_workflow_type
+    ):
+        return None
+    return lambda table: partition_table(
+        table,
+        by_event_type=activity_input.partition_by_event_type,
+        by_workflow_type=activity_input.partition_by_workflow_type,
+    )
+
+
+def _projection(activity_input: _ConversionInput) -> Projection:
+    include = list(activity_input.include_fields or [])
+    # Partitioning reads these columns, so an include list must keep them
+    if include and activity_input.partition_by_event_type:
+        include.append(EVENT_TYPE_COLUMN)
+    if include and activity_input.partition_by_workflow_type:
+        include.append(WORKFLOW_TYPE_FIELD_PATH)
+    return Projection(
+        include,
+        activity_input.exclude_fields or [],
+        activity_input.exclude_payload_fields,
+    )
+
+
+def _flattener(
+    activity_input: _ConversionInput,
+) -> Union[SchemaFlattener, ArrowFlattener]:
+    projection = _projection(activity_input)
+    if activity_input.fixed_schema:
+        return SchemaFlattener(projection)
+    return ArrowFlattener(projection)
+
+
+def _partition_path(write_path: str, partition_path: str) -> str:
+    return f"{write_path}/{partition_path}" if partition_path else write_path
 
 
 @activity.defn
 def data_trans_and_land(activity_input: DataTransAndLandActivityInput) -> str:
-    """Function that convert proto to parquet and save to S3."""
+    """Function that convert proto to parquet and save to S3.
+
+    Returns the key of the Parquet file written. Streaming and partitioning
+    can write several files, so inputs using them must go to
+    data_trans_and_land_files instead.
+    """
+    if activity_input.streaming or _partitioner(activity_input):
+        raise ApplicationError(
+            "Streaming and partitioned conversions write several files, "
+            "use data_trans_and_land_files",
+            non_retryable=True,
+        )
+    return data_trans_and_land_files(activity_input)[0]
+
+
+@activity.defn
+def data_trans_and_land_files(
+    activity_input: DataTransAndLandActivityInput,
+) -> List[str]:
+    """Function that convert proto to parquet and save to S3.
+
+    Returns the keys of every Parquet file written.
+    """
+    if not activity_input.incremental:
+        return trans_and_land(activity_input)
+
+    # Skip the object if this version of it was already converted, which also
+    # makes retries after a successful upload free
+    key = activity_input.object_key
+    storage = get_storage()
+    etag = normalize_etag(storage.etag(activity_input.export_s3_bucket, key))
+    markers = find_markers(
+        storage, activity_input.output_s3_bucket, activity_input.write_path, key
+    )
+    for marker in markers:
+        if marker.etag == etag:
+            activity.logger.info("Skipping unchanged file: %s", key)
+            return marker.data_keys
+
+    output_keys = trans_and_land(activity_input, output_name(key))
+    write_marker(
+        storage,
+        activity_input.output_s3_bucket,
+        activity_input.write_path,
+        ProcessedMarker(key, etag, output_keys),
+    )
+    # Drop what an older version of the object produced and this one didn't
+    # overwrite, such as partitions that no longer have rows
+    for marker in markers:
+        for stale_key in set(marker.output_keys) - set(output_keys):
+            storage.delete(activity_input.output_s3_bucket, stale_key)
+        delete_marker(
+            storage, activity_input.output_s3_bucket, activity_input.write_path, marker
+        )
+    return output_keys
+
+
+def _resume_checkpoint(
+    activity_input: DataTransAndLandActivityInput, name: Optional[str]
+) -> ConversionCheckpoint:
+    """Pick up the checkpoint of a previous attempt, or start a new one.
+
+    A checkpoint is only used if the export object hasn't changed since.
+    """
+    etag = normalize_etag(
+        get_storage().etag(activity_input.export_s3_bucket, activity_input.object_key)
+    )
+    details = activity.info().heartbeat_details
+    if details and isinstance(details[0], dict):
+        try:
+            checkpoint = ConversionCheckpoint(**details[0])
+        except TypeError:
+            pass
+        else:
+            if checkpoint.etag == etag and name in (None, checkpoint.file_name):
+                return checkpoint
+    return ConversionCheckpoint(name or str(uuid.uuid1()), etag)
+
+
+def trans_and_land(
+    activity_input: DataTransAndLandActivityInput, name: Optional[str] = None
+) -> List[str]:
+    """Function that convert proto to parquet and save to S3.
+
+    Output files are named ``name`` or, if not given, a new UUID. Progress is
+    checkpointed in heartbeats, so a retried attempt reuses the output of an
+    attempt that finished uploading, and in streaming mode resumes after the
+    last uploaded part.
+    """
     key = activity_input.object_key
-    data = get_data_from_object_key(activity_input.export_s3_bucket, key)
+    checkpoint = _resume_checkpoint(activity_input, name)
+    if checkpoint.complete:
+        activity.logger.info("Output of an earlier attempt is complete: %s", key)
+        return checkpoint.output_keys
+    # Stage timings are recorded for failed attempts too
+    metrics = StageMetrics.for_activity()
+    try:
+        if activity_input.streaming:
+            return stream_trans_and_land(activity_input, checkpoint, metrics)
+        return _trans_and_land_file(activity_input, checkpoint, metrics)
+    finally:
+        activity.logger.info("Stage totals for file %s: %s", key, metrics.summary())
+        metrics.publish()
+
+
+def _trans_and_land_file(
+    activity_input: DataTransAndLandActivityInput,
+    checkpoint: ConversionCheckpoint,
+    metrics: StageMetrics,
+) -> List[str]:
+    key = activity_input.object_key
+    data = get_data_from_object_key(activity_input.export_s3_bucket, key, metrics)
+    heartbeat(checkpoint)
     activity.logger.info("Convert proto to parquet for file: %s", key)
-    parquet_data = convert_proto_to_parquet_flatten(data)
+    with metrics.stage("flatten"):
+        parquet_data = _flattener(activity_input).flatten(
+            data, progress=lambda _: heartbeat(checkpoint)
+        )
+        partitioner = _partitioner(activity_input)
+        # Every partition gets a file of the same name
+        partitions = partitioner(parquet_data) if partitioner else [("", parquet_data)]
+    metrics.add_bytes("flatten", parquet_data.nbytes)
     activity.logger.info("Finish transformation for file: %s", key)
-    return save_to_sink(
-        parquet_data, activity_input.output_s3_bucket, activity_input.write_path
+    heartbeat(checkpoint)
+    output_keys = [
+        save_to_sink(
+            partition,
+            activity_input.output_s3_bucket,
+            _partition_path(activity_input.write_path, path),
+            checkpoint.file_name,
+            metrics,
+        )
+        for path, partition in partitions
+    ]
+    checkpoint.executions_converted = len(data.items)
+    checkpoint.output_keys = output_keys
+    checkpoint.complete = True
+    heartbeat(checkpoint)
+    return output_keys
+
+
+def stream_trans_and_land(
+    activity_input: DataTransAndLandActivityInput,
+    checkpoint: ConversionCheckpoint,
+    metrics: StageMetrics,
+) -> List[str]:
+    """Function that convert proto to parquet while streaming from and to storage.
+
+    Every ``checkpoint_row_groups`` row groups the open files are finished as
+    one part and the checkpoint moves past them. Decoding starts at the
+    checkpoint's byte offset, so a retried attempt only converts what comes
+    after the parts already uploaded. Within a part, a partition gets more
+    than one file only when later row groups bring columns its first file
+    doesn't have, or when more than ``max_open_partitions`` partitions were
+    written to since its file was opened. Downloading overlaps with parsing
+    and encoding with uploading, and each is timed separately in ``metrics``.
+    """
+    key = activity_input.object_key
+    storage = get_storage()
+    start_offset = checkpoint.byte_offset
+    start_executions = checkpoint.executions_converted
+    if start_executions:
+        activity.logger.info(
+            "Resume proto to parquet for file: %s after %d executions",
+            key,
+            start_executions,
+        )
+    else:
+        activity.logger.info("Stream proto to parquet for file: %s", key)
+    try:
+        body = storage.open_read(activity_input.export_s3_bucket, key, start_offset)
+    except Exception as e:
+        activity.logger.error(f"Error reading object: {e}")
+        raise e
+
+    # Keys of files in the part being written
+    part_keys: List[str] = []
+    position = start_offset
+    decoded = 0
+
+    def executions() -> Iterator[export.WorkflowExecution]:
+        nonlocal position, decoded
+        decoder = iter_workflow_executions_with_offsets(
+            TimedReader(body, metrics)  # type: ignore[arg-type]
+        )
+        while True:
+            # Reads within are timed as the download stage
+            with metrics.stage("parse"):
+                item = next(decoder, None)
+            if item is None:
+                return
+            wf, offset = item
+            metrics.add_bytes("parse", start_offset + offset - position)
+            position = start_offset + offset
+            decoded += 1
+            yield wf
+
+    def open_sink(path: str, index: int) -> IO[bytes]:
+        part = f"-part-{checkpoint.parts}" if checkpoint.parts else ""
+        suffix = f"-{index}" if index else ""
+        write_path = _partition_path(activity_input.write_path, path)
+        output_key = f"{write_path}/{checkpoint.file_name}{part}{suffix}.parquet"
+        activity.logger.info("Writing to S3 bucket: %s", output_key)
+        part_keys.append(output_key)
+        return TimedWriter(  # type: ignore[return-value]
+            storage.open_write(activity_input.output_s3_bucket, output_key), metrics
+        )
+
+    def on_checkpoint(executions_written: int) -> None:
+        checkpoint.executions_converted = start_executions + executions_written
+        checkpoint.byte_offset = position
+        checkpoint.parts += 1
+        checkpoint.output_keys.extend(part_keys)
+        part_keys.clear()
+        heartbeat(checkpoint)
+
+    try:
+        write_parquet_stream(
+            executions(),
+            open_sink,
+            activity_input.row_group_size,
+            on_row_group=lambda _: heartbeat(checkpoint),
+            partition=_partitioner(activity_input),
+            projection=_projection(activity_input),
+            checkpoint_row_groups=activity_input.checkpoint_row_groups,
+            on_checkpoint=on_checkpoint,
+            fixed_schema=activity_input.fixed_schema,
+            metrics=metrics,
+            max_open_files=activity_input.max_open_partitions,
+        )
+    except Exception as e:
+        activity.logger.error(f"Error streaming to sink: {e}")
+        raise e
+    finally:
+        body.close()
+    checkpoint.executions_converted = start_executions + decoded
+    checkpoint.byte_offset = position
+    checkpoint.output_keys.extend(part_keys)
+    checkpoint.complete = True
+    heartbeat(checkpoint)
+    activity.logger.info("Finish transformation for file: %s", key)
+    return checkpoint.output_keys
+
+
+def _convert_key(
+    activity_input: DataTransAndLandBatchActivityInput,
+    key: str,
+    metrics: StageMetrics,
+) -> Tuple[pa.Table, int]:
+    data = get_data_from_object_key(activity_input.export_s3_bucket, key, metrics)
+    with metrics.stage("flatten"):
+        table = _flattener(activity_input).flatten(data)
+    metrics.add_bytes("flatten", table.nbytes)
+    return table, len(data.items)
+
+
+@activity.defn
+def data_trans_and_land_batch(
+    activity_input: DataTransAndLandBatchActivityInput,
+) -> BatchConversionResult:
+    """Function that convert a batch of proto files to one parquet file.
+
+    Files are downloaded and flattened on a pool of ``max_workers`` threads,
+    which overlaps downloads with flattening, and their rows are combined in
+    key order. A file that fails is reported in its key's result and left out
+    of the output instead of failing the batch; the activity only fails if
+    every file does. Output is named after the workflow run and activity ID,
+    so a retried attempt overwrites what an earlier one wrote.
+    """
+    metrics = StageMetrics.for_activity()
+    try:
+        return _trans_and_land_batch(activity_input, metrics)
+    finally:
+        activity.logger.info("Stage totals for batch: %s", metrics.summary())
+        metrics.publish()
+
+
+def _trans_and_land_batch(
+    activity_input: DataTransAndLandBatchActivityInput, metrics: StageMetrics
+) -> BatchConversionResult:
+    keys = activity_input.object_keys
+    results = {key: BatchKeyResult(key) for key in keys}
+    tables: Dict[str, pa.Table] = {}
+    pool = ThreadPoolExecutor(max(1, activity_input.max_workers))
+    try:
+        # Each file runs in a copy of the activity's context, so its log
+        # lines carry the activity's details
+        futures = {
+            pool.submit(
+                contextvars.copy_context().run,
+                _convert_key,
+                activity_input,
+                key,
+                metrics,
+            ): key
+            for key in keys
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                table, executions = future.result()
+            except Exception as e:
+                activity.logger.error(f"Error converting {key}: {e}")
+                results[key].error = str(e)
+            else:
+                tables[key] = table
+                results[key].executions = executions
+                results[key].events = table.num_rows
+            heartbeat(len(tables))
+    finally:
+        pool.shutdown(cancel_futures=True)
+    if not tables:
+        raise RuntimeError(
+            f"Every file of the batch failed, first: {results[keys[0]].error}"
+        )
+
+    converted = len(tables)
+    # Without the fixed schema, files can have different columns
+    parquet_data = pa.concat_tables(
+        [tables[key] for key in keys if key in tables], promote_options="default"
     )
+    tables.clear()
+    info = activity.info()
+    name = f"batch-{info.workflow_run_id}-{info.activity_id}"
+    partitioner = _partitioner(activity_input)
+    partitions = partitioner(parquet_data) if partitioner else [("", parquet_data)]
+    output_keys = [
+        save_to_sink(
+            partition,
+            activity_input.output_s3_bucket,
+            _partition_path(activity_input.write_path, path),
+            name,
+            metrics,
+        )
+        for path, partition in partitions
+    ]
+    activity.logger.info("Converted %d of %d files into %s", converted, len(keys), name)
+    return BatchConversionResult(output_keys, [results[key] for key in keys])
 
 
 def get_data_from_object_key(
-    bucket_name: str, object_key: str
+    bucket_name: str, object_key: str, metrics: Optional[StageMetrics] = None
 ) -> export.WorkflowExecutions:
     """Function that get object by key."""
+    metrics = metrics or StageMetrics(MetricMeter.noop)
     v = export.WorkflowExecutions()
 
-    s3 = boto3.client("s3")
     try:
-        data = s3.get_object(Bucket=bucket_name, Key=object_key)["Body"].read()
+        with metrics.stage("download"):
+            data = get_storage().read(bucket_name, object_key)
     except Exception as e:
         activity.logger.error(f"Error reading object: {e}")
         raise e
-    v.ParseFromString(data)
+    metrics.add_bytes("download", len(data))
+    with metrics.stage("parse"):
+        v.ParseFromString(data)
+    metrics.add_bytes("parse", len(data))
     return v
 
 
 def convert_proto_to_parquet_flatten(wfs: export.WorkflowExecutions) -> pd.DataFrame:
-    """Function that convert flatten proto data to parquet."""
+    """Function that convert flatten proto data to parquet.
+
+    This is the original pandas implementation, kept as the reference output
+    for convert_proto_to_arrow_flatten and for benchmarking against it.
+    """
     dfs = []
     for wf in wfs.items:
         start_attributes = wf.history.events[
@@ -106,17 +807,28 @@ def convert_proto_to_parquet_flatten(wfs: export.WorkflowExecutions) -> pd.DataF
     return df_flatten
 
 
-def save_to_sink(data: pd.DataFrame, s3_bucket: str, write_path: str) -> str:
+def save_to_sink(
+    data: pa.Table,
+    s3_bucket: str,
+    write_path: str,
+    name: Optional[str] = None,
+    metrics: Optional[StageMetrics] = None,
+) -> str:
     """Function that save object to s3 bucket."""
-    write_bytes = data.to_parquet(None, compression="snappy", index=False)
-    uuid_name = uuid.uuid1()
-    file_name = f"{uuid_name}.parquet"
+    metrics = metrics or StageMetrics(MetricMeter.noop)
+    with metrics.stage("encode"):
+        sink = pa.BufferOutputStream()
+        pq.write_table(data, sink, compression="snappy")
+        write_bytes = sink.getvalue().to_pybytes()
+    metrics.add_bytes("encode", len(write_bytes))
+    file_name = f"{name or uuid.uuid1()}.parquet"
     activity.logger.info("Writing to S3 bucket: %s", file_name)
 
-    s3 = boto3.client("s3")
     try:
         key = f"{write_path}/{file_name}"
-        s3.put_object(Bucket=s3_bucket, Key=key, Body=write_bytes)
+        with metrics.stage("upload"):
+            get_storage().write(s3_bucket, key, write_bytes)
+        metrics.add_bytes("upload", len(write_bytes))
         return key
     except Exception as e:
         activity.logger.error(f"Error saving to sink: {e}")
@@ -0,0 +1,321 @@
+import json
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import pyarrow as pa
+import temporalio.api.export.v1 as export
+from google.protobuf.descriptor import Descriptor, FieldDescriptor
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.message import Message
+from temporalio.api.history.v1 import HistoryEvent
+
+from cloud_export_to_parquet.proto_flatten import (
+    _PAYLOAD_TYPES,
+    PROGRESS_INTERVAL,
+    Projection,
+    _is_repeated,
+    _Scope,
+)
+
+_SCALAR_TYPES = {
+    FieldDescriptor.TYPE_INT32: pa.int32(),
+    FieldDescriptor.TYPE_SINT32: pa.int32(),
+    FieldDescriptor.TYPE_SFIXED32: pa.int32(),
+    FieldDescriptor.TYPE_UINT32: pa.uint32(),
+    FieldDescriptor.TYPE_FIXED32: pa.uint32(),
+    FieldDescriptor.TYPE_INT64: pa.int64(),
+    FieldDescriptor.TYPE_SINT64: pa.int64(),
+    FieldDescriptor.TYPE_SFIXED64: pa.int64(),
+    FieldDescriptor.TYPE_UINT64: pa.uint64(),
+    FieldDescriptor.TYPE_FIXED64: pa.uint64(),
+    FieldDescriptor.TYPE_BOOL: pa.bool_(),
+    FieldDescriptor.TYPE_FLOAT: pa.float32(),
+    FieldDescriptor.TYPE_DOUBLE: pa.float64(),
+    FieldDescriptor.TYPE_STRING: pa.string(),
+    FieldDescriptor.TYPE_BYTES: pa.binary(),
+}
+
+_WRAPPER_TYPES = {
+    "google.protobuf.BoolValue",
+    "google.protobuf.BytesValue",
+    "google.protobuf.DoubleValue",
+    "google.protobuf.FloatValue",
+    "google.protobuf.Int32Value",
+    "google.protobuf.Int64Value",
+    "google.protobuf.StringValue",
+    "google.protobuf.UInt32Value",
+    "google.protobuf.UInt64Value",
+}
+
+# Enums are stored as their names, dictionary encoded since every column only
+# has a handful of distinct values
+ENUM_TYPE = pa.dictionary(pa.int32(), pa.string())
+TIMESTAMP_TYPE = pa.timestamp("us", tz="UTC")
+DURATION_TYPE = pa.duration("us")
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def _to_json(message: Message) -> str:
+    return json.dumps(MessageToDict(message), separators=(",", ":"))
+
+
+def _enum_name(field: FieldDescriptor) -> Callable[[int], str]:
+    assert field.enum_type is not None
+    values = field.enum_type.values_by_number
+    # Numbers from a newer server than these protos are kept as strings
+    return lambda v: values[v].name if v in values else str(v)
+
+
+def _value_type(
+    field: FieldDescriptor, in_list: bool
+) -> Optional[Tuple[pa.DataType, Callable[[Any], Any]]]:
+    """Arrow type of a single value of a field and a converter producing it.
+
+    Returns None for messages that are walked into columns of their own.
+    Enums inside lists and maps are plain strings rather than dictionaries.
+    """
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        return pa.string() if in_list else ENUM_TYPE, _enum_name(field)
+    message_type = field.message_type
+    if message_type is None:
+        return _SCALAR_TYPES[field.type], _identity
+    name = message_type.full_name
+    if name == "google.protobuf.Timestamp":
+        return TIMESTAMP_TYPE, lambda v: v.ToMicroseconds()
+    if name == "google.protobuf.Duration":
+        return DURATION_TYPE, lambda v: v.ToMicroseconds()
+    if name in _WRAPPER_TYPES:
+        value_type, _ = _item_type(message_type.fields_by_name["value"])
+        return value_type, lambda v: v.value
+    if in_list or name.startswith("google.protobuf."):
+        return pa.string(), _to_json
+    return None
+
+
+def _item_type(field: FieldDescriptor) -> Tuple[pa.DataType, Callable[[Any], Any]]:
+    """Arrow type and converter of the items of a list or map."""
+    item = _value_type(field, True)
+    assert item is not None
+    return item
+
+
+def _list_type(
+    field: FieldDescriptor,
+) -> Optional[Tuple[pa.DataType, Callable[[Any], Any]]]:
+    """Arrow type and converter of a map or repeated field, None otherwise."""
+    message_type = field.message_type
+    if message_type is not None and message_type.GetOptions().map_entry:
+        key_type, convert_key = _item_type(message_type.fields_by_name["key"])
+        value_type, convert_value = _item_type(message_type.fields_by_name["value"])
+        return pa.map_(key_type, value_type), lambda v: [
+            (convert_key(k), convert_value(item)) for k, item in v.items()
+        ]
+    if _is_repeated(field):
+        value_type, convert = _item_type(field)
+        return pa.list_(value_type), lambda v: [convert(item) for item in v]
+    return None
+
+
+def _is_payload_field(field: FieldDescriptor) -> bool:
+    message_type = field.message_type
+    if message_type is not None and message_type.GetOptions().map_entry:
+        message_type = message_type.fields_by_name["value"].message_type
+    return message_type is not None and message_type.full_name in _PAYLOAD_TYPES
+
+
+# A compiled message: for each field either the column index and converter of
+# its value, or the compiled fields of the message it holds
+_Node = Dict[FieldDescriptor, Tuple[int, Callable[[Any], Any], Optional[dict]]]
+
+
+class HistorySchema:
+    """Fixed Arrow schema of flattened history events, derived from the
+    ``temporalio.api.history.v1`` descriptors rather than from the data.
+
+    Column names match the inferred flattening of :mod:`proto_flatten`:
+    WorkflowId and RunId, then every field below ``HistoryEvent`` with its
+    JSON path joined by ``_``. Values get their natural Arrow types: integers
+    and floats of the proto's width, enums as dictionary encoded names,
+    timestamps and durations in microseconds. Messages are walked into
+    columns of their own, except where that would recurse (like a failure's
+    ``cause``), inside maps and lists, and for ``google.protobuf`` types such
+    as ``Struct``; those hold JSON strings. Maps and repeated fields are one
+    map or list column each, so map keys are not projection path segments
+    here.
+    """
+
+    def __init__(self, projection: Optional[Projection] = None) -> None:
+        projection = projection or Projection()
+        self._skip_payloads = projection.exclude_payload_fields
+        self.fields: List[pa.Field] = [
+            pa.field("WorkflowId", pa.string()),
+            pa.field("RunId", pa.string()),
+        ]
+        self.root = self._compile(
+            HistoryEvent.DESCRIPTOR,
+            _Scope.root(projection),
+            {HistoryEvent.DESCRIPTOR.full_name},
+        )
+        self.schema = pa.schema(self.fields)
+
+    def _add_column(self, name: str, type: pa.DataType) -> int:
+        self.fields.append(pa.field(name, type))
+        return len(self.fields) - 1
+
+    def _compile(self, descriptor: Descriptor, scope: _Scope, path: Set[str]) -> _Node:
+        node: _Node = {}
+        for field in descriptor.fields:
+            if self._skip_payloads and _is_payload_field(field):
+                continue
+            child = scope.child(field.json_name)
+            if child is None:
+                continue
+            value = _list_type(field) or _value_type(field, False)
+            # Fields without a value type are messages
+            message_type = field.message_type
+            if value is None:
+                assert message_type is not None
+                if message_type.full_name in path:
+                    # Recursive messages can't have a fixed set of columns
+                    value = pa.string(), _to_json
+            if value is not None:
+                if child.complete:
+                    value_type, convert = value
+                    node[field] = (
+                        self._add_column(child.name, value_type),
+                        convert,
+                        None,
+                    )
+                continue
+            assert message_type is not None
+            children = self._compile(
+                message_type, child, path | {message_type.full_name}
+            )
+            if children:
+                node[field] = (-1, _identity, children)
+        return node
+
+
+@lru_cache(maxsize=32)
+def _history_schema(
+    include: Tuple[str, ...], exclude: Tuple[str, ...], exclude_payload_fields: bool
+) -> HistorySchema:
+    return HistorySchema(Projection(include, exclude, exclude_payload_fields))
+
+
+def history_schema(projection: Optional[Projection] = None) -> HistorySchema:
+    """The schema for a projection, built once per process and then cached."""
+    projection = projection or Projection()
+    return _history_schema(
+        tuple(projection.include),
+        tuple(projection.exclude),
+        projection.exclude_payload_fields,
+    )
+
+
+def history_event_schema(projection: Optional[Projection] = None) -> pa.Schema:
+    """Function that returns the Arrow schema of flattened history events."""
+    return history_schema(projection).schema
+
+
+class SchemaFlattener:
+    """Flattens export protos into tables that all have the same schema.
+
+    A drop-in for :class:`proto_flatten.ArrowFlattener` that fills the columns
+    of :class:`HistorySchema` instead of inferring columns and types from the
+    events at hand, so files converted from different exports can be read
+    together without schema merging. Columns no event sets are all-null
+    arrays, which are never materialized as Python lists.
+    """
+
+    def __init__(self, projection: Optional[Projection] = None) -> None:
+        self._history_schema = history_schema(projection)
+
+    @property
+    def schema(self) -> pa.Schema:
+        return self._history_schema.schema
+
+    def flatten(
+        self,
+        wfs: export.WorkflowExecutions,
+        progress: Optional[Callable[[int], None]] = None,
+    ) -> pa.Table:
+        """Flatten every event of every workflow execution into one table."""
+        return self.flatten_executions(wfs.items, progress)
+
+    def flatten_executions(
+        self,
+        executions: Sequence[export.WorkflowExecution],
+        progress: Optional[Callable[[int], None]] = None,
+    ) -> pa.Table:
+        """Flatten every event of the given workflow executions into one table.
+
+        ``progress`` is called as by ``ArrowFlattener.flatten_executions``.
+        """
+        schema = self.schema
+        num_rows = sum(len(wf.history.events) for wf in executions)
+        buffers: List[Optional[List[Any]]] = [None] * len(schema)
+        workflow_ids: List[Any] = [None] * num_rows
+        run_ids: List[Any] = [None] * num_rows
+        root = self._history_schema.root
+        row = 0
+        for i, wf in enumerate(executions):
+            if progress is not None and i and i % PROGRESS_INTERVAL == 0:
+                progress(i)
+            events = wf.history.events
+            if not events:
+                continue
+            start_attributes = events[0].workflow_execution_started_event_attributes
+            workflow_id = start_attributes.workflow_id
+            run_id = start_attributes.original_execution_run_id
+            for event in events:
+                workflow_ids[row] = workflow_id
+                run_ids[row] = run_id
+                _walk(event, root, row, buffers, num_rows)
+                row += 1
+        buffers[0] = workflow_ids
+        buffers[1] = run_ids
+
+        arrays = []
+        for field, buffer in zip(schema, buffers):
+            if buffer is None:
+                arrays.append(pa.nulls(num_rows, field.type))
+            elif field.type == ENUM_TYPE:
+                arrays.append(pa.array(buffer, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(buffer, field.type))
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _walk(
+    message: Message,
+    node: _Node,
+    row: int,
+    buffers: List[Optional[List[Any]]],
+    num_rows: int,
+) -> None:
+    for field, value in message.ListFields():
+        compiled = node.get(field)
+        if compiled is None:
+            continue
+        index, convert, children = compiled
+        if children is not None:
+            _walk(value, children, row, buffers, num_rows)
+            continue
+        buffer = buffers[index]
+        if buffer is None:
+            buffer = [None] * num_rows
+            buffers[index] = buffer
+        buffer[row] = convert(value)
+
+
+def convert_proto_to_arrow_schema(
+    wfs: export.WorkflowExecutions,
+    projection: Optional[Projection] = None,
+    progress: Optional[Callable[[int], None]] = None,
+) -> pa.Table:
+    """Function that flattens export protos into a table of the fixed schema."""
+    return SchemaFlattener(projection).flatten(wfs, progress)
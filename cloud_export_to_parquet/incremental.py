@@ -0,0 +1,148 @@
+import hashlib
+import json
+import posixpath
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from cloud_export_to_parquet.storage import ExportStorage
+
+PROCESSED_DIR = "_processed"
+
+
+@dataclass
+class ProcessedMarker:
+    """Record that one export object was converted, and into which files.
+
+    Markers live at ``<write_path>/_processed/<output name>/<etag>.json``, so
+    listing the ``_processed`` prefix yields every processed key and the ETag
+    it had when converted without reading any marker bodies. Together the
+    markers form the processed-key manifest of an output path.
+
+    Once compaction merges an output file into a file shared with other
+    objects, its key moves from ``output_keys`` to ``compacted_keys``.
+    Converting a new version of the object deletes stale ``output_keys`` but
+    never ``compacted_keys``, which hold other objects' rows too.
+    """
+
+    object_key: str
+    etag: str
+    output_keys: List[str]
+    compacted_keys: List[str] = field(default_factory=list)
+
+    @property
+    def data_keys(self) -> List[str]:
+        """Keys of every file holding rows of the object."""
+        return self.output_keys + self.compacted_keys
+
+    def replace_compacted(self, input_keys: Set[str], merged_key: str) -> bool:
+        """Point keys merged by a compaction at the merged file.
+
+        Returns whether anything changed, so repeating it is a no-op.
+        """
+        if not input_keys & set(self.data_keys):
+            return False
+        self.output_keys = [k for k in self.output_keys if k not in input_keys]
+        self.compacted_keys = [k for k in self.compacted_keys if k not in input_keys]
+        if merged_key not in self.compacted_keys:
+            self.compacted_keys.append(merged_key)
+        return True
+
+
+def output_name(object_key: str) -> str:
+    """Deterministic output file name for an export object key.
+
+    The object's base name keeps outputs recognizable, and a digest of the
+    full key keeps them unique if two prefixes share a base name.
+    """
+    stem = posixpath.basename(object_key).split(".", 1)[0] or "export"
+    digest = hashlib.sha256(object_key.encode()).hexdigest()[:12]
+    return f"{stem}-{digest}"
+
+
+def normalize_etag(etag: str) -> str:
+    return etag.strip('"')
+
+
+def processed_prefix(write_path: str) -> str:
+    return f"{write_path}/{PROCESSED_DIR}/"
+
+
+def marker_key(write_path: str, object_key: str, etag: str) -> str:
+    return (
+        f"{processed_prefix(write_path)}{output_name(object_key)}/"
+        f"{normalize_etag(etag)}.json"
+    )
+
+
+def _parse_marker_key(write_path: str, key: str) -> Optional[Tuple[str, str]]:
+    relative = key[len(processed_prefix(write_path)) :]
+    name, _, file_name = relative.partition("/")
+    if not file_name.endswith(".json"):
+        return None
+    return name, file_name[: -len(".json")]
+
+
+def list_processed(
+    storage: ExportStorage, bucket: str, write_path: str
+) -> Set[Tuple[str, str]]:
+    """Return the (output name, ETag) pairs recorded under an output path."""
+    processed = set()
+    for page in storage.iter_pages(bucket, processed_prefix(write_path)):
+        for obj in page:
+            parsed = _parse_marker_key(write_path, obj.key)
+            if parsed:
+                processed.add(parsed)
+    return processed
+
+
+def is_processed(processed: Set[Tuple[str, str]], object_key: str, etag: str) -> bool:
+    return (output_name(object_key), normalize_etag(etag)) in processed
+
+
+def read_marker(storage: ExportStorage, bucket: str, key: str) -> ProcessedMarker:
+    return ProcessedMarker(**json.loads(storage.read(bucket, key)))
+
+
+def markers_by_data_key(
+    storage: ExportStorage, bucket: str, marker_keys: List[str]
+) -> Dict[str, List[str]]:
+    """Map each file that markers point at to the keys of those markers."""
+    by_data_key: Dict[str, List[str]] = {}
+    for key in marker_keys:
+        for data_key in read_marker(storage, bucket, key).data_keys:
+            by_data_key.setdefault(data_key, []).append(key)
+    return by_data_key
+
+
+def find_markers(
+    storage: ExportStorage, bucket: str, write_path: str, object_key: str
+) -> List[ProcessedMarker]:
+    """Read every marker recorded for an export object, for any ETag."""
+    prefix = f"{processed_prefix(write_path)}{output_name(object_key)}/"
+    markers = []
+    for page in storage.iter_pages(bucket, prefix):
+        for obj in page:
+            markers.append(read_marker(storage, bucket, obj.key))
+    return markers
+
+
+def write_marker(
+    storage: ExportStorage, bucket: str, write_path: str, marker: ProcessedMarker
+) -> None:
+    storage.write(
+        bucket,
+        marker_key(write_path, marker.object_key, marker.etag),
+        json.dumps(asdict(marker)).encode(),
+    )
+
+
+def is_marker_key(write_path: str, key: str) -> bool:
+    return key.startswith(processed_prefix(write_path)) and bool(
+        _parse_marker_key(write_path, key)
+    )
+
+
+def delete_marker(
+    storage: ExportStorage, bucket: str, write_path: str, marker: ProcessedMarker
+) -> None:
+    storage.delete(bucket, marker_key(write_path, marker.object_key, marker.etag))
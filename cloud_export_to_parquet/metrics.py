@@ -0,0 +1,192 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import IO, Dict, Iterator, List, Sequence
+
+from temporalio import activity
+from temporalio.common import MetricMeter
+
+# Stages of converting one export file, in pipeline order
+STAGES = ("download", "parse", "flatten", "encode", "upload")
+
+STAGE_DURATION_METRIC = "parquet_export_stage_duration"
+STAGE_BYTES_METRIC = "parquet_export_stage_bytes"
+
+# Durations are recorded in milliseconds. The SDK's default buckets stop at
+# 10 seconds, which is where conversion stages of large files begin.
+DURATION_BUCKETS_MS: Sequence[float] = (
+    10,
+    50,
+    100,
+    250,
+    500,
+    1_000,
+    2_500,
+    5_000,
+    10_000,
+    30_000,
+    60_000,
+    120_000,
+    300_000,
+    600_000,
+    900_000,
+)
+
+# Bucket boundaries for the duration histograms of this sample, for
+# PrometheusConfig(histogram_bucket_overrides=...) in run_worker.py
+HISTOGRAM_BUCKET_OVERRIDES: Dict[str, Sequence[float]] = {
+    STAGE_DURATION_METRIC: DURATION_BUCKETS_MS,
+    "parquet_compaction_duration": DURATION_BUCKETS_MS,
+    "parquet_compaction_workflow_duration": DURATION_BUCKETS_MS,
+}
+
+
+def activity_metric_meter() -> MetricMeter:
+    """The current activity's metric meter, or a no-op meter where there is none.
+
+    Activities running on a process pool have no metric meter, since metrics
+    can't cross the process boundary, and ``activity.metric_meter()`` raises
+    there.
+    """
+    try:
+        return activity.metric_meter()
+    except RuntimeError:
+        return MetricMeter.noop
+
+
+class StageMetrics:
+    """Time and bytes spent in each stage of converting export files.
+
+    Stages are timed with :meth:`stage` and may nest, e.g. an upload that
+    happens while encoding; a stage's time excludes the stages nested in it,
+    so the stages add up to the wall time measured. Totals accumulate across
+    threads and are recorded through the activity's metric meter by
+    :meth:`publish`, once per stage rather than once per call, so a streaming
+    conversion doesn't record thousands of tiny samples.
+    """
+
+    def __init__(self, meter: MetricMeter) -> None:
+        duration = meter.create_histogram_timedelta(
+            STAGE_DURATION_METRIC,
+            "Time spent in one stage of converting export files",
+            "ms",
+        )
+        counter = meter.create_counter(
+            STAGE_BYTES_METRIC,
+            "Bytes processed by one stage of converting export files",
+            "By",
+        )
+        self._durations = {
+            stage: duration.with_additional_attributes({"stage": stage})
+            for stage in STAGES
+        }
+        self._counters = {
+            stage: counter.with_additional_attributes({"stage": stage})
+            for stage in STAGES
+        }
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.bytes = {stage: 0 for stage in STAGES}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def for_activity(cls) -> "StageMetrics":
+        return cls(activity_metric_meter())
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        # Time of the stages nested in each open stage of this thread
+        stack: List[float] = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.seconds[stage] += elapsed - nested
+
+    def add_bytes(self, stage: str, num_bytes: int) -> None:
+        with self._lock:
+            self.bytes[stage] += num_bytes
+
+    def publish(self) -> None:
+        """Record the totals so far and start counting from zero again."""
+        with self._lock:
+            for stage in STAGES:
+                if self.seconds[stage]:
+                    self._durations[stage].record(
+                        timedelta(seconds=self.seconds[stage])
+                    )
+                if self.bytes[stage]:
+                    self._counters[stage].add(self.bytes[stage])
+                self.seconds[stage] = 0.0
+                self.bytes[stage] = 0
+
+    def summary(self) -> str:
+        with self._lock:
+            return ", ".join(
+                f"{stage} {self.seconds[stage]:.2f}s/{self.bytes[stage]}B"
+                for stage in STAGES
+            )
+
+
+class TimedReader:
+    """Readable file object that counts reads as the download stage."""
+
+    def __init__(self, stream: IO[bytes], metrics: StageMetrics) -> None:
+        self.stream = stream
+        self.metrics = metrics
+
+    def read(self, size: int = -1) -> bytes:
+        with self.metrics.stage("download"):
+            data = self.stream.read(size)
+        self.metrics.add_bytes("download", len(data))
+        return data
+
+    def close(self) -> None:
+        self.stream.close()
+
+
+class TimedWriter:
+    """Writable file object that counts writes as the upload stage.
+
+    Wraps the writers of ``ExportStorage.open_write``, so ``abort()`` is
+    passed through as well. What the Parquet writer hands it is what it
+    encoded, so bytes written count towards both encode and upload.
+    """
+
+    def __init__(self, sink: IO[bytes], metrics: StageMetrics) -> None:
+        self.sink = sink
+        self.metrics = metrics
+
+    @property
+    def closed(self) -> bool:
+        return self.sink.closed
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.sink.tell()
+
+    def flush(self) -> None:
+        self.sink.flush()
+
+    def write(self, data: bytes) -> int:
+        with self.metrics.stage("upload"):
+            written = self.sink.write(data)
+        self.metrics.add_bytes("encode", len(data))
+        self.metrics.add_bytes("upload", len(data))
+        return written
+
+    def close(self) -> None:
+        with self.metrics.stage("upload"):
+            self.sink.close()
+
+    def abort(self) -> None:
+        self.sink.abort()  # type: ignore[attr-defined]
@@ -0,0 +1,100 @@
+from functools import lru_cache
+from typing import Dict, List, Tuple
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from temporalio.api.history.v1 import HistoryEvent
+
+EVENT_TYPE_COLUMN = "eventType"
+WORKFLOW_TYPE_PARTITION = "workflowType"
+WORKFLOW_TYPE_COLUMN = "workflowExecutionStartedEventAttributes_workflowType_name"
+# Projection path of the workflow type column, see proto_flatten.Projection
+WORKFLOW_TYPE_FIELD_PATH = "workflowExecutionStartedEventAttributes.workflowType.name"
+
+# Hive's name for the partition of rows whose partition value is null
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+@lru_cache(maxsize=None)
+def event_attribute_prefixes() -> Dict[str, str]:
+    """Map each event type name to the column prefix of its attributes.
+
+    Every field of the HistoryEvent ``attributes`` oneof is named after its
+    event type, e.g. ``activity_task_scheduled_event_attributes`` holds the
+    attributes of ``EVENT_TYPE_ACTIVITY_TASK_SCHEDULED``.
+    """
+    oneof = HistoryEvent.DESCRIPTOR.oneofs_by_name["attributes"]
+    return {
+        "EVENT_TYPE_" + field.name[: -len("_event_attributes")].upper(): field.json_name
+        for field in oneof.fields
+    }
+
+
+def _partition_value(value: object) -> str:
+    if value is None:
+        return DEFAULT_PARTITION
+    return quote(str(value), safe="")
+
+
+def _workflow_types(table: pa.Table) -> pa.Array:
+    """Workflow type of every row, taken from its run's started event."""
+    if WORKFLOW_TYPE_COLUMN not in table.column_names:
+        return pa.nulls(table.num_rows, pa.string())
+    started = table.filter(pc.is_valid(table[WORKFLOW_TYPE_COLUMN]))
+    index = pc.index_in(table["RunId"], value_set=started["RunId"])
+    return started[WORKFLOW_TYPE_COLUMN].take(index)
+
+
+def _narrow(table: pa.Table, event_type: object) -> pa.Table:
+    """Keep the common event columns plus those of one event type's attributes.
+
+    Attribute columns are sorted by name so every file in a partition lists
+    its columns in the same order regardless of which events came first.
+    """
+    prefixes = set(event_attribute_prefixes().values())
+    own_prefix = event_attribute_prefixes().get(str(event_type))
+    common = []
+    own = []
+    for name in table.column_names:
+        prefix = name.split("_", 1)[0]
+        if prefix not in prefixes:
+            common.append(name)
+        elif prefix == own_prefix:
+            own.append(name)
+    return table.select(common + sorted(own))
+
+
+def partition_table(
+    table: pa.Table, by_event_type: bool = True, by_workflow_type: bool = False
+) -> List[Tuple[str, pa.Table]]:
+    """Split flattened history rows into Hive-style partitions.
+
+    Returns ``(relative_path, table)`` pairs where the path looks like
+    ``eventType=EVENT_TYPE_TIMER_STARTED/workflowType=MyWorkflow``. As Hive
+    readers expect, partition values only appear in the path, not as columns.
+    Event type partitions keep just the columns that event type can have,
+    instead of the union of every event's attributes.
+    """
+    keys: Dict[str, pa.Array] = {}
+    if by_event_type:
+        keys[EVENT_TYPE_COLUMN] = table[EVENT_TYPE_COLUMN]
+    if by_workflow_type:
+        keys[WORKFLOW_TYPE_PARTITION] = _workflow_types(table)
+    if not keys:
+        return [("", table)]
+
+    rows = pa.table({**keys, "_row": pa.array(range(table.num_rows), pa.int64())})
+    # Without threads the row lists keep the input order
+    groups = rows.group_by(list(keys), use_threads=False).aggregate([("_row", "list")])
+    partitions = []
+    for group in groups.to_pylist():
+        partition = table.take(group["_row_list"])
+        if by_event_type:
+            partition = _narrow(partition, group[EVENT_TYPE_COLUMN]).drop_columns(
+                [EVENT_TYPE_COLUMN]
+            )
+        path = "/".join(f"{name}={_partition_value(group[name])}" for name in keys)
+        partitions.append((path, partition))
+    partitions.sort(key=lambda p: p[0])
+    return partitions
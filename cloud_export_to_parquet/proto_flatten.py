@@ -0,0 +1,403 @@
+import base64
+import math
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import pyarrow as pa
+import temporalio.api.export.v1 as export
+from google.protobuf.descriptor import Descriptor, FieldDescriptor
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.message import Message
+
+# Column names containing any of these are dropped, same as the pandas flattener
+SKIP_NAMES = ("payloads", ".")
+
+# Well-known types whose JSON form is produced by the protobuf runtime rather
+# than by walking their fields
+_TIME_TYPES = {"google.protobuf.Timestamp", "google.protobuf.Duration"}
+_JSON_TYPES = {
+    "google.protobuf.Any",
+    "google.protobuf.FieldMask",
+    "google.protobuf.Struct",
+    "google.protobuf.Value",
+    "google.protobuf.ListValue",
+    "google.protobuf.BoolValue",
+    "google.protobuf.BytesValue",
+    "google.protobuf.DoubleValue",
+    "google.protobuf.FloatValue",
+    "google.protobuf.Int32Value",
+    "google.protobuf.Int64Value",
+    "google.protobuf.StringValue",
+    "google.protobuf.UInt32Value",
+    "google.protobuf.UInt64Value",
+}
+
+# Messages holding user payloads, which only a codec can make sense of
+_PAYLOAD_TYPES = {
+    "temporal.api.common.v1.Header",
+    "temporal.api.common.v1.Memo",
+    "temporal.api.common.v1.Payload",
+    "temporal.api.common.v1.Payloads",
+}
+
+_INT64_TYPES = {
+    FieldDescriptor.TYPE_INT64,
+    FieldDescriptor.TYPE_SINT64,
+    FieldDescriptor.TYPE_SFIXED64,
+    FieldDescriptor.TYPE_UINT64,
+    FieldDescriptor.TYPE_FIXED64,
+}
+
+# How many executions are flattened between calls of a progress callback
+PROGRESS_INTERVAL = 1000
+
+# Field plan kinds
+_SCALAR = 0
+_MESSAGE = 1
+_MAP = 2
+_REPEATED = 3
+
+
+def _float_value(value: float) -> Any:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "Infinity" if value > 0 else "-Infinity"
+    return value
+
+
+def _scalar_converter(field: FieldDescriptor) -> Callable[[Any], Any]:
+    """Converter producing the same value MessageToJson would for a scalar."""
+    if field.type in _INT64_TYPES:
+        return str
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return lambda v: base64.b64encode(v).decode("utf-8")
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        assert field.enum_type is not None
+        values = field.enum_type.values_by_number
+        return lambda v: values[v].name if v in values else v
+    if field.type in (FieldDescriptor.TYPE_FLOAT, FieldDescriptor.TYPE_DOUBLE):
+        return _float_value
+    return lambda v: v
+
+
+def _message_converter(descriptor: Descriptor) -> Callable[[Message], Any]:
+    """Converter for well-known types that are leaves in the flattened output."""
+    if descriptor.full_name in _TIME_TYPES:
+        return lambda v: v.ToJsonString()  # type: ignore[attr-defined]
+    return MessageToDict
+
+
+def _is_repeated(field: FieldDescriptor) -> bool:
+    # Newer protobuf releases replace ``label`` with ``is_repeated``
+    is_repeated = getattr(field, "is_repeated", None)
+    if is_repeated is not None:
+        return is_repeated
+    return getattr(field, "label") == FieldDescriptor.LABEL_REPEATED
+
+
+def _is_leaf_message(descriptor: Descriptor) -> bool:
+    return descriptor.full_name in _TIME_TYPES or descriptor.full_name in _JSON_TYPES
+
+
+def _flatten_dict(prefix: str, value: Any, emit: Callable[[str, Any], None]) -> None:
+    """Flatten a JSON dict the way ``pd.json_normalize(sep="_")`` does."""
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _flatten_dict(f"{prefix}_{k}", v, emit)
+    else:
+        emit(prefix, value)
+
+
+@dataclass
+class Projection:
+    """Field paths to keep or drop while flattening.
+
+    Paths are dot-separated JSON field names below ``HistoryEvent``, such as
+    ``workflowExecutionStartedEventAttributes.memo``. Map keys are path
+    segments too. ``*`` matches any one segment and ``**`` any number of them,
+    so ``**.header`` is every header. A path selects a field and everything
+    under it. If ``include`` is empty every field is kept, otherwise only
+    included fields are. ``exclude`` wins over ``include``. With
+    ``exclude_payload_fields`` set, every field holding payloads is dropped:
+    inputs, results, failure details, headers, memos and search attributes.
+
+    Excluded subtrees are never walked, so their payloads are not base64
+    encoded or turned into columns. WorkflowId and RunId are always kept.
+    """
+
+    include: Sequence[str] = ()
+    exclude: Sequence[str] = ()
+    exclude_payload_fields: bool = False
+
+
+_Patterns = FrozenSet[Tuple[str, ...]]
+
+
+def _compile(paths: Sequence[str]) -> _Patterns:
+    return frozenset(tuple(path.split(".")) for path in paths)
+
+
+def _advance(patterns: _Patterns, segment: str) -> _Patterns:
+    """What is left of each pattern after matching one more path segment.
+
+    An empty remainder means the pattern matched the path so far in full.
+    """
+    advanced = set()
+    for pattern in patterns:
+        head = pattern[0]
+        if head == "**":
+            advanced.add(pattern)
+            rest = pattern[1:]
+            if not rest:
+                advanced.add(rest)
+            elif rest[0] == "*" or rest[0] == segment:
+                advanced.add(rest[1:])
+        elif head == "*" or head == segment:
+            advanced.add(pattern[1:])
+    return frozenset(advanced)
+
+
+class _Scope:
+    """Column name and projection state at one position of the proto walk.
+
+    Children are worked out once per field name or map key and cached, so
+    deciding whether to descend into a field is a dict lookup. ``complete``
+    means everything below is included unless excluded.
+    """
+
+    __slots__ = ("name", "complete", "_include", "_exclude", "_children")
+
+    def __init__(
+        self, name: str, complete: bool, include: _Patterns, exclude: _Patterns
+    ) -> None:
+        self.name = name
+        self.complete = complete
+        self._include = include
+        self._exclude = exclude
+        self._children: Dict[str, Optional[_Scope]] = {}
+
+    @classmethod
+    def root(cls, projection: Projection) -> "_Scope":
+        include = _compile(projection.include)
+        return cls("", not include, include, _compile(projection.exclude))
+
+    def child(self, segment: str) -> Optional["_Scope"]:
+        try:
+            return self._children[segment]
+        except KeyError:
+            child = self._make_child(segment)
+            self._children[segment] = child
+            return child
+
+    def _make_child(self, segment: str) -> Optional["_Scope"]:
+        name = f"{self.name}_{segment}" if self.name else segment
+        # Nothing under a skipped name can survive, so don't descend
+        if any(skip in name for skip in SKIP_NAMES):
+            return None
+        exclude = _advance(self._exclude, segment)
+        if () in exclude:
+            return None
+        if self.complete:
+            return _Scope(name, True, frozenset(), exclude)
+        include = _advance(self._include, segment)
+        if not include:
+            return None
+        return _Scope(name, () in include, include, exclude)
+
+
+class _FieldPlan:
+    """Precomputed handling of a single proto field, cached per descriptor."""
+
+    __slots__ = (
+        "kind",
+        "json_name",
+        "convert",
+        "leaf_message",
+        "message_values",
+        "payload",
+    )
+
+    def __init__(self, field: FieldDescriptor) -> None:
+        self.json_name = field.json_name
+        self.leaf_message = False
+        self.message_values = False
+        self.payload = False
+        message_type = field.message_type
+        if message_type is not None and message_type.GetOptions().map_entry:
+            self.kind = _MAP
+            value_field = message_type.fields_by_name["value"]
+            value_type = value_field.message_type
+            if value_type is None:
+                self.convert = _scalar_converter(value_field)
+            else:
+                self.message_values = True
+                self.payload = value_type.full_name in _PAYLOAD_TYPES
+                self.leaf_message = _is_leaf_message(value_type)
+                self.convert = _message_converter(value_type)
+        elif _is_repeated(field):
+            self.kind = _REPEATED
+            if message_type is None:
+                self.convert = _scalar_converter(field)
+            else:
+                self.payload = message_type.full_name in _PAYLOAD_TYPES
+                self.convert = _message_converter(message_type)
+        elif message_type is not None:
+            self.kind = _MESSAGE
+            self.payload = message_type.full_name in _PAYLOAD_TYPES
+            self.leaf_message = _is_leaf_message(message_type)
+            self.convert = _message_converter(message_type)
+        else:
+            self.kind = _SCALAR
+            self.convert = _scalar_converter(field)
+
+
+class ArrowFlattener:
+    """Walks export protos straight into per-column Arrow buffers.
+
+    This produces the same columns as :func:`convert_proto_to_parquet_flatten`
+    in ``data_trans_activities`` without the JSON round trip and per-event
+    DataFrames. Each column is a list pre-sized to the total number of events
+    and filled by row index, so building the table is one ``pa.array`` call
+    per column. An optional :class:`Projection` limits which fields are walked.
+    """
+
+    def __init__(self, projection: Optional[Projection] = None) -> None:
+        projection = projection or Projection()
+        self._plans: Dict[FieldDescriptor, _FieldPlan] = {}
+        self._root = _Scope.root(projection)
+        self._skip_payloads = projection.exclude_payload_fields
+
+    def _plan(self, field: FieldDescriptor) -> _FieldPlan:
+        plan = self._plans.get(field)
+        if plan is None:
+            plan = _FieldPlan(field)
+            self._plans[field] = plan
+        return plan
+
+    def flatten(
+        self,
+        wfs: export.WorkflowExecutions,
+        progress: Optional[Callable[[int], None]] = None,
+    ) -> pa.Table:
+        """Flatten every event of every workflow execution into one table."""
+        return self.flatten_executions(wfs.items, progress)
+
+    def flatten_executions(
+        self,
+        executions: Sequence[export.WorkflowExecution],
+        progress: Optional[Callable[[int], None]] = None,
+    ) -> pa.Table:
+        """Flatten every event of the given workflow executions into one table.
+
+        ``progress`` is called with the number of executions flattened so far
+        every :data:`PROGRESS_INTERVAL` executions, e.g. to heartbeat.
+        """
+        num_rows = sum(len(wf.history.events) for wf in executions)
+        columns: Dict[str, List[Any]] = {"WorkflowId": [None] * num_rows}
+        columns["RunId"] = [None] * num_rows
+        row = 0
+        for i, wf in enumerate(executions):
+            if progress is not None and i and i % PROGRESS_INTERVAL == 0:
+                progress(i)
+            events = wf.history.events
+            if not events:
+                continue
+            start_attributes = events[0].workflow_execution_started_event_attributes
+            workflow_id = start_attributes.workflow_id
+            run_id = start_attributes.original_execution_run_id
+            for event in events:
+                columns["WorkflowId"][row] = workflow_id
+                columns["RunId"][row] = run_id
+                self._walk(event, self._root, row, columns, num_rows)
+                row += 1
+        return pa.table({name: pa.array(values) for name, values in columns.items()})
+
+    def _emit(
+        self,
+        columns: Dict[str, List[Any]],
+        num_rows: int,
+        row: int,
+        name: str,
+        value: Any,
+    ) -> None:
+        buffer = columns.get(name)
+        if buffer is None:
+            buffer = [None] * num_rows
+            columns[name] = buffer
+        buffer[row] = value
+
+    def _walk(
+        self,
+        message: Message,
+        scope: _Scope,
+        row: int,
+        columns: Dict[str, List[Any]],
+        num_rows: int,
+    ) -> None:
+        for field, value in message.ListFields():
+            plan = self._plan(field)
+            if plan.payload and self._skip_payloads:
+                continue
+            child = scope.child(plan.json_name)
+            if child is None:
+                continue
+            if plan.kind == _SCALAR:
+                if child.complete:
+                    self._emit(columns, num_rows, row, child.name, plan.convert(value))
+            elif plan.kind == _MESSAGE:
+                if not plan.leaf_message:
+                    self._walk(value, child, row, columns, num_rows)
+                elif child.complete:
+                    self._emit_json(
+                        columns, num_rows, row, child.name, plan.convert(value)
+                    )
+            elif plan.kind == _REPEATED:
+                if child.complete:
+                    self._emit(
+                        columns,
+                        num_rows,
+                        row,
+                        child.name,
+                        [plan.convert(v) for v in value],
+                    )
+            else:
+                for key, item in value.items():
+                    item_scope = child.child(str(key))
+                    if item_scope is None:
+                        continue
+                    if plan.message_values and not plan.leaf_message:
+                        self._walk(item, item_scope, row, columns, num_rows)
+                    elif not item_scope.complete:
+                        continue
+                    elif plan.message_values:
+                        self._emit_json(
+                            columns, num_rows, row, item_scope.name, plan.convert(item)
+                        )
+                    else:
+                        self._emit(
+                            columns, num_rows, row, item_scope.name, plan.convert(item)
+                        )
+
+    def _emit_json(
+        self,
+        columns: Dict[str, List[Any]],
+        num_rows: int,
+        row: int,
+        name: str,
+        value: Any,
+    ) -> None:
+        def emit(name: str, value: Any) -> None:
+            if not any(skip in name for skip in SKIP_NAMES):
+                self._emit(columns, num_rows, row, name, value)
+
+        _flatten_dict(name, value, emit)
+
+
+def convert_proto_to_arrow_flatten(
+    wfs: export.WorkflowExecutions,
+    projection: Optional[Projection] = None,
+    progress: Optional[Callable[[int], None]] = None,
+) -> pa.Table:
+    """Function that flattens export protos into an Arrow table."""
+    return ArrowFlattener(projection).flatten(wfs, progress)
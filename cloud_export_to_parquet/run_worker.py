@@ -1,38 +1,183 @@
+import argparse
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
 
 from temporalio.client import Client
-from temporalio.worker import Worker
+from temporalio.runtime import PrometheusConfig, Runtime, TelemetryConfig
+from temporalio.worker import SharedStateManager, Worker
 from temporalio.worker.workflow_sandbox import (
     SandboxedWorkflowRunner,
     SandboxRestrictions,
 )
 
+from cloud_export_to_parquet.compaction_activities import (
+    commit_compaction,
+    compact_files,
+    plan_compaction,
+)
 from cloud_export_to_parquet.data_trans_activities import (
+    create_object_key_manifest,
     data_trans_and_land,
+    data_trans_and_land_batch,
+    data_trans_and_land_files,
     get_object_keys,
+    get_object_keys_batch,
+    get_objects,
+)
+from cloud_export_to_parquet.metrics import HISTOGRAM_BUCKET_OVERRIDES
+from cloud_export_to_parquet.s3_client import s3_client_provider
+from cloud_export_to_parquet.storage import (
+    ExportStorage,
+    LocalStorage,
+    S3Storage,
+    configure_storage,
 )
-from cloud_export_to_parquet.workflows import ProtoToParquet
+from cloud_export_to_parquet.workflows import CompactParquet, ProtoToParquet
+
+ACTIVITY_THREADS = 100
+CONVERSION_TASK_QUEUE = "DATA_TRANSFORMATION_CONVERSION_TASK_QUEUE"
+
 
+async def log_s3_client_stats(interval_seconds: float = 60) -> None:
+    """Periodically log how well the shared S3 client reuses connections."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        stats = s3_client_provider.stats()
+        logging.info(
+            "S3 clients created: %d, requests: %d, connections opened: %d, "
+            "connections reused: %d",
+            stats.clients_created,
+            stats.requests_sent,
+            stats.connections_opened,
+            stats.connections_reused,
+        )
+
+
+def conversion_executor(processes: int, storage: ExportStorage) -> ProcessPoolExecutor:
+    """Process pool to run conversion activities on.
+
+    Processes are spawned rather than forked, so they don't inherit the
+    worker's threads, and the storage the activities use is configured in
+    each of them.
+    """
+    return ProcessPoolExecutor(
+        processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=configure_storage,
+        initargs=(storage,),
+    )
 
-async def main() -> None:
+
+async def main(
+    conversion_processes: int,
+    storage: ExportStorage,
+    prometheus_port: Optional[int] = None,
+) -> None:
     """Main worker function."""
+    # Export SDK and activity metrics, such as the conversion stage and
+    # compaction metrics, for Prometheus the same way as prometheus/worker.py.
+    # Activities on the conversion process pool can't record metrics.
+    runtime = None
+    if prometheus_port is not None:
+        runtime = Runtime(
+            telemetry=TelemetryConfig(
+                metrics=PrometheusConfig(
+                    bind_address=f"127.0.0.1:{prometheus_port}",
+                    # Conversion stages and compactions take seconds to
+                    # minutes, past the default buckets
+                    histogram_bucket_overrides=HISTOGRAM_BUCKET_OVERRIDES,
+                )
+            )
+        )
     # Create client connected to server at the given address
-    client = await Client.connect("localhost:7233")
+    client = await Client.connect("localhost:7233", runtime=runtime)
+
+    configure_storage(storage)
+
+    # Every activity thread shares one S3 client, so give it a connection per
+    # thread
+    s3_client_provider.configure(max_pool_connections=ACTIVITY_THREADS)
+    stats_task = asyncio.create_task(log_s3_client_stats())
+
+    # Listing is I/O bound and always runs on threads. Conversion is CPU bound
+    # and holds the GIL, so it can optionally run on a process pool instead,
+    # on its own task queue so the two kinds of activity get separate
+    # executors. Start workflows with conversion_task_queue set to
+    # CONVERSION_TASK_QUEUE to use it.
+    conversion_activities: List[Callable[..., Any]] = [
+        data_trans_and_land,
+        data_trans_and_land_files,
+        data_trans_and_land_batch,
+    ]
+    activities: List[Callable[..., Any]] = [
+        get_object_keys,
+        get_objects,
+        create_object_key_manifest,
+        get_object_keys_batch,
+        plan_compaction,
+        compact_files,
+        commit_compaction,
+    ]
+    if not conversion_processes:
+        activities += conversion_activities
 
     # Run the worker
     worker: Worker = Worker(
         client,
         task_queue="DATA_TRANSFORMATION_TASK_QUEUE",
-        workflows=[ProtoToParquet],
-        activities=[get_object_keys, data_trans_and_land],
+        workflows=[ProtoToParquet, CompactParquet],
+        activities=activities,
         workflow_runner=SandboxedWorkflowRunner(
             restrictions=SandboxRestrictions.default.with_passthrough_modules("boto3")
         ),
-        activity_executor=ThreadPoolExecutor(100),
+        activity_executor=ThreadPoolExecutor(ACTIVITY_THREADS),
     )
-    await worker.run()
+    workers = [worker]
+    if conversion_processes:
+        workers.append(
+            Worker(
+                client,
+                task_queue=CONVERSION_TASK_QUEUE,
+                activities=conversion_activities,
+                activity_executor=conversion_executor(conversion_processes, storage),
+                # Heartbeats and cancellation are shared with the activity
+                # processes through a multiprocessing manager, the same as
+                # hello/hello_activity_multiprocess.py
+                shared_state_manager=SharedStateManager.create_from_multiprocessing(
+                    multiprocessing.Manager()
+                ),
+                max_concurrent_activities=conversion_processes,
+            )
+        )
+    try:
+        await asyncio.gather(*(w.run() for w in workers))
+    finally:
+        stats_task.cancel()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--conversion-processes",
+        type=int,
+        default=0,
+        help="Convert files on a process pool of this size instead of on threads",
+    )
+    parser.add_argument(
+        "--local-storage",
+        metavar="DIR",
+        help="Read and write buckets as subdirectories of this directory "
+        "instead of S3",
+    )
+    parser.add_argument(
+        "--prometheus-port",
+        type=int,
+        help="Serve metrics for Prometheus on this port",
+    )
+    args = parser.parse_args()
+    storage = LocalStorage(args.local_storage) if args.local_storage else S3Storage()
+    asyncio.run(main(args.conversion_processes, storage, args.prometheus_port))
@@ -0,0 +1,105 @@
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import boto3
+from botocore.config import Config
+
+# One connection per activity thread, matching the executor in run_worker.py
+DEFAULT_MAX_POOL_CONNECTIONS = 100
+
+
+@dataclass
+class S3ClientStats:
+    clients_created: int
+    requests_sent: int
+    connections_opened: int
+
+    @property
+    def connections_reused(self) -> int:
+        """Requests that were sent over an already open connection."""
+        return max(0, self.requests_sent - self.connections_opened)
+
+
+class S3ClientProvider:
+    """Process-wide S3 client shared by every activity thread.
+
+    boto3 clients are thread-safe once built, but building one resolves
+    credentials and endpoints and each new client starts with an empty
+    connection pool. Sharing a single client whose pool is as large as the
+    activity executor means files after the first only pay for the transfer.
+    Creating clients is not thread-safe, so it happens under a lock, and a
+    client inherited across a fork is replaced since its sockets can't be
+    shared with the parent.
+    """
+
+    def __init__(
+        self, max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS
+    ) -> None:
+        self.max_pool_connections = max_pool_connections
+        self._lock = threading.Lock()
+        self._client: Optional[Any] = None
+        self._pid: Optional[int] = None
+        self._clients_created = 0
+        self._requests_sent = 0
+
+    def configure(self, max_pool_connections: int) -> None:
+        """Set the pool size, replacing the client if one was already built."""
+        with self._lock:
+            self.max_pool_connections = max_pool_connections
+            self._client = None
+
+    def get(self) -> Any:
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self._create()
+                self._pid = os.getpid()
+            return self._client
+
+    def _create(self) -> Any:
+        client = boto3.session.Session().client(
+            "s3",
+            config=Config(
+                max_pool_connections=self.max_pool_connections,
+                tcp_keepalive=True,
+                retries={"mode": "standard"},
+            ),
+        )
+        client.meta.events.register("before-send.s3", self._on_send)
+        self._clients_created += 1
+        return client
+
+    def _on_send(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._requests_sent += 1
+
+    def _connections_opened(self) -> int:
+        # urllib3 counts new connections per host pool. botocore doesn't expose
+        # its pool manager, so this reaches in and reports 0 if that changes.
+        try:
+            pools = self._client._endpoint.http_session._manager.pools  # type: ignore[union-attr]
+            return sum(
+                pools[key].num_connections for key in pools.keys() if key in pools
+            )
+        except (AttributeError, KeyError):
+            return 0
+
+    def stats(self) -> S3ClientStats:
+        with self._lock:
+            return S3ClientStats(
+                clients_created=self._clients_created,
+                requests_sent=self._requests_sent,
+                connections_opened=self._connections_opened(),
+            )
+
+
+s3_client_provider = S3ClientProvider()
+
+
+def get_s3_client() -> Any:
+    """Return the shared S3 client for this process."""
+    return s3_client_provider.get()
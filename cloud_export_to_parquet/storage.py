@@ -0,0 +1,277 @@
+import os
+import posixpath
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import IO, Iterator, List
+
+from botocore.exceptions import ClientError
+
+from cloud_export_to_parquet.s3_client import get_s3_client
+from cloud_export_to_parquet.streaming import S3MultipartWriter
+
+# Same page size as list_objects_v2
+LIST_PAGE_SIZE = 1000
+
+# Suffix of files LocalStorage is still writing, which listing leaves out
+PARTIAL_SUFFIX = ".partial"
+
+
+@dataclass
+class StoredObject:
+    key: str
+    etag: str
+    size: int
+
+
+class ExportStorage(ABC):
+    """Object store the export pipeline reads from and writes to.
+
+    Buckets and keys follow S3 semantics: a prefix is a plain string prefix of
+    the key, not a directory. Writers returned by ``open_write`` are file
+    objects with an extra ``abort()`` that discards what was written, and
+    nothing is visible under the key until ``close()``.
+    """
+
+    @abstractmethod
+    def iter_pages(self, bucket: str, prefix: str) -> Iterator[List[StoredObject]]:
+        """Yield the objects under a prefix in key order, a page at a time."""
+
+    @abstractmethod
+    def open_read(self, bucket: str, key: str, start: int = 0) -> IO[bytes]:
+        """Open an object for streaming reads from byte ``start`` on."""
+
+    @abstractmethod
+    def read_range(self, bucket: str, key: str, start: int, end: int) -> bytes:
+        """Read bytes ``start`` up to but not including ``end`` of an object."""
+
+    @abstractmethod
+    def open_write(self, bucket: str, key: str) -> IO[bytes]:
+        """Open an object for streaming writes."""
+
+    @abstractmethod
+    def etag(self, bucket: str, key: str) -> str:
+        """Return a value that changes whenever the object is rewritten."""
+
+    @abstractmethod
+    def delete(self, bucket: str, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def exists(self, bucket: str, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def move(self, bucket: str, source_key: str, key: str) -> None:
+        """Move an object within a bucket, replacing whatever is at ``key``.
+
+        The object appears under ``key`` all at once, but both keys may exist
+        for a moment before the source is removed.
+        """
+
+    def read(self, bucket: str, key: str) -> bytes:
+        body = self.open_read(bucket, key)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def write(self, bucket: str, key: str, data: bytes) -> None:
+        writer = self.open_write(bucket, key)
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()  # type: ignore[attr-defined]
+            raise
+        writer.close()
+
+
+class S3Storage(ExportStorage):
+    """Storage on S3 through the shared client of s3_client.py."""
+
+    def iter_pages(self, bucket: str, prefix: str) -> Iterator[List[StoredObject]]:
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            yield [
+                StoredObject(obj["Key"], obj["ETag"].strip('"'), obj["Size"])
+                for obj in page.get("Contents", [])
+            ]
+
+    def open_read(self, bucket: str, key: str, start: int = 0) -> IO[bytes]:
+        if start:
+            return get_s3_client().get_object(
+                Bucket=bucket, Key=key, Range=f"bytes={start}-"
+            )["Body"]
+        return get_s3_client().get_object(Bucket=bucket, Key=key)["Body"]
+
+    def read_range(self, bucket: str, key: str, start: int, end: int) -> bytes:
+        if end <= start:
+            return b""
+        return (
+            get_s3_client()
+            .get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}")[
+                "Body"
+            ]
+            .read()
+        )
+
+    def open_write(self, bucket: str, key: str) -> IO[bytes]:
+        return S3MultipartWriter(get_s3_client(), bucket, key)  # type: ignore[return-value]
+
+    def etag(self, bucket: str, key: str) -> str:
+        return get_s3_client().head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+
+    def delete(self, bucket: str, key: str) -> None:
+        get_s3_client().delete_object(Bucket=bucket, Key=key)
+
+    def exists(self, bucket: str, key: str) -> bool:
+        try:
+            get_s3_client().head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    def move(self, bucket: str, source_key: str, key: str) -> None:
+        # S3 has no rename. The managed copy switches to a multipart copy for
+        # objects over the 5 GB limit of a single CopyObject.
+        s3 = get_s3_client()
+        s3.copy({"Bucket": bucket, "Key": source_key}, bucket, key)
+        s3.delete_object(Bucket=bucket, Key=source_key)
+
+    def write(self, bucket: str, key: str, data: bytes) -> None:
+        get_s3_client().put_object(Bucket=bucket, Key=key, Body=data)
+
+
+class _AtomicFileWriter:
+    """Write to a temporary file next to ``path`` and move it into place on
+    close, so readers never see a partial object."""
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._temp_path = f"{path}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}"
+        self._file = open(self._temp_path, "wb")
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def write(self, data: bytes) -> int:
+        return self._file.write(data)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        try:
+            self._file.close()
+            os.replace(self._temp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+class LocalStorage(ExportStorage):
+    """Storage in a local directory, with each bucket a subdirectory of root.
+
+    Meant for running and benchmarking the pipeline offline. ETags are derived
+    from the file's size and modification time rather than its contents, which
+    is enough to tell a rewritten file apart without hashing it on every
+    listing.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+
+    def path(self, bucket: str, key: str) -> str:
+        bucket_root = os.path.join(self.root, bucket)
+        path = os.path.normpath(os.path.join(bucket_root, *key.split("/")))
+        if not path.startswith(bucket_root + os.sep):
+            raise ValueError(f"Key {key!r} is outside of bucket {bucket!r}")
+        return path
+
+    @staticmethod
+    def _etag(stat: os.stat_result) -> str:
+        return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+    def _iter_objects(self, bucket: str, prefix: str) -> Iterator[StoredObject]:
+        bucket_root = os.path.join(self.root, bucket)
+        # Only walk the deepest directory the prefix is known to be under
+        start = os.path.join(bucket_root, *posixpath.dirname(prefix).split("/"))
+        for directory, dirs, files in os.walk(start):
+            dirs.sort()
+            relative = os.path.relpath(directory, bucket_root).replace(os.sep, "/")
+            for name in files:
+                if name.endswith(PARTIAL_SUFFIX):
+                    continue
+                key = name if relative == "." else f"{relative}/{name}"
+                if key.startswith(prefix):
+                    stat = os.stat(os.path.join(directory, name))
+                    yield StoredObject(key, self._etag(stat), stat.st_size)
+
+    def iter_pages(self, bucket: str, prefix: str) -> Iterator[List[StoredObject]]:
+        objects = sorted(self._iter_objects(bucket, prefix), key=lambda o: o.key)
+        for start in range(0, len(objects), LIST_PAGE_SIZE):
+            yield objects[start : start + LIST_PAGE_SIZE]
+
+    def open_read(self, bucket: str, key: str, start: int = 0) -> IO[bytes]:
+        f = open(self.path(bucket, key), "rb")
+        f.seek(start)
+        return f
+
+    def read_range(self, bucket: str, key: str, start: int, end: int) -> bytes:
+        with open(self.path(bucket, key), "rb") as f:
+            f.seek(start)
+            return f.read(max(0, end - start))
+
+    def open_write(self, bucket: str, key: str) -> IO[bytes]:
+        return _AtomicFileWriter(self.path(bucket, key))  # type: ignore[return-value]
+
+    def etag(self, bucket: str, key: str) -> str:
+        return self._etag(os.stat(self.path(bucket, key)))
+
+    def delete(self, bucket: str, key: str) -> None:
+        try:
+            os.remove(self.path(bucket, key))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, bucket: str, key: str) -> bool:
+        return os.path.isfile(self.path(bucket, key))
+
+    def move(self, bucket: str, source_key: str, key: str) -> None:
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path(bucket, source_key), path)
+
+
+_storage: ExportStorage = S3Storage()
+
+
+def configure_storage(storage: ExportStorage) -> None:
+    """Set the storage used by the activities in this process.
+
+    Also usable as the initializer of a process pool, since both storages are
+    picklable.
+    """
+    global _storage
+    _storage = storage
+
+
+def get_storage() -> ExportStorage:
+    return _storage
@@ -0,0 +1,376 @@
+from collections import OrderedDict
+from functools import partial
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import temporalio.api.export.v1 as export
+from temporalio.common import MetricMeter
+
+from cloud_export_to_parquet.history_schema import SchemaFlattener
+from cloud_export_to_parquet.metrics import StageMetrics
+from cloud_export_to_parquet.proto_flatten import ArrowFlattener, Projection
+
+# S3 requires every part but the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# WorkflowExecutions.items is field 1 with the length-delimited wire type
+_ITEMS_FIELD = 1
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LENGTH_DELIMITED = 2
+_WIRE_FIXED32 = 5
+
+
+def _read_varint(stream: IO[bytes]) -> Optional[int]:
+    """Read a base 128 varint, returning None at a clean end of stream."""
+    result = 0
+    shift = 0
+    while True:
+        b = stream.read(1)
+        if not b:
+            if shift == 0:
+                return None
+            raise EOFError("Truncated varint in export file")
+        result |= (b[0] & 0x7F) << shift
+        if not b[0] & 0x80:
+            return result
+        shift += 7
+
+
+def _read_exactly(stream: IO[bytes], size: int) -> bytes:
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            raise EOFError("Truncated record in export file")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def iter_workflow_executions(
+    stream: IO[bytes],
+) -> Iterator[export.WorkflowExecution]:
+    """Decode the items of a serialized WorkflowExecutions one at a time.
+
+    The export file is a single WorkflowExecutions message, which on the wire
+    is just a run of length-delimited ``items`` fields. Reading them one by
+    one means only one workflow execution is ever held in memory.
+    """
+    while True:
+        tag = _read_varint(stream)
+        if tag is None:
+            return
+        field_number, wire_type = tag >> 3, tag & 0x7
+        if wire_type == _WIRE_LENGTH_DELIMITED:
+            size = _read_varint(stream)
+            if size is None:
+                raise EOFError("Truncated record in export file")
+            data = _read_exactly(stream, size)
+            if field_number == _ITEMS_FIELD:
+                yield export.WorkflowExecution.FromString(data)
+        elif wire_type == _WIRE_VARINT:
+            _read_varint(stream)
+        elif wire_type == _WIRE_FIXED64:
+            _read_exactly(stream, 8)
+        elif wire_type == _WIRE_FIXED32:
+            _read_exactly(stream, 4)
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type} in export file")
+
+
+class _CountingReader:
+    def __init__(self, stream: IO[bytes]) -> None:
+        self.stream = stream
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.position += len(data)
+        return data
+
+
+def iter_workflow_executions_with_offsets(
+    stream: IO[bytes],
+) -> Iterator[Tuple[export.WorkflowExecution, int]]:
+    """Like :func:`iter_workflow_executions`, also yielding the number of
+    bytes read from the stream up to the end of each execution.
+
+    Every execution starts at a field boundary, so decoding can later resume
+    from any of these offsets.
+    """
+    counting = _CountingReader(stream)
+    for wf in iter_workflow_executions(counting):  # type: ignore[arg-type]
+        yield wf, counting.position
+
+
+class S3MultipartWriter:
+    """Write-only file object that uploads to S3 in multipart chunks.
+
+    Data is buffered until ``part_size`` bytes are available and then sent as
+    one part, so memory use is bounded by the part size no matter how large
+    the object gets. Objects smaller than one part are sent with a single
+    ``put_object`` on close.
+    """
+
+    def __init__(
+        self, s3: Any, bucket: str, key: str, part_size: int = 8 * 1024 * 1024
+    ) -> None:
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.closed = False
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id: Optional[str] = None
+        self._parts: List[dict] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed writer")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def _upload_part(self, body: bytes) -> None:
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer)
+                )
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts},
+                )
+        except BaseException:
+            # Uploaded parts are stored, and billed, until the upload is
+            # aborted, and nothing else would abort a closed writer's upload
+            self.abort()
+            raise
+        self.closed = True
+        self._buffer = bytearray()
+
+    def abort(self) -> None:
+        """Discard everything written, including parts already uploaded."""
+        self.closed = True
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+
+
+def _conform(table: pa.Table, schema: pa.Schema) -> Optional[pa.Table]:
+    """Reshape a row group to an open file's schema, or None if it can't fit."""
+    # Always the case with a fixed schema, which has over a thousand columns
+    if table.schema.equals(schema):
+        return table
+    indexes = {name: i for i, name in enumerate(table.column_names)}
+    if not indexes.keys() <= set(schema.names):
+        return None
+    columns = [
+        (
+            table.column(indexes[field.name])
+            if field.name in indexes
+            else pa.nulls(table.num_rows, field.type)
+        )
+        for field in schema
+    ]
+    try:
+        return pa.Table.from_arrays(columns, names=schema.names).cast(schema)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return None
+
+
+class RollingParquetWriter:
+    """Writes row groups to a Parquet file, starting a new file on new columns.
+
+    Parquet files have a single schema, so when a row group brings columns the
+    open file doesn't have, that file is finished and a new one is opened
+    through ``open_sink(index)`` with the widened schema.
+    """
+
+    def __init__(self, open_sink: Callable[[int], IO[bytes]]) -> None:
+        self.open_sink = open_sink
+        self.num_files = 0
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._sink: Optional[IO[bytes]] = None
+
+    def write(self, table: pa.Table) -> None:
+        conformed = _conform(table, self._writer.schema) if self._writer else None
+        if conformed is None:
+            schema = table.schema
+            if self._writer is not None:
+                try:
+                    schema = pa.unify_schemas([self._writer.schema, table.schema])
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    pass
+                self.close()
+            self._sink = self.open_sink(self.num_files)
+            self.num_files += 1
+            self._writer = pq.ParquetWriter(self._sink, schema, compression="snappy")
+            conformed = _conform(table, schema)
+            if conformed is None:
+                raise ValueError("Row group does not match its own schema")
+        assert self._writer is not None
+        self._writer.write_table(conformed, row_group_size=conformed.num_rows)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()  # type: ignore[union-attr]
+            self._writer = None
+            self._sink = None
+
+    def abort(self) -> None:
+        abort = getattr(self._sink, "abort", None)
+        if abort is not None and not getattr(self._sink, "closed", True):
+            abort()
+        self._writer = None
+        self._sink = None
+
+
+def write_parquet_stream(
+    executions: Iterator[export.WorkflowExecution],
+    open_sink: Callable[[str, int], IO[bytes]],
+    row_group_size: int,
+    on_row_group: Optional[Callable[[int], None]] = None,
+    partition: Optional[Callable[[pa.Table], List[Tuple[str, pa.Table]]]] = None,
+    projection: Optional[Projection] = None,
+    checkpoint_row_groups: int = 0,
+    on_checkpoint: Optional[Callable[[int], None]] = None,
+    fixed_schema: bool = False,
+    metrics: Optional[StageMetrics] = None,
+    max_open_files: int = 0,
+) -> int:
+    """Flatten executions into Parquet row groups as they are decoded.
+
+    Executions are buffered until they hold at least ``row_group_size`` events
+    and then flattened and written as one row group. If ``partition`` is given
+    it splits each row group into ``(path, table)`` pairs and every path gets
+    its own writer, otherwise everything goes to path ``""``. Sinks are opened
+    with ``open_sink(path, index)``, see :class:`RollingParquetWriter`. After
+    each row group, ``on_row_group`` is called with the number of executions
+    written so far. ``projection`` limits the fields flattened, and with
+    ``fixed_schema`` every row group has the schema of
+    :class:`history_schema.HistorySchema`, so a partition only ever gets one
+    file. Flattening and encoding are timed as stages of ``metrics``.
+
+    Every open file holds an upload buffer, so with ``max_open_files`` set,
+    writing to a path beyond that many open files first finishes the file of
+    the path written least recently. Its later rows go to a new file, so
+    memory is bounded however many partitions there are.
+
+    With ``checkpoint_row_groups`` set, every open file is finished after that
+    many row groups and ``on_checkpoint`` is called with the number of
+    executions written. Everything written up to that point is then durable,
+    and the next row group starts new files, opened with index 0 again.
+    Returns the number of files written.
+    """
+    flattener = (
+        SchemaFlattener(projection) if fixed_schema else ArrowFlattener(projection)
+    )
+    metrics = metrics or StageMetrics(MetricMeter.noop)
+    writers: Dict[str, RollingParquetWriter] = {}
+    # Paths with an open file, least recently written first
+    open_paths: "OrderedDict[str, None]" = OrderedDict()
+    pending: List[export.WorkflowExecution] = []
+    pending_events = 0
+    executions_written = 0
+    row_groups = 0
+    files_written = 0
+
+    def checkpoint() -> None:
+        nonlocal files_written
+        with metrics.stage("encode"):
+            for writer in writers.values():
+                writer.close()
+                files_written += writer.num_files
+        writers.clear()
+        open_paths.clear()
+        if on_checkpoint is not None:
+            on_checkpoint(executions_written)
+
+    def write_row_group() -> None:
+        nonlocal executions_written, row_groups
+        with metrics.stage("flatten"):
+            table = flattener.flatten_executions(pending)
+            parts = partition(table) if partition else [("", table)]
+        metrics.add_bytes("flatten", table.nbytes)
+        with metrics.stage("encode"):
+            for path, part in parts:
+                if (
+                    max_open_files
+                    and path not in open_paths
+                    and len(open_paths) >= max_open_files
+                ):
+                    writers[open_paths.popitem(last=False)[0]].close()
+                writer = writers.get(path)
+                if writer is None:
+                    writer = RollingParquetWriter(partial(open_sink, path))
+                    writers[path] = writer
+                writer.write(part)
+                open_paths[path] = None
+                open_paths.move_to_end(path)
+        executions_written += len(pending)
+        row_groups += 1
+        if on_row_group is not None:
+            on_row_group(executions_written)
+        if checkpoint_row_groups and row_groups % checkpoint_row_groups == 0:
+            checkpoint()
+
+    try:
+        for wf in executions:
+            pending.append(wf)
+            pending_events += len(wf.history.events)
+            if pending_events >= row_group_size:
+                write_row_group()
+                pending.clear()
+                pending_events = 0
+        if pending_events or not (writers or files_written):
+            write_row_group()
+        with metrics.stage("encode"):
+            for writer in writers.values():
+                writer.close()
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    return files_written + sum(writer.num_files for writer in writers.values())
@@ -0,0 +1,281 @@
+import argparse
+import json
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+import temporalio.api.export.v1 as export
+from temporalio.api.common.v1 import (
+    ActivityType,
+    Header,
+    Memo,
+    Payload,
+    Payloads,
+    RetryPolicy,
+    SearchAttributes,
+    WorkflowType,
+)
+from temporalio.api.enums.v1 import EventType, TaskQueueKind
+from temporalio.api.history.v1 import (
+    ActivityTaskCompletedEventAttributes,
+    ActivityTaskScheduledEventAttributes,
+    ActivityTaskStartedEventAttributes,
+    History,
+    HistoryEvent,
+    WorkflowExecutionCompletedEventAttributes,
+    WorkflowExecutionStartedEventAttributes,
+    WorkflowTaskCompletedEventAttributes,
+    WorkflowTaskScheduledEventAttributes,
+    WorkflowTaskStartedEventAttributes,
+)
+from temporalio.api.taskqueue.v1 import TaskQueue
+
+from cloud_export_to_parquet.storage import ExportStorage, LocalStorage
+
+SYNTHETIC_START_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _json_payload(value: object) -> Payload:
+    return Payload(
+        metadata={"encoding": b"json/plain"}, data=json.dumps(value).encode()
+    )
+
+
+def _payloads(rand: random.Random, payload_size: int) -> Payloads:
+    blob = "".join(rand.choices("abcdefghijklmnopqrstuvwxyz", k=payload_size))
+    return Payloads(
+        payloads=[_json_payload({"id": rand.randint(0, 1 << 30), "blob": blob})]
+    )
+
+
+def make_workflow_execution(
+    rand: random.Random,
+    start_time: datetime,
+    activities_per_workflow: int = 5,
+    payload_size: int = 256,
+    memo_size: int = 0,
+) -> export.WorkflowExecution:
+    """Build one completed workflow history that schedules activities in turn.
+
+    ``memo_size`` adds a memo field holding that many bytes of JSON, like a
+    workflow that keeps its own notes in the memo.
+    """
+    workflow_id = f"synthetic-{uuid.UUID(int=rand.getrandbits(128))}"
+    run_id = str(uuid.UUID(int=rand.getrandbits(128)))
+    task_queue = TaskQueue(
+        name="synthetic-task-queue", kind=TaskQueueKind.TASK_QUEUE_KIND_NORMAL
+    )
+    events: List[HistoryEvent] = []
+    now = start_time
+
+    def add(event_type: int, **attributes: object) -> int:
+        nonlocal now
+        now += timedelta(milliseconds=rand.randint(1, 50))
+        event = HistoryEvent(
+            event_id=len(events) + 1,
+            event_type=event_type,  # type: ignore[arg-type]
+            version=0,
+            task_id=rand.randint(1 << 20, 1 << 30),
+            **attributes,  # type: ignore[arg-type]
+        )
+        event.event_time.FromDatetime(now)
+        events.append(event)
+        return event.event_id
+
+    started = WorkflowExecutionStartedEventAttributes(
+        workflow_type=WorkflowType(name="SyntheticWorkflow"),
+        task_queue=task_queue,
+        input=_payloads(rand, payload_size),
+        original_execution_run_id=run_id,
+        first_execution_run_id=run_id,
+        identity="synthetic@worker",
+        attempt=1,
+        workflow_id=workflow_id,
+        memo=Memo(fields={"owner": _json_payload("data-team")}),
+        search_attributes=SearchAttributes(
+            indexed_fields={"CustomKeywordField": _json_payload("synthetic")}
+        ),
+        header=Header(fields={"trace": _json_payload({"span": rand.getrandbits(64)})}),
+    )
+    if memo_size:
+        started.memo.fields["notes"].CopyFrom(_payloads(rand, memo_size).payloads[0])
+    started.workflow_task_timeout.FromSeconds(10)
+    add(
+        EventType.EVENT_TYPE_WORKFLOW_EXECUTION_STARTED,
+        workflow_execution_started_event_attributes=started,
+    )
+
+    def workflow_task() -> int:
+        scheduled = add(
+            EventType.EVENT_TYPE_WORKFLOW_TASK_SCHEDULED,
+            workflow_task_scheduled_event_attributes=WorkflowTaskScheduledEventAttributes(
+                task_queue=task_queue, attempt=1
+            ),
+        )
+        started_id = add(
+            EventType.EVENT_TYPE_WORKFLOW_TASK_STARTED,
+            workflow_task_started_event_attributes=WorkflowTaskStartedEventAttributes(
+                scheduled_event_id=scheduled,
+                identity="synthetic@worker",
+                request_id=str(uuid.UUID(int=rand.getrandbits(128))),
+            ),
+        )
+        return add(
+            EventType.EVENT_TYPE_WORKFLOW_TASK_COMPLETED,
+            workflow_task_completed_event_attributes=WorkflowTaskCompletedEventAttributes(
+                scheduled_event_id=scheduled,
+                started_event_id=started_id,
+                identity="synthetic@worker",
+            ),
+        )
+
+    completed_task = workflow_task()
+    for i in range(activities_per_workflow):
+        scheduled_activity = ActivityTaskScheduledEventAttributes(
+            activity_id=str(i + 1),
+            activity_type=ActivityType(name=f"synthetic_activity_{i % 3}"),
+            task_queue=task_queue,
+            input=_payloads(rand, payload_size),
+            workflow_task_completed_event_id=completed_task,
+            retry_policy=RetryPolicy(maximum_attempts=10, backoff_coefficient=2.0),
+        )
+        scheduled_activity.start_to_close_timeout.FromSeconds(60)
+        scheduled = add(
+            EventType.EVENT_TYPE_ACTIVITY_TASK_SCHEDULED,
+            activity_task_scheduled_event_attributes=scheduled_activity,
+        )
+        started_id = add(
+            EventType.EVENT_TYPE_ACTIVITY_TASK_STARTED,
+            activity_task_started_event_attributes=ActivityTaskStartedEventAttributes(
+                scheduled_event_id=scheduled,
+                identity="synthetic@worker",
+                request_id=str(uuid.UUID(int=rand.getrandbits(128))),
+                attempt=1,
+            ),
+        )
+        add(
+            EventType.EVENT_TYPE_ACTIVITY_TASK_COMPLETED,
+            activity_task_completed_event_attributes=ActivityTaskCompletedEventAttributes(
+                result=_payloads(rand, payload_size),
+                scheduled_event_id=scheduled,
+                started_event_id=started_id,
+                identity="synthetic@worker",
+            ),
+        )
+        completed_task = workflow_task()
+
+    add(
+        EventType.EVENT_TYPE_WORKFLOW_EXECUTION_COMPLETED,
+        workflow_execution_completed_event_attributes=WorkflowExecutionCompletedEventAttributes(
+            result=_payloads(rand, payload_size),
+            workflow_task_completed_event_id=completed_task,
+        ),
+    )
+    return export.WorkflowExecution(history=History(events=events))
+
+
+def make_workflow_executions(
+    num_workflows: int,
+    activities_per_workflow: int = 5,
+    payload_size: int = 256,
+    seed: int = 0,
+    memo_size: int = 0,
+) -> export.WorkflowExecutions:
+    """Build a synthetic export file body with the given number of histories."""
+    rand = random.Random(seed)
+    return export.WorkflowExecutions(
+        items=[
+            make_workflow_execution(
+                rand,
+                SYNTHETIC_START_TIME + timedelta(seconds=i),
+                activities_per_workflow,
+                payload_size,
+                memo_size,
+            )
+            for i in range(num_workflows)
+        ]
+    )
+
+
+def make_workflow_executions_of_size(
+    target_bytes: int,
+    activities_per_workflow: int = 5,
+    payload_size: int = 256,
+    seed: int = 0,
+) -> export.WorkflowExecutions:
+    """Build a synthetic export file body of about ``target_bytes`` bytes.
+
+    Histories are added until the serialized size reaches the target, so the
+    file overshoots it by less than one history.
+    """
+    rand = random.Random(seed)
+    wfs = export.WorkflowExecutions()
+    size = 0
+    while size < target_bytes:
+        item = make_workflow_execution(
+            rand,
+            SYNTHETIC_START_TIME + timedelta(seconds=len(wfs.items)),
+            activities_per_workflow,
+            payload_size,
+        )
+        wfs.items.append(item)
+        # Field tag plus length prefix, which is at most 5 bytes here
+        size += item.ByteSize() + 6
+    return wfs
+
+
+def write_synthetic_export(
+    storage: ExportStorage,
+    bucket: str,
+    prefix: str,
+    num_files: int,
+    file_size: int,
+    activities_per_workflow: int = 5,
+    payload_size: int = 256,
+    seed: int = 0,
+) -> List[str]:
+    """Write ``num_files`` synthetic export files under a prefix.
+
+    Every file gets its own seed, so files hold different workflows but the
+    same arguments always produce the same files.
+    """
+    keys = []
+    for i in range(num_files):
+        key = f"{prefix}/synthetic-{i:06}.proto"
+        wfs = make_workflow_executions_of_size(
+            file_size, activities_per_workflow, payload_size, seed=seed + i
+        )
+        storage.write(bucket, key, wfs.SerializeToString())
+        keys.append(key)
+    return keys
+
+
+def main() -> None:
+    """Write synthetic export files into a local storage directory."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--root", required=True, help="Local storage directory")
+    parser.add_argument("--bucket", default="export-bucket")
+    parser.add_argument("--prefix", required=True)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--file-size-mb", type=float, default=10)
+    parser.add_argument("--activities", type=int, default=5)
+    parser.add_argument("--payload-size", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    keys = write_synthetic_export(
+        LocalStorage(args.root),
+        args.bucket,
+        args.prefix.rstrip("/"),
+        args.files,
+        int(args.file_size_mb * 1024 * 1024),
+        args.activities,
+        args.payload_size,
+        args.seed,
+    )
+    print(f"Wrote {len(keys)} files to {args.root}/{args.bucket}/{args.prefix}")
+
+
+if __name__ == "__main__":
+    main()
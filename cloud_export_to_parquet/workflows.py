@@ -1,17 +1,48 @@
+import asyncio
 from datetime import timedelta
+from typing import Dict, List, Optional
 
 from temporalio import workflow
 from temporalio.common import RetryPolicy
-from temporalio.exceptions import ActivityError
+from temporalio.exceptions import ActivityError, ApplicationError
 
 with workflow.unsafe.imports_passed_through():
+    from cloud_export_to_parquet.compaction_activities import (
+        DEFAULT_ROW_GROUP_SIZE_BYTES,
+        DEFAULT_TARGET_FILE_SIZE,
+        CompactFilesActivityInput,
+        CompactionGroup,
+        PlanCompactionActivityInput,
+        commit_compaction,
+        compact_files,
+        plan_compaction,
+    )
     from cloud_export_to_parquet.data_trans_activities import (
+        CreateObjectKeyManifestActivityInput,
         DataTransAndLandActivityInput,
-        data_trans_and_land,
-        get_object_keys,
+        DataTransAndLandBatchActivityInput,
         GetObjectKeysActivityInput,
+        GetObjectKeysBatchActivityInput,
+        ObjectKeyManifest,
+        batch_objects,
+        create_object_key_manifest,
+        data_trans_and_land_files,
+        data_trans_and_land_batch,
+        get_object_keys,
+        get_object_keys_batch,
+        get_objects,
+    )
+import dataclasses
+from dataclasses import dataclass, field
+from datetime import datetime
+
+
+def hour_path(namespace: str, read_time: datetime) -> str:
+    """Path of one hour of a namespace's history below a bucket's root."""
+    return (
+        f"{namespace}/{read_time.year}/{read_time.month:02}/"
+        f"{read_time.day:02}/{read_time.hour:02}/00"
     )
-from dataclasses import dataclass
 
 
 @dataclass
@@ -20,6 +51,49 @@ class ProtoToParquetWorkflowInput:
     export_s3_bucket: str
     namespace: str
     output_s3_bucket: str
+    streaming: bool = False
+    row_group_size: int = 100_000
+    # Number of files converted concurrently, 1 processes them one at a time
+    max_concurrent_activities: int = 1
+    # When set, keys are listed into a manifest object and read back in
+    # batches of this size instead of being returned by one activity, and
+    # the workflow continues as new after every manifest_batches_per_run
+    manifest_batch_size: Optional[int] = None
+    manifest_batches_per_run: int = 10
+    # Task queue of a worker that converts files on a process pool, see
+    # run_worker.py. Conversion runs on this workflow's task queue if unset.
+    conversion_task_queue: Optional[str] = None
+    # Split output into Hive-style partitions, see partitioning.py
+    partition_by_event_type: bool = False
+    partition_by_workflow_type: bool = False
+    # Only convert export files that are new or changed since the last run,
+    # into output files named after the export file, see incremental.py
+    incremental: bool = False
+    # Limit the fields converted, see proto_flatten.Projection
+    include_fields: Optional[List[str]] = None
+    exclude_fields: Optional[List[str]] = None
+    exclude_payload_fields: bool = False
+    # Row groups between resumable checkpoints in streaming mode
+    checkpoint_row_groups: int = 10
+    # Write every file with the schema derived from the history protos, see
+    # history_schema.py
+    fixed_schema: bool = True
+    # When set, files are listed with their sizes and small ones converted
+    # together, in batches of about this many bytes and at most
+    # max_batch_keys files, into one output file per batch. Not used with
+    # incremental or manifest listing, which track files one by one.
+    batch_target_bytes: Optional[int] = None
+    max_batch_keys: int = 500
+    # Files of a batch downloaded and flattened at once
+    batch_workers: int = 4
+    # Most partitions with an output file open at once in streaming mode
+    max_open_partitions: int = 16
+    # Set by a run that continued as new: the hour it converts, the manifest,
+    # where in it to resume, and the files that failed so far
+    hour: Optional[str] = None
+    manifest: Optional[ObjectKeyManifest] = None
+    manifest_offset: int = 0
+    failures: Dict[str, str] = field(default_factory=dict)
 
 
 @workflow.defn
@@ -35,40 +109,299 @@ class ProtoToParquet:
 
         # Read from export S3 bucket and given at least 2 hour delay to ensure the file has been uploaded
         read_time = workflow.now() - timedelta(hours=workflow_input.num_delay_hour)
-        common_path = f"{workflow_input.namespace}/{read_time.year}/{read_time.month:02}/{read_time.day:02}/{read_time.hour:02}/00"
+        common_path = workflow_input.hour or hour_path(
+            workflow_input.namespace, read_time
+        )
         path = f"temporal-workflow-history/export/{common_path}"
-        get_object_keys_input = GetObjectKeysActivityInput(
-            workflow_input.export_s3_bucket, path
+        write_path = f"temporal-workflow-history/parquet/{common_path}"
+        # Listing leaves out files the processed-key manifest says are done
+        processed_bucket = (
+            workflow_input.output_s3_bucket if workflow_input.incremental else None
         )
+        processed_write_path = write_path if workflow_input.incremental else None
 
-        # Read Input File
-        object_keys_output = await workflow.execute_activity(
-            get_object_keys,
-            get_object_keys_input,
-            start_to_close_timeout=timedelta(minutes=5),
-            retry_policy=retry_policy,
-        )
+        # Convert proto to parquet and save to S3, with at most
+        # max_concurrent_activities files in flight at once. A failed file
+        # doesn't stop the others; failures are collected per key and reported
+        # together once every file has been attempted.
+        semaphore = asyncio.Semaphore(max(1, workflow_input.max_concurrent_activities))
+        failures = dict(workflow_input.failures)
 
-        write_path = f"temporal-workflow-history/parquet/{common_path}"
+        async def process_key(key: str) -> None:
+            data_trans_and_land_input = DataTransAndLandActivityInput(
+                workflow_input.export_s3_bucket,
+                key,
+                workflow_input.output_s3_bucket,
+                write_path,
+                workflow_input.streaming,
+                workflow_input.row_group_size,
+                workflow_input.partition_by_event_type,
+                workflow_input.partition_by_workflow_type,
+                workflow_input.incremental,
+                workflow_input.include_fields,
+                workflow_input.exclude_fields,
+                workflow_input.exclude_payload_fields,
+                workflow_input.checkpoint_row_groups,
+                workflow_input.fixed_schema,
+                workflow_input.max_open_partitions,
+            )
+            async with semaphore:
+                try:
+                    await workflow.execute_activity(
+                        data_trans_and_land_files,
+                        data_trans_and_land_input,
+                        task_queue=workflow_input.conversion_task_queue,
+                        start_to_close_timeout=timedelta(minutes=15),
+                        # A lost worker is noticed within minutes, and the
+                        # retry resumes from the last heartbeat checkpoint
+                        heartbeat_timeout=timedelta(minutes=2),
+                        retry_policy=retry_policy,
+                    )
+                except ActivityError as output_err:
+                    workflow.logger.error(
+                        f"Data transformation failed for {key}: {output_err}"
+                    )
+                    failures[key] = str(output_err.cause or output_err)
 
-        try:
-            # Could create a list of corountine objects to process files in parallel
-            for key in object_keys_output:
-                data_trans_and_land_input = DataTransAndLandActivityInput(
-                    workflow_input.export_s3_bucket,
-                    key,
-                    workflow_input.output_s3_bucket,
-                    write_path,
+        async def process_batch(keys: List[str]) -> None:
+            if len(keys) == 1:
+                await process_key(keys[0])
+                return
+            batch_input = DataTransAndLandBatchActivityInput(
+                workflow_input.export_s3_bucket,
+                keys,
+                workflow_input.output_s3_bucket,
+                write_path,
+                workflow_input.batch_workers,
+                workflow_input.partition_by_event_type,
+                workflow_input.partition_by_workflow_type,
+                workflow_input.include_fields,
+                workflow_input.exclude_fields,
+                workflow_input.exclude_payload_fields,
+                workflow_input.fixed_schema,
+            )
+            async with semaphore:
+                try:
+                    result = await workflow.execute_activity(
+                        data_trans_and_land_batch,
+                        batch_input,
+                        task_queue=workflow_input.conversion_task_queue,
+                        start_to_close_timeout=timedelta(minutes=15),
+                        heartbeat_timeout=timedelta(minutes=2),
+                        retry_policy=retry_policy,
+                    )
+                except ActivityError as output_err:
+                    workflow.logger.error(
+                        f"Batch of {len(keys)} files failed: {output_err}"
+                    )
+                    for key in keys:
+                        failures[key] = str(output_err.cause or output_err)
+                    return
+            # Files that failed within the batch get retried on their own
+            await asyncio.gather(
+                *(process_key(r.key) for r in result.results if r.error is not None)
+            )
+
+        if workflow_input.batch_target_bytes and not (
+            workflow_input.manifest_batch_size or workflow_input.incremental
+        ):
+            objects = await workflow.execute_activity(
+                get_objects,
+                GetObjectKeysActivityInput(workflow_input.export_s3_bucket, path),
+                start_to_close_timeout=timedelta(minutes=5),
+                retry_policy=retry_policy,
+            )
+            num_keys = len(objects)
+            batches = batch_objects(
+                objects,
+                workflow_input.batch_target_bytes,
+                workflow_input.max_batch_keys,
+            )
+            workflow.logger.info(
+                f"Converting {num_keys} files in {len(batches)} batches"
+            )
+            await asyncio.gather(*(process_batch(keys) for keys in batches))
+        elif workflow_input.manifest_batch_size:
+            # List into a manifest object and only carry a reference to it, so
+            # the listing result stays small however many files there are
+            manifest = workflow_input.manifest
+            if manifest is None:
+                manifest = await workflow.execute_activity(
+                    create_object_key_manifest,
+                    CreateObjectKeyManifestActivityInput(
+                        workflow_input.export_s3_bucket,
+                        path,
+                        workflow_input.output_s3_bucket,
+                        f"temporal-workflow-history/manifests/{common_path}/keys.txt",
+                        workflow_input.manifest_batch_size,
+                        processed_bucket,
+                        processed_write_path,
+                    ),
+                    start_to_close_timeout=timedelta(minutes=5),
+                    retry_policy=retry_policy,
                 )
-                # Convert proto to parquet and save to S3
-                await workflow.execute_activity(
-                    data_trans_and_land,
-                    data_trans_and_land_input,
-                    start_to_close_timeout=timedelta(minutes=15),
+            num_keys = manifest.total_keys
+            offset = workflow_input.manifest_offset
+            for _ in range(max(1, workflow_input.manifest_batches_per_run)):
+                if offset >= manifest.size:
+                    break
+                batch = await workflow.execute_activity(
+                    get_object_keys_batch,
+                    GetObjectKeysBatchActivityInput(manifest, offset),
+                    start_to_close_timeout=timedelta(minutes=5),
                     retry_policy=retry_policy,
                 )
-        except ActivityError as output_err:
-            workflow.logger.error(f"Data transformation failed: {output_err}")
-            raise output_err
+                await asyncio.gather(*(process_key(key) for key in batch.keys))
+                offset = batch.next_offset
+            if offset < manifest.size:
+                # Each run's history only covers a window of batches, so it
+                # stays the same size however many files the hour has
+                workflow.continue_as_new(
+                    dataclasses.replace(
+                        workflow_input,
+                        hour=common_path,
+                        manifest=manifest,
+                        manifest_offset=offset,
+                        failures=failures,
+                    )
+                )
+        else:
+            # Read Input File
+            object_keys_output = await workflow.execute_activity(
+                get_object_keys,
+                GetObjectKeysActivityInput(
+                    workflow_input.export_s3_bucket,
+                    path,
+                    processed_bucket,
+                    processed_write_path,
+                ),
+                start_to_close_timeout=timedelta(minutes=5),
+                retry_policy=retry_policy,
+            )
+            num_keys = len(object_keys_output)
+            await asyncio.gather(*(process_key(key) for key in object_keys_output))
+
+        if failures:
+            raise ApplicationError(
+                f"Data transformation failed for {len(failures)} of "
+                f"{num_keys} files",
+                failures,
+                type="DataTransformationFailed",
+            )
 
         return write_path
+
+
+@dataclass
+class CompactParquetWorkflowInput:
+    # Should be later than the hour ProtoToParquet converts, so compaction
+    # only sees an hour once its conversion is done
+    num_delay_hour: int
+    namespace: str
+    output_s3_bucket: str
+    target_file_size: int = DEFAULT_TARGET_FILE_SIZE
+    row_group_size_bytes: int = DEFAULT_ROW_GROUP_SIZE_BYTES
+    max_concurrent_activities: int = 1
+
+
+@dataclass
+class CompactionSummary:
+    write_path: str
+    files_merged: int
+    files_written: int
+    bytes_merged: int
+    bytes_written: int
+    elapsed_seconds: float
+
+
+@workflow.defn
+class CompactParquet:
+    """Merge an hour's small Parquet outputs into target-sized files."""
+
+    @workflow.run
+    async def run(
+        self, workflow_input: CompactParquetWorkflowInput
+    ) -> CompactionSummary:
+        """Run parquet compaction workflow."""
+        started = workflow.now()
+        retry_policy = RetryPolicy(
+            maximum_attempts=10, maximum_interval=timedelta(seconds=5)
+        )
+        read_time = started - timedelta(hours=workflow_input.num_delay_hour)
+        write_path = (
+            "temporal-workflow-history/parquet/"
+            f"{hour_path(workflow_input.namespace, read_time)}"
+        )
+
+        groups = await workflow.execute_activity(
+            plan_compaction,
+            PlanCompactionActivityInput(
+                workflow_input.output_s3_bucket,
+                write_path,
+                workflow_input.target_file_size,
+            ),
+            start_to_close_timeout=timedelta(minutes=5),
+            retry_policy=retry_policy,
+        )
+
+        # Each group is merged into a staging file and then swapped in for
+        # its inputs. A group that fails to merge leaves its inputs untouched.
+        semaphore = asyncio.Semaphore(max(1, workflow_input.max_concurrent_activities))
+        summary = CompactionSummary(write_path, 0, 0, 0, 0, 0.0)
+        failures: Dict[str, str] = {}
+
+        async def compact(group: CompactionGroup) -> None:
+            async with semaphore:
+                try:
+                    result = await workflow.execute_activity(
+                        compact_files,
+                        CompactFilesActivityInput(
+                            workflow_input.output_s3_bucket,
+                            write_path,
+                            group,
+                            workflow_input.row_group_size_bytes,
+                        ),
+                        start_to_close_timeout=timedelta(minutes=30),
+                        heartbeat_timeout=timedelta(minutes=2),
+                        retry_policy=retry_policy,
+                    )
+                    await workflow.execute_activity(
+                        commit_compaction,
+                        result,
+                        start_to_close_timeout=timedelta(minutes=10),
+                        retry_policy=retry_policy,
+                    )
+                except ActivityError as err:
+                    workflow.logger.error(
+                        f"Compaction failed for {group.directory}: {err}"
+                    )
+                    failures[group.keys[0]] = str(err.cause or err)
+                    return
+            summary.files_merged += len(result.input_keys)
+            summary.files_written += 1
+            summary.bytes_merged += result.bytes_merged
+            summary.bytes_written += result.output_bytes
+
+        await asyncio.gather(*(compact(group) for group in groups))
+        elapsed = workflow.now() - started
+        summary.elapsed_seconds = elapsed.total_seconds()
+        workflow.metric_meter().create_histogram_timedelta(
+            "parquet_compaction_workflow_duration",
+            "Time to compact one hour of Parquet output",
+        ).record(elapsed)
+        workflow.logger.info(
+            "Compacted %d files (%d bytes) into %d under %s in %.1fs",
+            summary.files_merged,
+            summary.bytes_merged,
+            summary.files_written,
+            write_path,
+            summary.elapsed_seconds,
+        )
+
+        if failures:
+            raise ApplicationError(
+                f"Compaction failed for {len(failures)} of {len(groups)} groups",
+                failures,
+                type="CompactionFailed",
+            )
+        return summary
@@ -4,15 +4,53 @@ import asyncio
 import dataclasses
 from dataclasses import dataclass
 from datetime import timedelta
-from typing import Any, Dict, List, Optional, Union
+from typing import (
+    Any,
+    Awaitable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from temporalio import workflow
+from temporalio.exceptions import ApplicationError
 
 
 @dataclass
 class DSLInput:
     root: Statement
     variables: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    # Run each activity as soon as the variables it reads are set instead of
+    # in the order of sequences, see plan_dataflow
+    dataflow: bool = False
+    # Most activities running at once with dataflow, no limit if 0
+    max_concurrency: int = 0
+    # Variables the workflow returns, all of them if not set
+    outputs: Optional[List[str]] = None
+    # Continue as new once the history has this many events or bytes (no
+    # limit if 0), or once the server suggests it, see DSLWorkflow.run
+    max_history_length: int = 0
+    max_history_size: int = 0
+    # Where to resume, set by the run that continued as new
+    position: Optional[DSLPosition] = None
+
+
+@dataclass
+class DSLPosition:
+    # Paths of the completed statements. A statement's path is "root", or
+    # "node.<index>" in a dataflow plan, followed by the index of the element,
+    # branch, foreach element or batch at each level below it, e.g. "root.2.0".
+    # A completed statement's path replaces those of the statements in it, and
+    # in a sequence only the last completed element's path is kept.
+    completed: List[str] = dataclasses.field(default_factory=list)
+    # Values collected by the completed elements of foreach statements that
+    # haven't completed, by the foreach's path and the element's index
+    collected: Dict[str, Dict[str, Any]] = dataclasses.field(default_factory=dict)
 
 
 @dataclass
@@ -42,44 +80,473 @@ class ParallelStatement:
     parallel: Parallel
 
 
+# How a parallel block ends:
+# * fail_fast: once every branch succeeds, or as soon as one fails, cancelling
+#   the others and failing with its error
+# * wait_all: once every branch has ended, failing with the errors of all the
+#   branches that failed
+# * first_n: as soon as count branches succeed, cancelling the others, or
+#   fail as soon as too many have failed for that
+ParallelPolicy = Literal["fail_fast", "wait_all", "first_n"]
+
+
 @dataclass
 class Parallel:
     branches: List[Statement]
+    policy: ParallelPolicy = "fail_fast"
+    # Branches that must succeed with first_n
+    count: Optional[int] = None
+
+
+@dataclass
+class ForeachStatement:
+    foreach: Foreach
+
+
+@dataclass
+class Foreach:
+    # List variable to iterate over
+    items: str
+    # Variable each element is set to for the body
+    item: str
+    body: Statement
+    # Most elements running at once, no limit if 0
+    max_concurrency: int = 0
+    # Variable the body sets for each element, and the variable to store the
+    # list of its values in, in the order of items
+    collect: Optional[str] = None
+    result: Optional[str] = None
+    # Run every batch_size elements in a child workflow instead, up to
+    # max_concurrent_batches of them at once (no limit if 0)
+    batch_size: int = 0
+    max_concurrent_batches: int = 0
+
+
+Statement = Union[
+    ActivityStatement, SequenceStatement, ParallelStatement, ForeachStatement
+]
+
+
+async def _gather_cancelling(aws: Iterable[Awaitable[Any]]) -> List[Any]:
+    # Like asyncio.gather, but cancels the rest once one fails
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+@dataclass
+class DataflowNode:
+    statement: Statement
+    # Indexes of the nodes that must complete before this one starts
+    depends_on: List[int]
+
+
+def statement_variables(stmt: Statement) -> Tuple[Set[str], Set[str]]:
+    """The variables a statement reads and the variables it writes."""
+    if isinstance(stmt, ActivityStatement):
+        result = stmt.activity.result
+        return set(stmt.activity.arguments), {result} if result else set()
+    if isinstance(stmt, ForeachStatement):
+        # The body's variables are its own, apart from what it reads
+        foreach = stmt.foreach
+        body_reads, _ = statement_variables(foreach.body)
+        return (
+            {foreach.items} | (body_reads - {foreach.item}),
+            {foreach.result} if foreach.result else set(),
+        )
+    if isinstance(stmt, SequenceStatement):
+        children, in_sequence = stmt.sequence.elements, True
+    else:
+        children, in_sequence = stmt.parallel.branches, False
+    reads: Set[str] = set()
+    writes: Set[str] = set()
+    for child in children:
+        child_reads, child_writes = statement_variables(child)
+        # What a sequence reads after setting it isn't read from outside
+        reads |= child_reads - writes if in_sequence else child_reads
+        writes |= child_writes
+    return reads, writes
+
+
+def _dataflow_statements(stmt: Statement) -> List[Statement]:
+    # The statements the plan schedules, in program order
+    if isinstance(stmt, SequenceStatement):
+        return [
+            s for elem in stmt.sequence.elements for s in _dataflow_statements(elem)
+        ]
+    # Failing fast is what the plan does anyway. Other policies depend on how
+    # the block's branches end, so the block is scheduled as a whole.
+    if isinstance(stmt, ParallelStatement) and stmt.parallel.policy == "fail_fast":
+        return [
+            s for branch in stmt.parallel.branches for s in _dataflow_statements(branch)
+        ]
+    return [stmt]
+
+
+def plan_dataflow(root: Statement) -> List[DataflowNode]:
+    """Compile a statement tree into a graph of the activities in it.
 
+    Parallel blocks with policies other than fail_fast are nodes of the graph
+    themselves, reading and writing what their branches do.
 
-Statement = Union[ActivityStatement, SequenceStatement, ParallelStatement]
+    An activity depends on the last activity before it, in program order, that
+    writes a variable it reads or writes, and on the activities since then
+    that read a variable it writes. Running activities in any order that
+    respects those dependencies gives the variables the tree would give
+    running in program order. Sequences add no ordering of their own, so
+    activities that don't share variables run in parallel. Activities in
+    different branches of a parallel that do share variables are ordered as
+    if the branches ran one after the other, which is one of the orders the
+    branches could race into.
+    """
+    nodes: List[DataflowNode] = []
+    last_writer: Dict[str, int] = {}
+    readers: Dict[str, List[int]] = {}
+    for i, stmt in enumerate(_dataflow_statements(root)):
+        reads, writes = statement_variables(stmt)
+        depends_on = {last_writer[var] for var in reads | writes if var in last_writer}
+        for var in writes:
+            depends_on.update(readers.get(var, []))
+        depends_on.discard(i)
+        nodes.append(DataflowNode(stmt, sorted(depends_on)))
+        for var in reads:
+            readers.setdefault(var, []).append(i)
+        for var in writes:
+            last_writer[var] = i
+            readers[var] = []
+    return nodes
 
 
 @workflow.defn
 class DSLWorkflow:
     @workflow.run
     async def run(self, input: DSLInput) -> Dict[str, Any]:
+        # Statements with a path are checkpointed: once the history reaches a
+        # threshold no more of them start, and when the running ones have
+        # completed the workflow continues as new with the variables and the
+        # completed paths, so replay cost stays bounded however long the
+        # program runs. Statements without a path, those in foreach bodies and
+        # in parallel blocks with other policies than fail_fast, run to
+        # completion once started, as their own variables aren't kept.
+        self.input = input
         self.variables = dict(input.variables)
+        position = input.position or DSLPosition()
+        self.completed = set(position.completed)
+        self.collected = {
+            path: dict(values) for path, values in position.collected.items()
+        }
+        self.started = 0
+        self.checkpointing = False
         workflow.logger.info("Running DSL workflow")
-        await self.execute_statement(input.root)
+        if input.dataflow:
+            completed = await self.execute_dataflow(
+                plan_dataflow(input.root), input.max_concurrency
+            )
+        else:
+            completed = await self.execute_statement(input.root, self.variables, "root")
+        if not completed:
+            workflow.logger.info(
+                f"Continuing DSL workflow as new after {self.started} statements"
+            )
+            workflow.continue_as_new(
+                dataclasses.replace(
+                    input,
+                    variables=self.variables,
+                    position=DSLPosition(sorted(self.completed), self.collected),
+                )
+            )
         workflow.logger.info("DSL workflow completed")
+        if input.outputs is not None:
+            return {name: self.variables.get(name) for name in input.outputs}
         return self.variables
 
-    async def execute_statement(self, stmt: Statement) -> None:
-        if isinstance(stmt, ActivityStatement):
-            # Invoke activity loading arguments from variables and optionally
-            # storing result as a variable
-            result = await workflow.execute_activity(
-                stmt.activity.name,
-                args=[self.variables.get(arg, "") for arg in stmt.activity.arguments],
-                start_to_close_timeout=timedelta(minutes=1),
+    def start(self, path: Optional[str]) -> bool:
+        # Whether a statement that runs to completion once started may start.
+        # Something must have started in this run first, so each run makes
+        # progress whatever the thresholds.
+        if path is None:
+            return True
+        if not self.checkpointing and self.started:
+            info = workflow.info()
+            max_length = self.input.max_history_length
+            max_size = self.input.max_history_size
+            self.checkpointing = (
+                info.is_continue_as_new_suggested()
+                or 0 < max_length <= info.get_current_history_length()
+                or 0 < max_size <= info.get_current_history_size()
+            )
+        if self.checkpointing:
+            return False
+        self.started += 1
+        return True
+
+    def complete(self, path: str, nested: bool) -> None:
+        if nested:
+            prefix = f"{path}."
+            self.completed = {p for p in self.completed if not p.startswith(prefix)}
+            self.collected.pop(path, None)
+        self.completed.add(path)
+
+    async def execute_statement(
+        self, stmt: Statement, variables: Dict[str, Any], path: Optional[str] = None
+    ) -> bool:
+        # Returns whether the statement completed rather than being left, in
+        # part or whole, for the next run
+        if path is not None and path in self.completed:
+            return True
+        if isinstance(stmt, SequenceStatement):
+            completed = await self.execute_sequence(stmt.sequence, variables, path)
+        elif isinstance(stmt, ForeachStatement):
+            completed = await self.execute_foreach(stmt.foreach, variables, path)
+        elif (
+            isinstance(stmt, ParallelStatement) and stmt.parallel.policy == "fail_fast"
+        ):
+            completed = await self.execute_parallel(stmt.parallel, variables, path)
+        else:
+            if not self.start(path):
+                return False
+            if isinstance(stmt, ActivityStatement):
+                await self.execute_activity(stmt.activity, variables)
+            else:
+                # Its outcome depends on how all its branches end, so it
+                # starts as a whole
+                await self.execute_parallel(stmt.parallel, variables, None)
+            completed = True
+        if completed and path is not None:
+            self.complete(path, not isinstance(stmt, ActivityStatement))
+        return completed
+
+    async def execute_activity(
+        self, invocation: ActivityInvocation, variables: Dict[str, Any]
+    ) -> None:
+        # Invoke activity loading arguments from variables and optionally
+        # storing result as a variable
+        result = await workflow.execute_activity(
+            invocation.name,
+            args=[variables.get(arg, "") for arg in invocation.arguments],
+            start_to_close_timeout=timedelta(minutes=1),
+        )
+        if invocation.result:
+            variables[invocation.result] = result
+
+    async def execute_sequence(
+        self, sequence: Sequence, variables: Dict[str, Any], path: Optional[str]
+    ) -> bool:
+        # Execute each statement in order, from the one after the last that
+        # completed in an earlier run
+        first = 0
+        if path is not None:
+            for i in reversed(range(len(sequence.elements))):
+                if f"{path}.{i}" in self.completed:
+                    first = i + 1
+                    break
+        for i in range(first, len(sequence.elements)):
+            elem_path = None if path is None else f"{path}.{i}"
+            if not await self.execute_statement(
+                sequence.elements[i], variables, elem_path
+            ):
+                return False
+            if path is not None:
+                self.completed.discard(f"{path}.{i - 1}")
+        return True
+
+    async def execute_parallel(
+        self, parallel: Parallel, variables: Dict[str, Any], path: Optional[str]
+    ) -> bool:
+        # Execute all in parallel, cancelling the branches still running once
+        # the policy has decided the outcome. In newer Python versions fail_fast
+        # would use a TaskGroup instead.
+        total = len(parallel.branches)
+        needed = total
+        if parallel.policy == "first_n":
+            if parallel.count is None or not 0 < parallel.count <= total:
+                raise ApplicationError(
+                    f"first_n needs a count between 1 and {total} branches",
+                    non_retryable=True,
+                )
+            needed = parallel.count
+        succeeded = 0
+        # Branches left for the next run, only ever with fail_fast
+        deferred = 0
+        errors: List[BaseException] = []
+
+        async def execute_branch(i: int) -> None:
+            nonlocal succeeded, deferred
+            branch_path = None if path is None else f"{path}.{i}"
+            try:
+                if await self.execute_statement(
+                    parallel.branches[i], variables, branch_path
+                ):
+                    succeeded += 1
+                else:
+                    deferred += 1
+            except Exception as err:
+                errors.append(err)
+
+        def decided() -> bool:
+            if parallel.policy == "wait_all":
+                return succeeded + len(errors) == total
+            # With fail_fast every branch is needed, so one failure decides
+            return succeeded + deferred >= needed or total - len(errors) < needed
+
+        tasks = [asyncio.create_task(execute_branch(i)) for i in range(total)]
+        try:
+            await workflow.wait_condition(decided)
+            # What cancelling the rest may add doesn't change the outcome
+            outcome = succeeded, deferred, list(errors)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let the cancelled branches finish, e.g. request their activities'
+            # cancellation, before going on
+            await asyncio.gather(*tasks, return_exceptions=True)
+        succeeded, deferred, errors = outcome
+        if succeeded + deferred >= needed:
+            return not deferred
+        if len(errors) == 1 or parallel.policy == "fail_fast":
+            raise errors[0]
+        messages = "; ".join(str(getattr(err, "cause", None) or err) for err in errors)
+        raise ApplicationError(
+            f"{len(errors)} of {total} parallel branches failed: {messages}",
+            type="ParallelBranchesFailed",
+        ) from errors[0]
+
+    async def execute_dataflow(
+        self, nodes: List[DataflowNode], max_concurrency: int
+    ) -> bool:
+        # Each node waits for the nodes it depends on, then for a free slot. A
+        # node whose dependencies were left for the next run is left too.
+        ended = [asyncio.Event() for _ in nodes]
+        completed = [False] * len(nodes)
+        slots = asyncio.Semaphore(max_concurrency or max(len(nodes), 1))
+
+        async def execute_node(i: int) -> None:
+            for dependency in nodes[i].depends_on:
+                await ended[dependency].wait()
+            if all(completed[dependency] for dependency in nodes[i].depends_on):
+                async with slots:
+                    completed[i] = await self.execute_statement(
+                        nodes[i].statement, self.variables, f"node.{i}"
+                    )
+            ended[i].set()
+
+        # Nodes waiting on a failed one would never start, and the others
+        # would run for a workflow that has already failed
+        await _gather_cancelling(execute_node(i) for i in range(len(nodes)))
+        return all(completed)
+
+    async def execute_foreach(
+        self, foreach: Foreach, variables: Dict[str, Any], path: Optional[str]
+    ) -> bool:
+        items = variables.get(foreach.items)
+        if not isinstance(items, list):
+            raise ApplicationError(
+                f"foreach items variable {foreach.items} is not a list",
+                non_retryable=True,
+            )
+        if (foreach.collect is None) != (foreach.result is None):
+            raise ApplicationError(
+                "foreach needs both collect and result or neither",
+                non_retryable=True,
+            )
+        # Collected values by element index, kept across runs with a path
+        collected = {} if path is None else self.collected.setdefault(path, {})
+        if foreach.batch_size:
+            completed = await self.execute_foreach_batches(
+                foreach, variables, items, path, collected
             )
-            if stmt.activity.result:
-                self.variables[stmt.activity.result] = result
-        elif isinstance(stmt, SequenceStatement):
-            # Execute each statement in order
-            for elem in stmt.sequence.elements:
-                await self.execute_statement(elem)
-        elif isinstance(stmt, ParallelStatement):
-            # Execute all in parallel. Note, this will raise an exception when
-            # the first activity fails and will not cancel the others. We could
-            # store tasks and cancel if we wanted. In newer Python versions this
-            # would use a TaskGroup instead.
-            await asyncio.gather(
-                *[self.execute_statement(branch) for branch in stmt.parallel.branches]
+        else:
+            completed = await self.execute_foreach_items(
+                foreach, variables, items, path, collected
             )
+        if not completed:
+            return False
+        if foreach.result:
+            variables[foreach.result] = [
+                collected.get(str(i)) for i in range(len(items))
+            ]
+        return True
+
+    async def execute_foreach_items(
+        self,
+        foreach: Foreach,
+        variables: Dict[str, Any],
+        items: List[Any],
+        path: Optional[str],
+        collected: Dict[str, Any],
+    ) -> bool:
+        slots = asyncio.Semaphore(foreach.max_concurrency or max(len(items), 1))
+
+        async def execute_item(i: int) -> bool:
+            item_path = None if path is None else f"{path}.{i}"
+            if item_path in self.completed:
+                return True
+            async with slots:
+                if not self.start(item_path):
+                    return False
+                # Each element gets its own variables, so elements running at
+                # once don't overwrite each other's
+                scope = {**variables, foreach.item: items[i]}
+                await self.execute_statement(foreach.body, scope)
+                if foreach.collect:
+                    collected[str(i)] = scope.get(foreach.collect)
+                if item_path is not None:
+                    self.complete(item_path, False)
+                return True
+
+        return all(await _gather_cancelling(execute_item(i) for i in range(len(items))))
+
+    async def execute_foreach_batches(
+        self,
+        foreach: Foreach,
+        variables: Dict[str, Any],
+        items: List[Any],
+        path: Optional[str],
+        collected: Dict[str, Any],
+    ) -> bool:
+        # Each child workflow gets its batch and the variables the body reads,
+        # and returns only the collected values, so the parent's history grows
+        # with the number of batches rather than the number of elements
+        body_reads, _ = statement_variables(foreach.body)
+        shared = {
+            name: value for name, value in variables.items() if name in body_reads
+        }
+        child_foreach = dataclasses.replace(
+            foreach, batch_size=0, max_concurrent_batches=0
+        )
+        starts = range(0, len(items), foreach.batch_size)
+        slots = asyncio.Semaphore(foreach.max_concurrent_batches or max(len(starts), 1))
+
+        async def execute_batch(b: int) -> bool:
+            batch_path = None if path is None else f"{path}.{b}"
+            if batch_path in self.completed:
+                return True
+            async with slots:
+                if not self.start(batch_path):
+                    return False
+                batch = items[starts[b] : starts[b] + foreach.batch_size]
+                outputs = await workflow.execute_child_workflow(
+                    DSLWorkflow.run,
+                    DSLInput(
+                        root=ForeachStatement(child_foreach),
+                        variables={**shared, foreach.items: batch},
+                        outputs=[foreach.result] if foreach.result else [],
+                        max_history_length=self.input.max_history_length,
+                        max_history_size=self.input.max_history_size,
+                    ),
+                    id=f"{workflow.info().workflow_id}-foreach-{workflow.uuid4()}",
+                )
+                if foreach.result:
+                    for i, value in enumerate(outputs[foreach.result], starts[b]):
+                        collected[str(i)] = value
+                if batch_path is not None:
+                    self.complete(batch_path, False)
+                return True
+
+        return all(
+            await _gather_cancelling(execute_batch(b) for b in range(len(starts)))
+        )
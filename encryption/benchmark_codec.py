@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from temporalio.api.common.v1 import Payload
+
+from encryption.codec import EncryptionCodec
+
+
+@dataclass
+class LoopStalls:
+    max_seconds: float = 0.0
+    total_seconds: float = 0.0
+
+
+async def _watch_loop(
+    stalls: LoopStalls, stop: asyncio.Event, interval: float = 0.001
+) -> None:
+    # Anything beyond the requested sleep is time the loop couldn't run us
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stall = max(0.0, time.perf_counter() - start - interval)
+        stalls.max_seconds = max(stalls.max_seconds, stall)
+        stalls.total_seconds += stall
+
+
+async def run(
+    codec: EncryptionCodec, payloads: List[Payload], batches: int
+) -> Tuple[float, LoopStalls]:
+    stalls = LoopStalls()
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(_watch_loop(stalls, stop))
+    # Let the watcher start sleeping before the work begins
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for _ in range(batches):
+        await codec.decode(await codec.encode(payloads))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await watcher
+    return elapsed, stalls
+
+
+async def main() -> None:
+    """Compare event loop stalls of inline and offloaded payload encryption."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--payloads", type=int, default=32, help="Payloads per batch")
+    parser.add_argument("--payload-size", type=int, default=512 * 1024)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--threshold", type=int, default=64 * 1024)
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 4)
+    args = parser.parse_args()
+
+    payloads = [
+        Payload(
+            metadata={"encoding": b"binary/plain"},
+            data=os.urandom(args.payload_size),
+        )
+        for _ in range(args.payloads)
+    ]
+    total_mb = 2 * args.batches * args.payloads * args.payload_size / 1024 / 1024
+    print(
+        f"{args.batches} batches of {args.payloads} payloads of "
+        f"{args.payload_size} bytes, encoded and decoded"
+    )
+
+    executor = ThreadPoolExecutor(args.threads)
+    modes: List[Tuple[str, Optional[int]]] = [
+        ("inline", None),
+        ("offloaded", args.threshold),
+    ]
+    for name, threshold in modes:
+        codec = EncryptionCodec(offload_threshold=threshold, executor=executor)
+        assert await codec.decode(await codec.encode(payloads)) == payloads
+        elapsed, stalls = await run(codec, payloads, args.batches)
+        print(
+            f"{name:>10}: {elapsed:6.2f}s ({total_mb / elapsed:7.1f} MB/s), "
+            f"longest loop stall {stalls.max_seconds * 1000:7.1f} ms, "
+            f"loop stalled {stalls.total_seconds / elapsed:5.1%} of the time"
+        )
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
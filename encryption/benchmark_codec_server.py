@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import aiohttp
+from aiohttp import web
+from google.protobuf import json_format
+from google.protobuf.message import Message
+from temporalio.api.common.v1 import Payload, Payloads
+
+from encryption.codec import EncryptionCodec
+from encryption.codec_server import JSON, PROTOBUF, PayloadsBatch, build_codec_server
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: str
+    content_type: str
+    body: bytes
+    # Payload sets decoded per request
+    sets: int
+
+
+def _body(msg: Message, content_type: str) -> bytes:
+    if content_type == PROTOBUF:
+        return msg.SerializeToString()
+    return json_format.MessageToJson(msg).encode()
+
+
+def make_payloads(size: int) -> Payloads:
+    # A JSON object of roughly the given size, like a typical workflow input
+    data = json.dumps(
+        {"items": [{"id": i, "name": f"item-{i}"} for i in range(size // 30)]}
+    ).encode()
+    return Payloads(payloads=[Payload(metadata={"encoding": b"json/plain"}, data=data)])
+
+
+async def run(
+    session: aiohttp.ClientSession,
+    url: str,
+    scenario: Scenario,
+    concurrency: int,
+    duration: float,
+) -> int:
+    requests = 0
+    deadline = time.perf_counter() + duration
+
+    async def client() -> None:
+        nonlocal requests
+        while time.perf_counter() < deadline:
+            async with session.post(
+                url + scenario.path,
+                data=scenario.body,
+                headers={"Content-Type": scenario.content_type},
+            ) as resp:
+                resp.raise_for_status()
+                await resp.read()
+            requests += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return requests
+
+
+async def main() -> None:
+    """Measure codec server requests/sec for each body format."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--url", help="Codec server to load, an in-process one if not given"
+    )
+    parser.add_argument("--payload-size", type=int, default=16 * 1024)
+    parser.add_argument("--batch-size", type=int, default=50, help="Sets per batch")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds each")
+    args = parser.parse_args()
+
+    runner: Optional[web.AppRunner] = None
+    url = args.url
+    if url is None:
+        runner = web.AppRunner(build_codec_server())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+        url = f"http://127.0.0.1:{port}"
+
+    encrypted = Payloads(
+        payloads=await EncryptionCodec().encode(
+            make_payloads(args.payload_size).payloads
+        )
+    )
+    batch = PayloadsBatch(batch=[encrypted] * args.batch_size)
+    scenarios: List[Scenario] = []
+    for content_type in (JSON, PROTOBUF):
+        name = "json" if content_type == JSON else "protobuf"
+        scenarios.append(
+            Scenario(name, "/decode", content_type, _body(encrypted, content_type), 1)
+        )
+        scenarios.append(
+            Scenario(
+                f"{name} batch",
+                "/decode/batch",
+                content_type,
+                _body(batch, content_type),
+                args.batch_size,
+            )
+        )
+
+    print(
+        f"Decoding {args.payload_size} byte payloads with {args.concurrency} "
+        f"concurrent clients for {args.duration}s per format"
+    )
+    async with aiohttp.ClientSession() as session:
+        for scenario in scenarios:
+            requests = await run(
+                session, url, scenario, args.concurrency, args.duration
+            )
+            print(
+                f"{scenario.name:>14}: {requests / args.duration:8.1f} requests/sec, "
+                f"{requests * scenario.sets / args.duration:8.1f} payload sets/sec, "
+                f"{len(scenario.body)} byte requests"
+            )
+    if runner:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import temporalio.converter
+from temporalio.api.common.v1 import Payload
+
+from encryption.codec import COMPRESSIONS, EncryptionCodec
+
+
+def make_order(rng: random.Random, order_id: int) -> Dict[str, Any]:
+    """A JSON document shaped like a typical workflow input: repeated keys,
+    enum-like strings, IDs, timestamps and some free text."""
+    return {
+        "orderId": f"order-{order_id:08}",
+        "customer": {
+            "id": f"customer-{rng.randrange(100_000):06}",
+            "email": f"user{rng.randrange(100_000)}@example.com",
+            "tier": rng.choice(["FREE", "STANDARD", "PREMIUM"]),
+        },
+        "status": rng.choice(["PENDING", "PAID", "SHIPPED", "DELIVERED"]),
+        "createdAt": f"2024-01-{rng.randrange(1, 29):02}T{rng.randrange(24):02}:"
+        f"{rng.randrange(60):02}:{rng.randrange(60):02}Z",
+        "lines": [
+            {
+                "sku": f"SKU-{rng.randrange(10_000):05}",
+                "quantity": rng.randrange(1, 5),
+                "unitPrice": round(rng.uniform(1, 500), 2),
+            }
+            for _ in range(rng.randrange(1, 6))
+        ],
+        "notes": " ".join(
+            rng.choice(["leave", "at", "door", "gift", "wrap", "fragile", "call"])
+            for _ in range(rng.randrange(0, 12))
+        ),
+    }
+
+
+def make_payload(size: int, seed: int = 0) -> Payload:
+    """A JSON payload of about ``size`` bytes, encoded by the default converter."""
+    rng = random.Random(seed)
+    orders: List[Dict[str, Any]] = []
+    while len(json.dumps(orders)) < size:
+        orders.append(make_order(rng, len(orders)))
+    return temporalio.converter.default().payload_converter.to_payloads([orders])[0]
+
+
+async def measure(
+    codec: EncryptionCodec, payloads: List[Payload], repeat: int
+) -> Tuple[float, float, int]:
+    encoded = await codec.encode(payloads)
+    assert await codec.decode(encoded) == payloads
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encoded = await codec.encode(payloads)
+    encode_seconds = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await codec.decode(encoded)
+    decode_seconds = (time.perf_counter() - start) / repeat
+    return encode_seconds, decode_seconds, sum(p.ByteSize() for p in encoded)
+
+
+async def main() -> None:
+    """Compare payload sizes and codec throughput with and without compression."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="*", default=[1024, 16 * 1024, 256 * 1024]
+    )
+    parser.add_argument("--payloads", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    compressions: List[Optional[str]] = [None, *COMPRESSIONS]
+    for size in args.sizes:
+        payloads = [make_payload(size, seed) for seed in range(args.payloads)]
+        raw = sum(p.ByteSize() for p in payloads)
+        print(f"{args.payloads} JSON payloads of {raw // args.payloads} bytes")
+        for compression in compressions:
+            codec = EncryptionCodec(compression=compression, compression_threshold=0)
+            encode_seconds, decode_seconds, encoded = await measure(
+                codec, payloads, args.repeat
+            )
+            mb = raw / 1024 / 1024
+            print(
+                f"  {compression or 'none':>5}: ratio {raw / encoded:5.2f}, "
+                f"encode {mb / encode_seconds:7.1f} MB/s, "
+                f"decode {mb / decode_seconds:7.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,10 @@
+import asyncio
 import os
-from typing import Iterable, List
+import zlib
+from concurrent.futures import Executor
+from typing import Callable, Iterable, List, Optional, Tuple, Union
 
+import zstandard
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from temporalio.api.common.v1 import Payload
 from temporalio.converter import PayloadCodec
@@ -8,50 +12,189 @@ from temporalio.converter import PayloadCodec
 default_key = b"test-key-test-key-test-key-test!"
 default_key_id = "test-key-id"
 
+COMPRESSIONS = ("zstd", "zlib")
+# Levels that favour speed, since payloads are compressed on every encode.
+# On JSON, zlib level 3 compresses about 2x faster than the default of 6 for
+# a slightly lower ratio.
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 3
+
+
+def compress(compression: str, data: bytes) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(compression: str, data: bytes) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unrecognized compression {compression}")
+
+
+def encrypt(
+    encryptor: AESGCM, data: bytes, associated_data: Optional[bytes] = None
+) -> bytes:
+    nonce = os.urandom(12)
+    return nonce + encryptor.encrypt(nonce, data, associated_data)
+
+
+def decrypt(
+    encryptor: AESGCM, data: bytes, associated_data: Optional[bytes] = None
+) -> bytes:
+    return encryptor.decrypt(data[:12], data[12:], associated_data)
+
+
+def compression_associated_data(compression: str) -> Optional[bytes]:
+    """Data authenticated along with a payload, but not encrypted.
+
+    Binding the compression algorithm makes decryption fail if the
+    encryption-compression metadata is added, removed or changed, instead of
+    the payload being decompressed the wrong way. Uncompressed payloads have
+    none, so they stay readable by the TypeScript and Go samples.
+    """
+    if not compression:
+        return None
+    return b"encryption-compression:" + compression.encode()
+
 
 class EncryptionCodec(PayloadCodec):
-    def __init__(self, key_id: str = default_key_id, key: bytes = default_key) -> None:
+    def __init__(
+        self,
+        key_id: str = default_key_id,
+        key: bytes = default_key,
+        *,
+        offload_threshold: Optional[int] = None,
+        executor: Optional[Executor] = None,
+        compression: Optional[str] = None,
+        compression_threshold: int = 1024,
+    ) -> None:
         super().__init__()
-        self.key_id = key_id
+        self._key_id = key_id
         # We are using direct AESGCM to be compatible with samples from
         # TypeScript and Go. Pure Python samples may prefer the higher-level,
         # safer APIs.
-        self.encryptor = AESGCM(key)
+        self._encryptor = AESGCM(key)
+        # When set, payloads of at least this many bytes are encrypted and
+        # decrypted on the executor (the event loop's default one if not
+        # given) so large payloads don't block the event loop. AESGCM releases
+        # the GIL while it works, so a batch of them runs in parallel. Smaller
+        # payloads are cheaper to handle inline than to hand off to a thread.
+        self.offload_threshold = offload_threshold
+        self.executor = executor
+        # When set to "zstd" or "zlib", payloads of at least
+        # compression_threshold serialized bytes are compressed before they
+        # are encrypted, and the algorithm is recorded in the metadata.
+        # Smaller payloads gain little and are left alone, as is any payload
+        # that doesn't shrink. Decoding handles both either way.
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unrecognized compression {compression}")
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    @property
+    def key_id(self) -> str:
+        """The ID of the key new payloads are encrypted with."""
+        return self._key_id
+
+    @property
+    def encryptor(self) -> AESGCM:
+        """The cipher of the key new payloads are encrypted with."""
+        return self._encryptor
 
     async def encode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        return await self._apply(self.encode_payload, payloads)
+
+    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        return await self._apply(self.decode_payload, payloads)
+
+    async def _apply(
+        self, fn: Callable[[Payload], Payload], payloads: Iterable[Payload]
+    ) -> List[Payload]:
+        if self.offload_threshold is None:
+            return [fn(p) for p in payloads]
+        loop = asyncio.get_running_loop()
+        ret: List[Union[Payload, "asyncio.Future[Payload]"]] = []
+        try:
+            for p in payloads:
+                if p.ByteSize() >= self.offload_threshold:
+                    ret.append(loop.run_in_executor(self.executor, fn, p))
+                else:
+                    ret.append(fn(p))
+            offloaded = [r for r in ret if isinstance(r, asyncio.Future)]
+            if not offloaded:
+                return ret  # type: ignore[return-value]
+            results = iter(await asyncio.gather(*offloaded))
+        except BaseException:
+            # One payload failed, so the others are of no use. Cancel those
+            # still queued on the executor and collect the outcome of the
+            # rest, so no work or error outlives the call unobserved.
+            offloaded = [r for r in ret if isinstance(r, asyncio.Future)]
+            for future in offloaded:
+                future.cancel()
+            await asyncio.gather(*offloaded, return_exceptions=True)
+            raise
+        return [r if isinstance(r, Payload) else next(results) for r in ret]
+
+    def encode_payload(self, p: Payload) -> Payload:
         # We blindly encode all payloads with the key and set the metadata
         # saying which key we used
-        return [
-            Payload(
-                metadata={
-                    "encoding": b"binary/encrypted",
-                    "encryption-key-id": self.key_id.encode(),
-                },
-                data=self.encrypt(p.SerializeToString()),
-            )
-            for p in payloads
-        ]
+        key_id, encryptor = self.encryption_key()
+        metadata = {
+            "encoding": b"binary/encrypted",
+            "encryption-key-id": key_id.encode(),
+        }
+        data = p.SerializeToString()
+        compression = ""
+        if self.compression and len(data) >= self.compression_threshold:
+            compressed = compress(self.compression, data)
+            if len(compressed) < len(data):
+                compression = self.compression
+                metadata["encryption-compression"] = compression.encode()
+                data = compressed
+        associated_data = compression_associated_data(compression)
+        return Payload(
+            metadata=metadata, data=encrypt(encryptor, data, associated_data)
+        )
 
-    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
-        ret: List[Payload] = []
-        for p in payloads:
-            # Ignore ones w/out our expected encoding
-            if p.metadata.get("encoding", b"").decode() != "binary/encrypted":
-                ret.append(p)
-                continue
-            # Confirm our key ID is the same
-            key_id = p.metadata.get("encryption-key-id", b"").decode()
-            if key_id != self.key_id:
-                raise ValueError(
-                    f"Unrecognized key ID {key_id}. Current key ID is {self.key_id}."
-                )
-            # Decrypt and append
-            ret.append(Payload.FromString(self.decrypt(p.data)))
-        return ret
+    def decode_payload(self, p: Payload) -> Payload:
+        # Ignore ones w/out our expected encoding
+        if p.metadata.get("encoding", b"").decode() != "binary/encrypted":
+            return p
+        key_id = p.metadata.get("encryption-key-id", b"").decode()
+        # Decrypt, then decompress if it was compressed
+        compression = p.metadata.get("encryption-compression", b"").decode()
+        data = decrypt(
+            self.decryption_key(key_id),
+            p.data,
+            compression_associated_data(compression),
+        )
+        if compression:
+            data = decompress(compression, data)
+        return Payload.FromString(data)
+
+    def encryption_key(self) -> Tuple[str, AESGCM]:
+        """The ID and cipher of the key new payloads are encrypted with."""
+        return self.key_id, self.encryptor
+
+    def decryption_key(self, key_id: str) -> AESGCM:
+        """The cipher of the key a payload was encrypted with."""
+        # Confirm our key ID is the same
+        if key_id != self.key_id:
+            raise ValueError(
+                f"Unrecognized key ID {key_id}. Current key ID is {self.key_id}."
+            )
+        return self.encryptor
 
     def encrypt(self, data: bytes) -> bytes:
-        nonce = os.urandom(12)
-        return nonce + self.encryptor.encrypt(nonce, data, None)
+        """Encrypt data with the key new payloads are encrypted with."""
+        return encrypt(self.encryption_key()[1], data)
 
-    def decrypt(self, data: bytes) -> bytes:
-        return self.encryptor.decrypt(data[:12], data[12:], None)
+    def decrypt(self, data: bytes, key_id: Optional[str] = None) -> bytes:
+        """Decrypt data encrypted with the given key, by default the one new
+        payloads are encrypted with."""
+        if key_id is None:
+            key_id = self.encryption_key()[0]
+        return decrypt(self.decryption_key(key_id), data)
@@ -1,14 +1,92 @@
+import argparse
+import multiprocessing
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from functools import partial
-from typing import Awaitable, Callable, Iterable, List
+from typing import Any, Awaitable, Callable, List, Optional, Sequence
 
 from aiohttp import hdrs, web
-from google.protobuf import json_format
+from google.protobuf import descriptor_pb2, descriptor_pool, json_format, message
+from google.protobuf.message_factory import GetMessageClass
 from temporalio.api.common.v1 import Payload, Payloads
+from temporalio.converter import PayloadCodec
 
 from encryption.codec import EncryptionCodec
+from encryption.codec_server_metrics import ROUTES, CodecServerMetrics
+from encryption.decode_cache import CachingCodec, DecodeCache
+from encryption.keyring import FileKeyring, KeyringEncryptionCodec
 
+JSON = "application/json"
+PROTOBUF = "application/x-protobuf"
+CONTENT_TYPES = (JSON, PROTOBUF)
+# aiohttp's default of 1 MiB is too small for batches of large payloads
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+def _payloads_batch_class() -> Any:
+    # Built at runtime so the sample needs no generated code. Equivalent to:
+    #
+    #   package encryption;
+    #   import "temporal/api/common/v1/message.proto";
+    #   message PayloadsBatch {
+    #     repeated temporal.api.common.v1.Payloads batch = 1;
+    #   }
+    file = descriptor_pb2.FileDescriptorProto(
+        name="encryption/codec_server.proto",
+        package="encryption",
+        dependency=[Payloads.DESCRIPTOR.file.name],
+        syntax="proto3",
+    )
+    file.message_type.add(name="PayloadsBatch").field.add(
+        name="batch",
+        number=1,
+        label=descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED,
+        type=descriptor_pb2.FieldDescriptorProto.TYPE_MESSAGE,
+        type_name=f".{Payloads.DESCRIPTOR.full_name}",
+    )
+    pool = descriptor_pool.Default()
+    pool.Add(file)
+    return GetMessageClass(pool.FindMessageTypeByName("encryption.PayloadsBatch"))
+
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+# A list of payload sets, the body of the batch endpoint
+PayloadsBatch = _payloads_batch_class()
+
+
+def response_content_type(req: web.Request) -> str:
+    """The supported content type the request's Accept header prefers.
+
+    Responses are in the request's own content type when the header is absent
+    or accepts neither, e.g. ``*/*``.
+    """
+    best, best_quality = req.content_type, 0.0
+    for accepted in req.headers.get(hdrs.ACCEPT, "").split(","):
+        content_type, *params = [part.strip() for part in accepted.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if content_type in CONTENT_TYPES and quality > best_quality:
+            best, best_quality = content_type, quality
+    return best
+
+
+def build_codec_server(
+    codec: Optional[PayloadCodec] = None, metrics: Optional[CodecServerMetrics] = None
+) -> web.Application:
+    payload_codec = codec or EncryptionCodec()
+    server_metrics = metrics or CodecServerMetrics()
 
-def build_codec_server() -> web.Application:
     # Cors handler
     async def cors_options(req: web.Request) -> web.Response:
         resp = web.Response()
@@ -18,35 +96,236 @@ def build_codec_server() -> web.Application:
             resp.headers[hdrs.ACCESS_CONTROL_ALLOW_HEADERS] = "content-type,x-namespace"
         return resp
 
+    # Read a message as JSON or binary protobuf, depending on the content type
+    async def read(req: web.Request, msg: message.Message) -> None:
+        if req.content_type not in CONTENT_TYPES:
+            raise web.HTTPUnsupportedMediaType(
+                text=f"Content type must be one of {', '.join(CONTENT_TYPES)}"
+            )
+        body = await req.read()
+        try:
+            if req.content_type == PROTOBUF:
+                msg.ParseFromString(body)
+            else:
+                json_format.Parse(body, msg)
+        except (json_format.ParseError, message.DecodeError) as err:
+            raise web.HTTPBadRequest(text=f"Invalid {req.content_type} body: {err}")
+
+    # Write a message in the content type the client accepts, with CORS applied
+    async def respond(req: web.Request, msg: message.Message) -> web.Response:
+        resp = await cors_options(req)
+        resp.content_type = response_content_type(req)
+        if resp.content_type == PROTOBUF:
+            resp.body = msg.SerializeToString()
+        else:
+            resp.text = json_format.MessageToJson(msg)
+        return resp
+
     # General purpose payloads-to-payloads
     async def apply(
-        fn: Callable[[Iterable[Payload]], Awaitable[List[Payload]]], req: web.Request
+        fn: Callable[[Sequence[Payload]], Awaitable[List[Payload]]], req: web.Request
     ) -> web.Response:
-        # Read payloads as JSON
-        assert req.content_type == "application/json"
-        payloads = json_format.Parse(await req.read(), Payloads())
+        payloads = Payloads()
+        await read(req, payloads)
+        return await respond(req, Payloads(payloads=await fn(payloads.payloads)))
 
-        # Apply
-        payloads = Payloads(payloads=await fn(payloads.payloads))
+    # Many payload sets in one request, e.g. all the events of a history
+    async def apply_batch(
+        fn: Callable[[Sequence[Payload]], Awaitable[List[Payload]]], req: web.Request
+    ) -> web.Response:
+        batch = PayloadsBatch()
+        await read(req, batch)
+        # One codec call for the whole batch, so offloaded payloads of all
+        # sets are handled concurrently, then split back into the sets
+        results = iter(await fn([p for s in batch.batch for p in s.payloads]))
+        return await respond(
+            req,
+            PayloadsBatch(
+                batch=[
+                    Payloads(payloads=[next(results) for _ in s.payloads])
+                    for s in batch.batch
+                ]
+            ),
+        )
 
-        # Apply CORS and return JSON
-        resp = await cors_options(req)
-        resp.content_type = "application/json"
-        resp.text = json_format.MessageToJson(payloads)
-        return resp
+    # Decode, counting what was decoded
+    async def decode(payloads: Sequence[Payload]) -> List[Payload]:
+        decoded = await payload_codec.decode(payloads)
+        server_metrics.add("codec_server_decoded_payloads_total", len(payloads))
+        server_metrics.add(
+            "codec_server_decoded_bytes_total", sum(len(p.data) for p in payloads)
+        )
+        return decoded
+
+    # Time each codec request, whether it succeeds or not
+    @web.middleware
+    async def record_latency(
+        request: web.Request, handler: Handler
+    ) -> web.StreamResponse:
+        start = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource else None
+            if request.method == hdrs.METH_POST and route in ROUTES:
+                server_metrics.observe(route, time.perf_counter() - start)
+
+    async def render_metrics(req: web.Request) -> web.Response:
+        return web.Response(text=server_metrics.render(), content_type="text/plain")
 
     # Build app
-    codec = EncryptionCodec()
-    app = web.Application()
+    app = web.Application(
+        client_max_size=MAX_REQUEST_BYTES, middlewares=[record_latency]
+    )
     app.add_routes(
         [
-            web.post("/encode", partial(apply, codec.encode)),
-            web.post("/decode", partial(apply, codec.decode)),
+            web.post("/encode", partial(apply, payload_codec.encode)),
+            web.post("/decode", partial(apply, decode)),
             web.options("/decode", cors_options),
+            web.post("/decode/batch", partial(apply_batch, decode)),
+            web.options("/decode/batch", cors_options),
+            web.get("/metrics", render_metrics),
         ]
     )
     return app
 
 
+@dataclass
+class CodecServerOptions:
+    host: str = "127.0.0.1"
+    port: int = 8081
+    workers: int = 1
+    # Threads per worker that payloads of at least offload_threshold bytes
+    # are decrypted on
+    threads: int = 4
+    offload_threshold: int = 64 * 1024
+    # Keyring file for KeyringEncryptionCodec, the sample's key if not set
+    keyring: Optional[str] = None
+    # Memory for caching decoded payloads per worker, no cache if 0, and how
+    # long a decoded payload may be served from it
+    cache_bytes: int = 0
+    cache_ttl: float = 300.0
+    # Share one listening socket between the workers instead of giving each
+    # its own with SO_REUSEPORT. Linux spreads connections evenly over
+    # SO_REUSEPORT sockets, other platforms may not.
+    shared_socket: bool = sys.platform != "linux"
+
+
+def _run_worker(
+    options: CodecServerOptions,
+    metrics: CodecServerMetrics,
+    sock: Optional[socket.socket],
+) -> None:
+    executor = ThreadPoolExecutor(options.threads)
+    codec: EncryptionCodec
+    if options.keyring:
+        codec = KeyringEncryptionCodec(
+            FileKeyring(options.keyring),
+            offload_threshold=options.offload_threshold,
+            executor=executor,
+        )
+    else:
+        codec = EncryptionCodec(
+            offload_threshold=options.offload_threshold, executor=executor
+        )
+    server_codec: PayloadCodec = codec
+    if options.cache_bytes:
+        server_codec = CachingCodec(
+            codec, DecodeCache(options.cache_bytes, options.cache_ttl, metrics)
+        )
+    app = build_codec_server(server_codec, metrics)
+    if sock:
+        web.run_app(app, sock=sock, print=None)
+    else:
+        web.run_app(
+            app,
+            host=options.host,
+            port=options.port,
+            reuse_port=options.workers > 1,
+            print=None,
+        )
+    executor.shutdown()
+
+
+def serve(options: CodecServerOptions) -> None:
+    """Run the codec server in ``options.workers`` processes on one port.
+
+    Requests are spread over the processes by the kernel, either through one
+    socket per worker bound with SO_REUSEPORT or one socket bound before the
+    workers start and shared by all of them.
+    """
+    metrics = CodecServerMetrics()
+    print(
+        f"Codec server on http://{options.host}:{options.port} "
+        f"with {options.workers} worker processes"
+    )
+    if options.workers == 1:
+        _run_worker(options, metrics, None)
+        return
+    sock = None
+    if options.shared_socket:
+        sock = socket.create_server((options.host, options.port))
+    workers = [
+        multiprocessing.Process(
+            target=_run_worker,
+            args=(options, metrics, sock),
+            name=f"codec-server-{i}",
+        )
+        for i in range(options.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Stop the workers along with the launcher. On Ctrl-C they get the
+    # interrupt themselves.
+    def stop_workers(*_: object) -> None:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+
+def main() -> None:
+    """Run the codec server, optionally as several processes sharing a port."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    defaults = CodecServerOptions()
+    parser.add_argument("--host", default=defaults.host)
+    parser.add_argument("--port", type=int, default=defaults.port)
+    parser.add_argument("--workers", type=int, default=defaults.workers)
+    parser.add_argument(
+        "--threads", type=int, default=defaults.threads, help="Per worker"
+    )
+    parser.add_argument(
+        "--offload-threshold", type=int, default=defaults.offload_threshold
+    )
+    parser.add_argument("--keyring", help="Keyring file to decode with")
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=0,
+        help="Memory per worker for caching decoded payloads, off if 0",
+    )
+    parser.add_argument(
+        "--cache-ttl", type=float, default=defaults.cache_ttl, help="Seconds"
+    )
+    parser.add_argument(
+        "--shared-socket",
+        action="store_true",
+        default=defaults.shared_socket,
+        help="Share one socket between workers instead of using SO_REUSEPORT",
+    )
+    args = vars(parser.parse_args())
+    args["cache_bytes"] = args.pop("cache_mb") * 1024 * 1024
+    serve(CodecServerOptions(**args))
+
+
 if __name__ == "__main__":
-    web.run_app(build_codec_server(), host="127.0.0.1", port=8081)
+    main()
@@ -0,0 +1,105 @@
+import multiprocessing
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+# Endpoints whose latency is recorded
+ROUTES = ("/encode", "/decode", "/decode/batch")
+
+LATENCY_METRIC = "codec_server_request_duration_seconds"
+LATENCY_BUCKETS: Sequence[float] = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# Name and help of each counter, in Prometheus' naming
+COUNTERS: Dict[str, str] = {
+    "codec_server_decoded_bytes_total": "Bytes of encoded payload data decoded",
+    "codec_server_decoded_payloads_total": "Payloads decoded",
+    "codec_server_decode_cache_hits_total": "Payloads decoded from the cache",
+    "codec_server_decode_cache_misses_total": "Payloads not found in the cache",
+    "codec_server_decode_cache_evictions_total": "Entries evicted to make room",
+    "codec_server_decode_cache_expirations_total": "Entries found expired",
+}
+GAUGES: Dict[str, str] = {
+    "codec_server_decode_cache_bytes": "Memory held by decode cache entries",
+}
+
+
+class CodecServerMetrics:
+    """Request latency and decode counters of the codec server.
+
+    Values live in shared memory, so every worker process of a launcher
+    records into and reports the same totals, whichever worker a scrape of
+    ``/metrics`` reaches. Create it before starting the workers and pass it to
+    each of them.
+    """
+
+    def __init__(self) -> None:
+        # Per route: a count for each bucket and one past the last, then sum
+        self._histogram_size = len(LATENCY_BUCKETS) + 2
+        # Then a value for each counter and gauge. Gauges are changed by
+        # adding too, so the value is the total over all workers.
+        self._counters = {
+            name: len(ROUTES) * self._histogram_size + i
+            for i, name in enumerate([*COUNTERS, *GAUGES])
+        }
+        self._values = multiprocessing.Array(
+            "d", len(ROUTES) * self._histogram_size + len(self._counters)
+        )
+
+    def observe(self, route: str, seconds: float) -> None:
+        start = ROUTES.index(route) * self._histogram_size
+        with self._values.get_lock():
+            self._values[start + bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self._values[start + self._histogram_size - 1] += seconds
+
+    def add(self, counter: str, value: float) -> None:
+        with self._values.get_lock():
+            self._values[self._counters[counter]] += value
+
+    def get(self, counter: str) -> float:
+        return self._values[self._counters[counter]]
+
+    def latency(self, route: str) -> Tuple[List[float], float]:
+        """Cumulative bucket counts, ending with the total count, and sum."""
+        start = ROUTES.index(route) * self._histogram_size
+        with self._values.get_lock():
+            values = self._values[start : start + self._histogram_size]
+        cumulative: List[float] = []
+        for count in values[:-1]:
+            cumulative.append((cumulative[-1] if cumulative else 0) + count)
+        return cumulative, values[-1]
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {LATENCY_METRIC} Time taken to handle a codec request",
+            f"# TYPE {LATENCY_METRIC} histogram",
+        ]
+        for route in ROUTES:
+            buckets, total = self.latency(route)
+            bounds = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+            labels = f'route="{route}"'
+            for bound, count in zip(bounds, buckets):
+                lines.append(
+                    f'{LATENCY_METRIC}_bucket{{{labels},le="{bound}"}} {int(count)}'
+                )
+            lines.append(f"{LATENCY_METRIC}_sum{{{labels}}} {total}")
+            lines.append(f"{LATENCY_METRIC}_count{{{labels}}} {int(buckets[-1])}")
+        for kind, metrics in (("counter", COUNTERS), ("gauge", GAUGES)):
+            for name, description in metrics.items():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {int(self.get(name))}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,137 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from temporalio.api.common.v1 import Payload
+from temporalio.converter import PayloadCodec
+
+from encryption.codec_server_metrics import CodecServerMetrics
+
+# Rough memory of a cache entry beyond the decoded payload's bytes: the
+# digest, the entry tuple, the ordered dict's node and the message object
+ENTRY_OVERHEAD_BYTES = 256
+
+
+class _Entry(NamedTuple):
+    payload: Payload
+    size: int
+    expires: float
+
+
+def payload_digest(p: Payload) -> bytes:
+    """SHA-256 of the payload's metadata and data as it arrived."""
+    # Deterministic, so the metadata map serializes in the same order each time
+    return hashlib.sha256(p.SerializeToString(deterministic=True)).digest()
+
+
+class DecodeCache:
+    """LRU of decoded payloads, keyed by the digest of the encoded payload.
+
+    Bounded by ``max_bytes`` of decoded payloads, with entries of more than a
+    quarter of that not cached at all so one huge payload doesn't flush
+    everything else. Entries expire ``ttl`` seconds after they are added,
+    however often they are hit, which bounds how long a plaintext outlives
+    e.g. the removal of its key from a keyring. Entries are only ever held in
+    this process's memory. Not thread safe, use it from one event loop.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        metrics: Optional[CodecServerMetrics] = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.metrics = metrics
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[bytes, _Entry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, digest: bytes) -> Optional[Payload]:
+        entry = self._entries.get(digest)
+        if entry is not None and entry.expires <= time.monotonic():
+            self._remove(digest, "codec_server_decode_cache_expirations_total")
+            entry = None
+        if entry is None:
+            self.misses += 1
+            self._count("codec_server_decode_cache_misses_total", 1)
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        self._count("codec_server_decode_cache_hits_total", 1)
+        return entry.payload
+
+    def put(self, digest: bytes, p: Payload) -> None:
+        size = p.ByteSize() + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes // 4:
+            return
+        if digest in self._entries:
+            self._remove(digest, None)
+        self._entries[digest] = _Entry(p, size, time.monotonic() + self.ttl)
+        self.size += size
+        self._count("codec_server_decode_cache_bytes", size)
+        while self.size > self.max_bytes:
+            self._remove(
+                next(iter(self._entries)), "codec_server_decode_cache_evictions_total"
+            )
+
+    def clear(self) -> None:
+        self._count("codec_server_decode_cache_bytes", -self.size)
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, digest: bytes, counter: Optional[str]) -> None:
+        entry = self._entries.pop(digest)
+        self.size -= entry.size
+        self._count("codec_server_decode_cache_bytes", -entry.size)
+        if counter:
+            self._count(counter, 1)
+
+    def _count(self, name: str, value: float) -> None:
+        if self.metrics:
+            self.metrics.add(name, value)
+
+
+class CachingCodec(PayloadCodec):
+    """Codec that serves decodes from a :class:`DecodeCache` where it can and
+    passes everything else to the wrapped codec.
+
+    Payloads the wrapped codec returns unchanged, i.e. ones that weren't
+    encoded by it, aren't cached.
+    """
+
+    def __init__(self, codec: PayloadCodec, cache: DecodeCache) -> None:
+        self.codec = codec
+        self.cache = cache
+
+    async def encode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        return await self.codec.encode(payloads)
+
+    async def decode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        results: List[Optional[Payload]] = []
+        misses: List[Tuple[int, bytes, Payload]] = []
+        for p in payloads:
+            digest = payload_digest(p)
+            decoded = self.cache.get(digest)
+            if decoded is None:
+                misses.append((len(results), digest, p))
+            results.append(decoded)
+        if misses:
+            # The misses are decoded in one call, so they may run concurrently
+            decoded_misses = await self.codec.decode([p for _, _, p in misses])
+            for (i, digest, p), decoded in zip(misses, decoded_misses):
+                results[i] = decoded
+                if decoded is not p:
+                    self.cache.put(digest, decoded)
+        return results  # type: ignore[return-value]
@@ -0,0 +1,219 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from encryption.codec import EncryptionCodec
+
+logger = logging.getLogger(__name__)
+
+# Enough for every key a worker sees across many rotations
+AESGCM_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=AESGCM_CACHE_SIZE)
+def cached_aesgcm(key: bytes) -> AESGCM:
+    """An AESGCM for the key, constructed once and reused while it's in use.
+
+    Keyed by the key bytes rather than the key ID, so a key ID that is reused
+    for different key material can never pick up a stale cipher.
+    """
+    return AESGCM(key)
+
+
+@dataclass(frozen=True)
+class Keyring:
+    """The key new payloads are encrypted with, and every key still in use."""
+
+    active_key_id: str
+    keys: Dict[str, bytes]
+
+    def __post_init__(self) -> None:
+        if self.active_key_id not in self.keys:
+            raise ValueError(f"Active key ID {self.active_key_id} is not a known key")
+        for key_id, key in self.keys.items():
+            if len(key) not in (16, 24, 32):
+                raise ValueError(f"Key {key_id} is not a 128, 192 or 256 bit key")
+
+    @staticmethod
+    def from_json(data: str) -> "Keyring":
+        """Parse ``{"active": "<key ID>", "keys": {"<key ID>": "<base64 key>"}}``."""
+        raw = json.loads(data)
+        return Keyring(
+            active_key_id=raw["active"],
+            keys={
+                key_id: base64.b64decode(key, validate=True)
+                for key_id, key in raw["keys"].items()
+            },
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "active": self.active_key_id,
+                "keys": {
+                    key_id: base64.b64encode(key).decode()
+                    for key_id, key in self.keys.items()
+                },
+            },
+            indent=2,
+        )
+
+
+class FileKeyring:
+    """A keyring read from a JSON file and read again when the file changes.
+
+    The file is checked at most once every ``check_interval`` seconds, with a
+    stat rather than a read, so calling :meth:`get` for every payload is
+    cheap. A file that fails to load, e.g. a half-written one, is logged and
+    the keyring loaded last is kept. Write new keyrings to a temporary file
+    and rename it over the old one, as :func:`rotate` does, so readers never
+    see a partial file.
+    """
+
+    def __init__(self, path: str, check_interval: float = 1.0) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stat = self._file_stat()
+        with open(path) as f:
+            self._keyring = Keyring.from_json(f.read())
+        self._checked = time.monotonic()
+
+    def _file_stat(self) -> Tuple[int, int, int]:
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def get(self) -> Keyring:
+        if time.monotonic() - self._checked < self.check_interval:
+            return self._keyring
+        with self._lock:
+            # Another thread may have checked while we waited for the lock
+            if time.monotonic() - self._checked >= self.check_interval:
+                self._reload_if_changed()
+                self._checked = time.monotonic()
+            return self._keyring
+
+    def _reload_if_changed(self) -> None:
+        try:
+            stat = self._file_stat()
+            if stat == self._stat:
+                return
+            with open(self.path) as f:
+                keyring = Keyring.from_json(f.read())
+        except Exception:
+            logger.exception(
+                "Failed reloading keyring %s, keeping the last one", self.path
+            )
+            return
+        self._stat = stat
+        if keyring != self._keyring:
+            logger.info(
+                "Reloaded keyring %s, active key ID %s, %s keys",
+                self.path,
+                keyring.active_key_id,
+                len(keyring.keys),
+            )
+        self._keyring = keyring
+
+
+class KeyringEncryptionCodec(EncryptionCodec):
+    """An :class:`EncryptionCodec` that encrypts with the keyring's active key
+    and decrypts with any key in the keyring.
+
+    Rotating keys is a matter of adding a key to the keyring file and making
+    it active. Keep the old keys in the keyring for as long as payloads
+    encrypted with them may still need decoding.
+    """
+
+    def __init__(
+        self,
+        keyring: FileKeyring,
+        *,
+        offload_threshold: Optional[int] = None,
+        executor: Optional[Executor] = None,
+        compression: Optional[str] = None,
+        compression_threshold: int = 1024,
+    ) -> None:
+        current = keyring.get()
+        super().__init__(
+            current.active_key_id,
+            current.keys[current.active_key_id],
+            offload_threshold=offload_threshold,
+            executor=executor,
+            compression=compression,
+            compression_threshold=compression_threshold,
+        )
+        self.keyring = keyring
+
+    # The key the codec was constructed with may have been rotated out since,
+    # so these always reflect the keyring's active key
+    @property
+    def key_id(self) -> str:
+        return self.keyring.get().active_key_id
+
+    @property
+    def encryptor(self) -> AESGCM:
+        return self.encryption_key()[1]
+
+    def encryption_key(self) -> Tuple[str, AESGCM]:
+        current = self.keyring.get()
+        key_id = current.active_key_id
+        return key_id, cached_aesgcm(current.keys[key_id])
+
+    def decryption_key(self, key_id: str) -> AESGCM:
+        key = self.keyring.get().keys.get(key_id)
+        if key is None:
+            raise ValueError(f"Unrecognized key ID {key_id}, not in the keyring")
+        return cached_aesgcm(key)
+
+
+def rotate(path: str, key_id: Optional[str] = None) -> Keyring:
+    """Add a new random key to the keyring file and make it the active key.
+
+    Creates the file if it doesn't exist. Keys already in the keyring are
+    kept so payloads encrypted with them can still be decoded.
+    """
+    keys: Dict[str, bytes] = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            keys = dict(Keyring.from_json(f.read()).keys)
+    key_id = key_id or f"key-{uuid.uuid4()}"
+    if key_id in keys:
+        raise ValueError(f"Key ID {key_id} is already in the keyring")
+    keys[key_id] = AESGCM.generate_key(bit_length=256)
+    keyring = Keyring(active_key_id=key_id, keys=keys)
+    tmp_path = f"{path}.tmp"
+    # Readable by the owner only, as the file holds the keys themselves
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w") as f:
+        f.write(keyring.to_json())
+    os.replace(tmp_path, path)
+    return keyring
+
+
+def main() -> None:
+    """Add a new active key to a keyring file, creating the file if needed."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("path", help="Keyring JSON file")
+    parser.add_argument("--key-id", help="ID of the new key, random if not given")
+    args = parser.parse_args()
+    keyring = rotate(args.path, args.key_id)
+    print(
+        f"Active key ID is now {keyring.active_key_id}, "
+        f"{len(keyring.keys)} keys in {args.path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet.compaction_activities import (
+    CompactFilesActivityInput,
+    PlanCompactionActivityInput,
+    commit_compaction,
+    compact_files,
+    plan_compaction,
+)
+from cloud_export_to_parquet.data_trans_activities import (
+    DataTransAndLandActivityInput,
+    data_trans_and_land,
+)
+from cloud_export_to_parquet.history_schema import history_event_schema
+from cloud_export_to_parquet.incremental import find_markers
+from cloud_export_to_parquet.storage import LocalStorage
+from cloud_export_to_parquet.synthetic_export import (
+    make_workflow_executions_of_size,
+    write_synthetic_export,
+)
+
+
+def test_compaction_merges_and_swaps_outputs(storage: LocalStorage):
+    env = ActivityEnvironment()
+    outputs = []
+    for key in write_synthetic_export(storage, "export", "in", 3, 20_000):
+        outputs.append(
+            env.run(
+                data_trans_and_land,
+                DataTransAndLandActivityInput("export", key, "output", "out"),
+            )
+        )
+    rows = sum(pq.read_metadata(storage.path("output", k)).num_rows for k in outputs)
+    # A marker-like file that compaction must leave alone
+    storage.write("output", "out/_processed/marker.json", b"{}")
+
+    groups = env.run(plan_compaction, PlanCompactionActivityInput("output", "out"))
+    assert [sorted(g.keys) for g in groups] == [sorted(outputs)]
+
+    # Small row groups, so rows are streamed through several of them
+    compact_input = CompactFilesActivityInput(
+        "output", "out", groups[0], row_group_size_bytes=400_000
+    )
+    result = env.run(compact_files, compact_input)
+    # A retried attempt overwrites the same staging file
+    assert env.run(compact_files, compact_input) == result
+    assert [
+        o.key for p in storage.iter_pages("output", "out/_compaction/") for o in p
+    ] == [result.staging_key]
+    # Nothing is visible until the commit
+    assert not storage.exists("output", result.output_key)
+    env.run(commit_compaction, result)
+    # A retried commit is a no-op
+    env.run(commit_compaction, result)
+
+    listed = [o.key for p in storage.iter_pages("output", "out/") for o in p]
+    assert listed == ["out/_processed/marker.json", result.output_key]
+    parquet_file = pq.ParquetFile(storage.path("output", result.output_key))
+    assert parquet_file.metadata.num_rows == result.rows == rows
+    assert parquet_file.num_row_groups > 1
+    # Rows are sorted within each row group
+    for i in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(i)
+        workflow_ids = table["WorkflowId"].to_pylist()
+        assert workflow_ids == sorted(workflow_ids)
+        times = pc.cast(table["eventTime"], pa.timestamp("ns", tz="UTC")).to_pylist()
+        assert all(
+            a <= b
+            for (wa, a), (wb, b) in zip(
+                zip(workflow_ids, times), zip(workflow_ids[1:], times[1:])
+            )
+            if wa == wb
+        )
+
+
+def test_compaction_repoints_incremental_markers(storage: LocalStorage):
+    env = ActivityEnvironment()
+    keys = write_synthetic_export(storage, "export", "in", 3, 20_000)
+    outputs = [
+        env.run(
+            data_trans_and_land,
+            DataTransAndLandActivityInput(
+                "export", key, "output", "out", incremental=True
+            ),
+        )
+        for key in keys
+    ]
+    groups = env.run(plan_compaction, PlanCompactionActivityInput("output", "out"))
+    assert len(groups[0].marker_keys) == 3
+    result = env.run(
+        compact_files, CompactFilesActivityInput("output", "out", groups[0])
+    )
+    env.run(commit_compaction, result)
+    env.run(commit_compaction, result)
+
+    markers = [find_markers(storage, "output", "out", key)[0] for key in keys]
+    assert [m.output_keys for m in markers] == [[], [], []]
+    assert [m.compacted_keys for m in markers] == [[result.output_key]] * 3
+    # Unchanged files resolve to the merged file
+    activity_input = DataTransAndLandActivityInput(
+        "export", keys[0], "output", "out", incremental=True
+    )
+    assert env.run(data_trans_and_land, activity_input) == result.output_key
+
+    # Converting a changed file writes it again but leaves the merged file,
+    # which holds the other files' rows, in place
+    changed = make_workflow_executions_of_size(10_000, seed=10)
+    storage.write("export", keys[0], changed.SerializeToString())
+    assert env.run(data_trans_and_land, activity_input) == outputs[0]
+    assert storage.exists("output", result.output_key)
+
+
+def test_compaction_merges_fixed_and_inferred_schema_files(storage: LocalStorage):
+    env = ActivityEnvironment()
+    keys = write_synthetic_export(storage, "export", "in", 2, 20_000)
+    outputs = [
+        env.run(
+            data_trans_and_land,
+            DataTransAndLandActivityInput(
+                "export", key, "output", "out", fixed_schema=fixed_schema
+            ),
+        )
+        for key, fixed_schema in zip(keys, [True, False])
+    ]
+    fixed, inferred = [pq.read_table(storage.path("output", k)) for k in outputs]
+    assert pa.types.is_string(inferred.schema.field("eventTime").type)
+
+    groups = env.run(plan_compaction, PlanCompactionActivityInput("output", "out"))
+    result = env.run(
+        compact_files, CompactFilesActivityInput("output", "out", groups[0])
+    )
+    table = pq.read_table(storage.path("output", result.staging_key))
+    # Columns the history schema has get its types
+    history = history_event_schema()
+    timeout = "workflowExecutionStartedEventAttributes_workflowTaskTimeout"
+    for name in ["eventId", "eventTime", "eventType", timeout]:
+        assert table.schema.field(name).type == history.field(name).type
+    # Rows of the inferred file are cast, not lost
+    run_ids = set(inferred["RunId"].to_pylist())
+    merged = table.filter(pc.is_in(table["RunId"], pa.array(list(run_ids))))
+    assert merged.num_rows == inferred.num_rows
+    assert merged.num_rows + fixed.num_rows == table.num_rows
+    assert sorted(merged["eventId"].to_pylist()) == sorted(
+        int(i) for i in inferred["eventId"].to_pylist()
+    )
+    assert sorted(
+        d.total_seconds() for d in merged[timeout].drop_null().to_pylist()
+    ) == sorted(float(d.rstrip("s")) for d in inferred[timeout].drop_null().to_pylist())
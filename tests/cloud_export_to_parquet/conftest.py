@@ -0,0 +1,18 @@
+from typing import Iterator
+
+import pytest
+
+from cloud_export_to_parquet.storage import (
+    LocalStorage,
+    configure_storage,
+    get_storage,
+)
+
+
+@pytest.fixture
+def storage(tmp_path) -> Iterator[LocalStorage]:
+    previous = get_storage()
+    storage = LocalStorage(str(tmp_path))
+    configure_storage(storage)
+    yield storage
+    configure_storage(previous)
@@ -0,0 +1,179 @@
+import dataclasses
+import os
+from dataclasses import asdict
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet import data_trans_activities
+from cloud_export_to_parquet.data_trans_activities import (
+    CreateObjectKeyManifestActivityInput,
+    DataTransAndLandActivityInput,
+    DataTransAndLandBatchActivityInput,
+    GetObjectKeysActivityInput,
+    GetObjectKeysBatchActivityInput,
+    batch_objects,
+    convert_proto_to_parquet_flatten,
+    create_object_key_manifest,
+    data_trans_and_land_batch,
+    data_trans_and_land_files,
+    get_object_keys_batch,
+    get_objects,
+)
+from cloud_export_to_parquet.history_schema import convert_proto_to_arrow_schema
+from cloud_export_to_parquet.proto_flatten import (
+    Projection,
+    convert_proto_to_arrow_flatten,
+)
+from cloud_export_to_parquet.storage import LocalStorage
+from cloud_export_to_parquet.synthetic_export import (
+    make_workflow_executions,
+    make_workflow_executions_of_size,
+    write_synthetic_export,
+)
+
+
+def test_arrow_flatten_matches_pandas_flatten():
+    wfs = make_workflow_executions(5, activities_per_workflow=2)
+    expected = convert_proto_to_parquet_flatten(wfs)
+    actual = convert_proto_to_arrow_flatten(wfs).to_pandas()
+
+    assert list(expected.columns) == list(actual.columns)
+    assert len(expected) == len(actual)
+    for column in expected.columns:
+        for want, got in zip(expected[column], actual[column]):
+            assert (pd.isna(want) and pd.isna(got)) or want == got, column
+
+
+def test_projection_drops_fields_while_walking():
+    wfs = make_workflow_executions(2, activities_per_workflow=1, memo_size=64)
+    full = convert_proto_to_arrow_flatten(wfs).column_names
+
+    no_payloads = convert_proto_to_arrow_flatten(
+        wfs, Projection(exclude_payload_fields=True)
+    ).column_names
+    assert not [c for c in no_payloads if "_memo_" in c or "_header_" in c]
+    assert set(no_payloads) < set(full)
+
+    projected = convert_proto_to_arrow_flatten(
+        wfs,
+        Projection(
+            include=["eventId", "*.workflowType", "*.activityType"],
+            exclude=["activityTaskScheduledEventAttributes"],
+        ),
+    ).column_names
+    assert projected == [
+        "WorkflowId",
+        "RunId",
+        "eventId",
+        "workflowExecutionStartedEventAttributes_workflowType_name",
+    ]
+
+
+def test_streaming_conversion_resumes_from_heartbeat_checkpoint(
+    storage: LocalStorage,
+):
+    key = write_synthetic_export(storage, "export", "in", 1, 60_000)[0]
+    activity_input = DataTransAndLandActivityInput(
+        "export",
+        key,
+        "output",
+        "out",
+        streaming=True,
+        row_group_size=70,
+        checkpoint_row_groups=2,
+    )
+    heartbeats = []
+    env = ActivityEnvironment()
+    env.on_heartbeat = lambda *details: heartbeats.append(details[0])
+
+    # Fail the first attempt when it opens its third part
+    open_write = storage.open_write
+
+    def failing_open_write(bucket: str, key: str):
+        if "-part-2" in key:
+            raise ConnectionError("worker lost")
+        return open_write(bucket, key)
+
+    storage.open_write = failing_open_write  # type: ignore[assignment]
+    with pytest.raises(ConnectionError):
+        env.run(data_trans_and_land_files, activity_input)
+    del storage.open_write
+    checkpoint = heartbeats[-1]
+    assert checkpoint.parts == 2 and not checkpoint.complete
+    size = os.path.getsize(storage.path("export", key))
+    assert 0 < checkpoint.byte_offset < size
+
+    # The retry starts from the checkpoint and only writes the remaining parts
+    env.info = dataclasses.replace(env.info, heartbeat_details=[asdict(checkpoint)])
+    output_keys = env.run(data_trans_and_land_files, activity_input)
+    assert output_keys[: len(checkpoint.output_keys)] == checkpoint.output_keys
+    assert heartbeats[-1].complete
+
+    wfs = make_workflow_executions_of_size(60_000, seed=0)
+    rows = sum(
+        pq.read_metadata(storage.path("output", k)).num_rows for k in output_keys
+    )
+    assert rows == sum(len(wf.history.events) for wf in wfs.items)
+    assert heartbeats[-1].executions_converted == len(wfs.items)
+
+
+def test_batch_conversion_combines_small_files(storage: LocalStorage):
+    keys = write_synthetic_export(storage, "export", "in", 4, 20_000)
+    storage.write("export", keys[2], b"not a proto")
+    env = ActivityEnvironment()
+
+    objects = env.run(get_objects, GetObjectKeysActivityInput("export", "in"))
+    assert [obj.key for obj in objects] == keys
+    size = objects[0].size
+    assert batch_objects(objects, 2 * size, 10) == [keys[:2], keys[2:]]
+    assert batch_objects(objects, 10 * size, 3) == [keys[:3], keys[3:]]
+    assert batch_objects(objects, 1, 10) == [[key] for key in keys]
+
+    result = env.run(
+        data_trans_and_land_batch,
+        DataTransAndLandBatchActivityInput("export", keys, "output", "out"),
+    )
+    assert [r.key for r in result.results] == keys
+    failed = result.results[2]
+    assert failed.error and not failed.events
+    assert [r.error for i, r in enumerate(result.results) if i != 2] == [None] * 3
+    assert len(result.output_keys) == 1
+    table = pq.read_table(storage.path("output", result.output_keys[0]))
+    assert table.num_rows == sum(r.events for r in result.results)
+    # Rows keep the order of the keys
+    expected = [
+        convert_proto_to_arrow_schema(make_workflow_executions_of_size(20_000, seed=i))
+        for i in (0, 1, 3)
+    ]
+    assert table["RunId"].to_pylist() == [
+        run_id for t in expected for run_id in t["RunId"].to_pylist()
+    ]
+
+
+def test_key_manifest_is_read_batch_by_batch(storage: LocalStorage, monkeypatch):
+    keys = [f"in/file-{i}.proto" for i in range(5)]
+    for key in keys:
+        storage.write("export", key, b"")
+    env = ActivityEnvironment()
+    manifest = env.run(
+        create_object_key_manifest,
+        CreateObjectKeyManifestActivityInput(
+            "export", "in", "output", "manifests/keys.txt", batch_size=2
+        ),
+    )
+    assert manifest.total_keys == 5
+
+    # Batches span several reads and end part way through one
+    monkeypatch.setattr(data_trans_activities, "MANIFEST_READ_SIZE", 7)
+    batches = []
+    offset = 0
+    while offset < manifest.size:
+        batch = env.run(
+            get_object_keys_batch, GetObjectKeysBatchActivityInput(manifest, offset)
+        )
+        batches.append(batch.keys)
+        offset = batch.next_offset
+    assert batches == [keys[:2], keys[2:4], keys[4:]]
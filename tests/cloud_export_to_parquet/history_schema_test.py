@@ -0,0 +1,70 @@
+import pyarrow as pa
+
+from cloud_export_to_parquet.history_schema import (
+    ENUM_TYPE,
+    TIMESTAMP_TYPE,
+    convert_proto_to_arrow_schema,
+    history_event_schema,
+)
+from cloud_export_to_parquet.partitioning import partition_table
+from cloud_export_to_parquet.proto_flatten import (
+    Projection,
+    convert_proto_to_arrow_flatten,
+)
+from cloud_export_to_parquet.synthetic_export import make_workflow_executions
+
+
+def test_every_file_gets_the_same_typed_schema():
+    small = make_workflow_executions(1, activities_per_workflow=0, seed=1)
+    large = make_workflow_executions(3, activities_per_workflow=2, memo_size=32)
+    small_table = convert_proto_to_arrow_schema(small)
+    large_table = convert_proto_to_arrow_schema(large)
+    assert small_table.schema == large_table.schema == history_event_schema()
+
+    schema = large_table.schema
+    assert schema.names[:2] == ["WorkflowId", "RunId"]
+    assert schema.field("eventId").type == pa.int64()
+    assert schema.field("eventTime").type == TIMESTAMP_TYPE
+    assert schema.field("eventType").type == ENUM_TYPE
+    assert schema.field(
+        "workflowExecutionStartedEventAttributes_workflowRunTimeout"
+    ).type == pa.duration("us")
+    assert pa.types.is_map(
+        schema.field("workflowExecutionStartedEventAttributes_memo_fields").type
+    )
+    # Failures nest failures, so the cause is kept as JSON
+    assert (
+        schema.field("workflowExecutionFailedEventAttributes_failure_cause").type
+        == pa.string()
+    )
+
+    # Columns the inferred flattener finds hold the same values
+    inferred = convert_proto_to_arrow_flatten(large)
+    assert large_table["eventId"].to_pylist() == [
+        int(v) for v in inferred["eventId"].to_pylist()
+    ]
+    assert large_table["eventType"].to_pylist() == inferred["eventType"].to_pylist()
+
+
+def test_projection_and_partitioning_keep_the_schema_fixed():
+    projection = Projection(include=["eventType", "**.workflowType"])
+    schema = history_event_schema(projection)
+    assert history_event_schema(projection) is schema
+    assert "eventId" not in schema.names
+    assert "workflowExecutionStartedEventAttributes_workflowType_name" in schema.names
+    assert not [
+        name
+        for name in history_event_schema(Projection(exclude_payload_fields=True)).names
+        if "_memo" in name or "_header" in name
+    ]
+
+    # Partitions of different exports list the same columns for an event type
+    partitions = [
+        dict(partition_table(convert_proto_to_arrow_schema(wfs)))
+        for wfs in (
+            make_workflow_executions(1, activities_per_workflow=1, seed=2),
+            make_workflow_executions(2, activities_per_workflow=3, seed=3),
+        )
+    ]
+    path = "eventType=EVENT_TYPE_ACTIVITY_TASK_SCHEDULED"
+    assert partitions[0][path].schema == partitions[1][path].schema
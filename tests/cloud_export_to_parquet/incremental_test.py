@@ -0,0 +1,22 @@
+from cloud_export_to_parquet.incremental import (
+    _parse_marker_key,
+    is_processed,
+    marker_key,
+    output_name,
+)
+
+
+def test_marker_keys_round_trip_through_listing():
+    object_key = "temporal-workflow-history/export/ns/2024/01/01/00/00/export.proto"
+    assert output_name(object_key) == output_name(object_key)
+    assert output_name(object_key).startswith("export-")
+    assert output_name(object_key) != output_name(
+        object_key.replace("/00/00", "/01/00")
+    )
+
+    key = marker_key("out", object_key, '"abc123"')
+    parsed = _parse_marker_key("out", key)
+    assert parsed is not None
+    processed = {parsed}
+    assert is_processed(processed, object_key, '"abc123"')
+    assert not is_processed(processed, object_key, '"def456"')
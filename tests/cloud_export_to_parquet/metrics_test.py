@@ -0,0 +1,75 @@
+import socket
+import time
+import urllib.request
+
+from temporalio.common import MetricMeter
+from temporalio.runtime import PrometheusConfig, Runtime, TelemetryConfig
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet.data_trans_activities import (
+    DataTransAndLandActivityInput,
+    data_trans_and_land_files,
+)
+from cloud_export_to_parquet.metrics import (
+    HISTOGRAM_BUCKET_OVERRIDES,
+    STAGES,
+    StageMetrics,
+)
+from cloud_export_to_parquet.storage import LocalStorage
+from cloud_export_to_parquet.synthetic_export import write_synthetic_export
+
+
+def test_nested_stages_are_timed_exclusively():
+    metrics = StageMetrics(MetricMeter.noop)
+    with metrics.stage("encode"):
+        time.sleep(0.02)
+        with metrics.stage("upload"):
+            time.sleep(0.05)
+    assert 0.05 <= metrics.seconds["upload"]
+    assert 0.02 <= metrics.seconds["encode"] < 0.05
+    metrics.publish()
+    assert not any(metrics.seconds.values())
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_stage_metrics_reach_prometheus(storage: LocalStorage):
+    port = _free_port()
+    runtime = Runtime(
+        telemetry=TelemetryConfig(
+            metrics=PrometheusConfig(
+                bind_address=f"127.0.0.1:{port}",
+                histogram_bucket_overrides=HISTOGRAM_BUCKET_OVERRIDES,
+            )
+        )
+    )
+    key = write_synthetic_export(storage, "export", "in", 1, 50_000)[0]
+    env = ActivityEnvironment()
+    env.metric_meter = runtime.metric_meter
+    env.run(
+        data_trans_and_land_files,
+        DataTransAndLandActivityInput("export", key, "output", "out", streaming=True),
+    )
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+        lines = response.read().decode().splitlines()
+    for stage in STAGES:
+        counted = [
+            line
+            for line in lines
+            if line.startswith("parquet_export_stage_bytes{")
+            and f'stage="{stage}"' in line
+        ]
+        assert counted and float(counted[0].rsplit(" ", 1)[1]) > 0, stage
+        # Buckets reach well past the SDK's default of 10 seconds
+        assert [
+            line
+            for line in lines
+            if line.startswith("parquet_export_stage_duration_bucket{")
+            and f'stage="{stage}"' in line
+            and 'le="900000"' in line
+        ], stage
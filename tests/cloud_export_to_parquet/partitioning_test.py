@@ -0,0 +1,22 @@
+from cloud_export_to_parquet.partitioning import partition_table
+from cloud_export_to_parquet.proto_flatten import convert_proto_to_arrow_flatten
+from cloud_export_to_parquet.synthetic_export import make_workflow_executions
+
+
+def test_partition_table_by_event_and_workflow_type():
+    table = convert_proto_to_arrow_flatten(make_workflow_executions(3))
+    partitions = dict(partition_table(table, by_event_type=True, by_workflow_type=True))
+
+    assert sum(p.num_rows for p in partitions.values()) == table.num_rows
+    scheduled = partitions[
+        "eventType=EVENT_TYPE_ACTIVITY_TASK_SCHEDULED/workflowType=SyntheticWorkflow"
+    ]
+    assert scheduled.num_rows == 15
+    assert "eventType" not in scheduled.column_names
+    assert "WorkflowId" in scheduled.column_names
+    # Only the scheduled event's attributes survive in its partition
+    assert all(
+        "EventAttributes_" not in name
+        or name.startswith("activityTaskScheduledEventAttributes_")
+        for name in scheduled.column_names
+    )
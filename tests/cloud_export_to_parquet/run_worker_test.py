@@ -0,0 +1,46 @@
+import pickle
+from typing import Any, List
+
+import pyarrow.parquet as pq
+import pytest
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet.data_trans_activities import (
+    DataTransAndLandActivityInput,
+    data_trans_and_land_files,
+)
+from cloud_export_to_parquet.run_worker import conversion_executor
+from cloud_export_to_parquet.storage import LocalStorage
+from cloud_export_to_parquet.synthetic_export import (
+    make_workflow_executions_of_size,
+    write_synthetic_export,
+)
+
+
+def _run_conversion(activity_input: DataTransAndLandActivityInput) -> List[str]:
+    env = ActivityEnvironment()
+
+    # In a worker, heartbeat details are sent to the parent process
+    def on_heartbeat(*details: Any) -> None:
+        pickle.dumps(details)
+
+    env.on_heartbeat = on_heartbeat
+    return env.run(data_trans_and_land_files, activity_input)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_conversion_runs_on_process_pool(storage: LocalStorage, streaming: bool):
+    key = write_synthetic_export(storage, "export", "in", 1, 20_000)[0]
+    activity_input = DataTransAndLandActivityInput(
+        "export", key, "output", "out", streaming=streaming
+    )
+    # Input and output cross the process boundary, and the process finds the
+    # storage it was configured with
+    with conversion_executor(1, storage) as executor:
+        output_keys = executor.submit(_run_conversion, activity_input).result()
+
+    wfs = make_workflow_executions_of_size(20_000, seed=0)
+    rows = sum(
+        pq.read_metadata(storage.path("output", k)).num_rows for k in output_keys
+    )
+    assert rows == sum(len(wf.history.events) for wf in wfs.items)
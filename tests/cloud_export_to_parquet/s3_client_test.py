@@ -0,0 +1,26 @@
+import os
+
+from cloud_export_to_parquet import s3_client
+from cloud_export_to_parquet.s3_client import S3ClientProvider
+
+
+def test_client_is_shared_until_the_process_forks(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    provider = S3ClientProvider(max_pool_connections=8)
+    client = provider.get()
+    assert provider.get() is client
+    assert client.meta.config.max_pool_connections == 8
+    client.meta.events.emit("before-send.s3.ListObjectsV2", request=None)
+    stats = provider.stats()
+    assert stats.clients_created == 1 and stats.requests_sent == 1
+
+    # A forked child sees a new PID and must not use the parent's sockets
+    parent_pid = os.getpid()
+    monkeypatch.setattr(s3_client.os, "getpid", lambda: parent_pid + 1)
+    forked = provider.get()
+    assert forked is not client and provider.get() is forked
+    assert provider.stats().clients_created == 2
+
+    provider.configure(max_pool_connections=4)
+    assert provider.get().meta.config.max_pool_connections == 4
+    assert provider.stats().clients_created == 3
@@ -0,0 +1,83 @@
+import pyarrow.parquet as pq
+import pytest
+from temporalio.exceptions import ApplicationError
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet.data_trans_activities import (
+    DataTransAndLandActivityInput,
+    GetObjectKeysActivityInput,
+    data_trans_and_land,
+    get_object_keys,
+)
+from cloud_export_to_parquet.history_schema import convert_proto_to_arrow_schema
+from cloud_export_to_parquet.storage import LocalStorage
+from cloud_export_to_parquet.synthetic_export import (
+    make_workflow_executions_of_size,
+    write_synthetic_export,
+)
+
+
+def test_local_storage_follows_s3_semantics(storage: LocalStorage):
+    storage.write("bucket", "a/b/one.txt", b"0123456789")
+    storage.write("bucket", "a/bc/two.txt", b"two")
+    writer = storage.open_write("bucket", "a/b/three.txt")
+    writer.write(b"partial")
+    # Unfinished writes are invisible and aborted ones leave nothing behind
+    assert [o.key for p in storage.iter_pages("bucket", "a/b") for o in p] == [
+        "a/b/one.txt",
+        "a/bc/two.txt",
+    ]
+    writer.abort()  # type: ignore[attr-defined]
+    assert [o.key for p in storage.iter_pages("bucket", "a/b/") for o in p] == [
+        "a/b/one.txt"
+    ]
+
+    assert storage.read_range("bucket", "a/b/one.txt", 2, 5) == b"234"
+    etag = storage.etag("bucket", "a/b/one.txt")
+    storage.write("bucket", "a/b/one.txt", b"changed")
+    assert storage.etag("bucket", "a/b/one.txt") != etag
+
+    storage.delete("bucket", "a/b/one.txt")
+    assert not list(storage.iter_pages("bucket", "a/b/"))
+    with pytest.raises(ValueError):
+        storage.path("bucket", "../escape")
+
+
+def test_synthetic_export_reaches_target_size():
+    wfs = make_workflow_executions_of_size(200_000)
+    assert 200_000 <= wfs.ByteSize() < 200_000 + wfs.items[0].ByteSize() + 6
+
+
+def test_pipeline_on_local_storage(storage: LocalStorage):
+    keys = write_synthetic_export(storage, "export", "in", 2, 50_000)
+    env = ActivityEnvironment()
+
+    listed = env.run(get_object_keys, GetObjectKeysActivityInput("export", "in"))
+    assert listed == keys
+    activity_input = DataTransAndLandActivityInput(
+        "export", keys[0], "output", "out", incremental=True
+    )
+    output_key = env.run(data_trans_and_land, activity_input)
+
+    expected = convert_proto_to_arrow_schema(
+        make_workflow_executions_of_size(50_000, seed=0)
+    )
+    assert pq.read_table(storage.path("output", output_key)).equals(expected)
+    # The first file is now recorded as processed and is no longer listed
+    assert env.run(
+        get_object_keys, GetObjectKeysActivityInput("export", "in", "output", "out")
+    ) == [keys[1]]
+
+
+def test_single_file_conversion_rejects_multi_file_options(storage: LocalStorage):
+    key = write_synthetic_export(storage, "export", "in", 1, 20_000)[0]
+    env = ActivityEnvironment()
+    for activity_input in [
+        DataTransAndLandActivityInput("export", key, "output", "out", streaming=True),
+        DataTransAndLandActivityInput(
+            "export", key, "output", "out", partition_by_event_type=True
+        ),
+    ]:
+        with pytest.raises(ApplicationError):
+            env.run(data_trans_and_land, activity_input)
+    assert not list(storage.iter_pages("output", "out"))
@@ -0,0 +1,110 @@
+import io
+from typing import Any, Dict, List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from cloud_export_to_parquet.partitioning import partition_table
+from cloud_export_to_parquet.proto_flatten import convert_proto_to_arrow_flatten
+from cloud_export_to_parquet.streaming import (
+    MIN_PART_SIZE,
+    S3MultipartWriter,
+    iter_workflow_executions,
+    write_parquet_stream,
+)
+from cloud_export_to_parquet.synthetic_export import make_workflow_executions
+
+
+class _Sink(io.BytesIO):
+    def close(self) -> None:
+        self.data = self.getvalue()
+        super().close()
+
+
+def test_iter_workflow_executions_matches_full_parse():
+    wfs = make_workflow_executions(3)
+    items = list(iter_workflow_executions(io.BytesIO(wfs.SerializeToString())))
+    assert [item.SerializeToString() for item in items] == [
+        item.SerializeToString() for item in wfs.items
+    ]
+
+
+def test_write_parquet_stream_rolls_over_on_new_columns():
+    # The first execution has no activities, so the activity event columns
+    # only show up in later row groups
+    wfs = make_workflow_executions(1, activities_per_workflow=0)
+    wfs.items.extend(make_workflow_executions(2, activities_per_workflow=2).items)
+    sinks: List[_Sink] = []
+
+    def open_sink(path: str, index: int) -> _Sink:
+        sinks.append(_Sink())
+        return sinks[-1]
+
+    num_files = write_parquet_stream(
+        iter_workflow_executions(io.BytesIO(wfs.SerializeToString())),
+        open_sink,
+        row_group_size=1,
+    )
+
+    assert num_files == 2 == len(sinks)
+    tables = [pq.read_table(pa.BufferReader(sink.data)) for sink in sinks]
+    assert [t.num_rows for t in tables] == [
+        len(wfs.items[0].history.events),
+        len(wfs.items[1].history.events) + len(wfs.items[2].history.events),
+    ]
+    expected = convert_proto_to_arrow_flatten(wfs)
+    assert set(tables[1].column_names) == set(expected.column_names)
+
+
+def test_write_parquet_stream_bounds_open_partition_files():
+    wfs = make_workflow_executions(4, activities_per_workflow=2)
+    sinks: Dict[str, List[_Sink]] = {}
+
+    def open_sink(path: str, index: int) -> _Sink:
+        assert len([s for ss in sinks.values() for s in ss if not s.closed]) < 2
+        sinks.setdefault(path, []).append(_Sink())
+        return sinks[path][-1]
+
+    write_parquet_stream(
+        iter_workflow_executions(io.BytesIO(wfs.SerializeToString())),
+        open_sink,
+        row_group_size=1,
+        partition=partition_table,
+        max_open_files=2,
+    )
+
+    # Partitions were reopened into new files, and no rows were lost
+    assert any(len(files) > 1 for files in sinks.values())
+    rows = sum(
+        pq.read_table(pa.BufferReader(sink.data)).num_rows
+        for files in sinks.values()
+        for sink in files
+    )
+    assert rows == sum(len(wf.history.events) for wf in wfs.items)
+
+
+class _FailingS3:
+    def __init__(self) -> None:
+        self.aborted: List[str] = []
+
+    def create_multipart_upload(self, **kwargs: Any) -> Dict[str, str]:
+        return {"UploadId": "upload"}
+
+    def upload_part(self, **kwargs: Any) -> Dict[str, str]:
+        return {"ETag": f"part-{kwargs['PartNumber']}"}
+
+    def complete_multipart_upload(self, **kwargs: Any) -> None:
+        raise ConnectionError("connection reset")
+
+    def abort_multipart_upload(self, **kwargs: Any) -> None:
+        self.aborted.append(kwargs["UploadId"])
+
+
+def test_multipart_upload_is_aborted_when_completion_fails():
+    s3 = _FailingS3()
+    writer = S3MultipartWriter(s3, "bucket", "key", part_size=MIN_PART_SIZE)
+    writer.write(b"x" * (MIN_PART_SIZE + 1))
+    with pytest.raises(ConnectionError):
+        writer.close()
+    assert s3.aborted == ["upload"] and writer.closed
@@ -0,0 +1,122 @@
+import uuid
+from typing import List
+
+import pytest
+from temporalio import activity
+from temporalio.client import Client, WorkflowExecutionStatus, WorkflowFailureError
+from temporalio.exceptions import ApplicationError
+from temporalio.worker import Worker
+
+from cloud_export_to_parquet.data_trans_activities import (
+    CreateObjectKeyManifestActivityInput,
+    DataTransAndLandActivityInput,
+    GetObjectKeysActivityInput,
+    GetObjectKeysBatchActivityInput,
+    ObjectKeyManifest,
+    ObjectKeysBatch,
+)
+from cloud_export_to_parquet.workflows import (
+    ProtoToParquet,
+    ProtoToParquetWorkflowInput,
+)
+
+
+@activity.defn(name="get_object_keys")
+async def get_object_keys_mocked(input: GetObjectKeysActivityInput) -> List[str]:
+    return ["file1.proto", "file2.proto", "file3.proto"]
+
+
+@activity.defn(name="data_trans_and_land_files")
+async def data_trans_and_land_mocked(
+    input: DataTransAndLandActivityInput,
+) -> List[str]:
+    if input.object_key == "file2.proto":
+        raise ApplicationError("corrupt file", non_retryable=True)
+    return [f"{input.write_path}/{input.object_key}.parquet"]
+
+
+async def test_partial_failures_are_collected(client: Client):
+    task_queue_name = str(uuid.uuid4())
+    workflow_input = ProtoToParquetWorkflowInput(
+        num_delay_hour=2,
+        export_s3_bucket="test-input-bucket",
+        namespace="test.namespace",
+        output_s3_bucket="test-output-bucket",
+        max_concurrent_activities=2,
+    )
+
+    async with Worker(
+        client,
+        task_queue=task_queue_name,
+        workflows=[ProtoToParquet],
+        activities=[get_object_keys_mocked, data_trans_and_land_mocked],
+    ):
+        with pytest.raises(WorkflowFailureError) as err:
+            await client.execute_workflow(
+                ProtoToParquet.run,
+                workflow_input,
+                id=str(uuid.uuid4()),
+                task_queue=task_queue_name,
+            )
+
+    assert isinstance(err.value.cause, ApplicationError)
+    assert err.value.cause.type == "DataTransformationFailed"
+    assert list(err.value.cause.details[0]) == ["file2.proto"]
+
+
+manifests_created: List[str] = []
+
+
+@activity.defn(name="create_object_key_manifest")
+async def create_object_key_manifest_mocked(
+    input: CreateObjectKeyManifestActivityInput,
+) -> ObjectKeyManifest:
+    manifests_created.append(input.manifest_key)
+    # One key per batch, each a byte of the manifest
+    return ObjectKeyManifest(input.manifest_bucket, input.manifest_key, 3, 1, 3)
+
+
+@activity.defn(name="get_object_keys_batch")
+async def get_object_keys_batch_mocked(
+    input: GetObjectKeysBatchActivityInput,
+) -> ObjectKeysBatch:
+    return ObjectKeysBatch([f"file{input.offset + 1}.proto"], input.offset + 1)
+
+
+async def test_manifest_batches_continue_as_new(client: Client):
+    task_queue_name = str(uuid.uuid4())
+    workflow_input = ProtoToParquetWorkflowInput(
+        num_delay_hour=2,
+        export_s3_bucket="test-input-bucket",
+        namespace="test.namespace",
+        output_s3_bucket="test-output-bucket",
+        manifest_batch_size=1,
+        manifest_batches_per_run=1,
+    )
+
+    async with Worker(
+        client,
+        task_queue=task_queue_name,
+        workflows=[ProtoToParquet],
+        activities=[
+            create_object_key_manifest_mocked,
+            get_object_keys_batch_mocked,
+            data_trans_and_land_mocked,
+        ],
+    ):
+        handle = await client.start_workflow(
+            ProtoToParquet.run,
+            workflow_input,
+            id=str(uuid.uuid4()),
+            task_queue=task_queue_name,
+        )
+        with pytest.raises(WorkflowFailureError) as err:
+            await handle.result()
+        # The handle describes the first run, which converted only file1
+        status = (await handle.describe()).status
+        assert status == WorkflowExecutionStatus.CONTINUED_AS_NEW
+
+    assert len(manifests_created) == 1
+    # The failure of the second run is reported by the last
+    assert isinstance(err.value.cause, ApplicationError)
+    assert list(err.value.cause.details[0]) == ["file2.proto"]
@@ -0,0 +1,299 @@
+import asyncio
+import dataclasses
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List
+
+import dacite
+import pytest
+import yaml
+from temporalio import activity
+from temporalio.client import (
+    Client,
+    WorkflowExecutionStatus,
+    WorkflowFailureError,
+    WorkflowHandle,
+)
+from temporalio.exceptions import ApplicationError
+from temporalio.worker import Worker
+
+from dsl.activities import DSLActivities
+from dsl.workflow import (
+    DSLInput,
+    DSLWorkflow,
+    ForeachStatement,
+    ParallelStatement,
+    SequenceStatement,
+    plan_dataflow,
+    statement_variables,
+)
+
+
+def load_dsl(name: str) -> DSLInput:
+    path = Path(__file__).parents[2] / "dsl" / name
+    return dacite.from_dict(DSLInput, yaml.safe_load(path.read_text()))
+
+
+def test_plan_dataflow_follows_variables():
+    nodes = plan_dataflow(load_dsl("workflow2.yaml").root)
+    # activity1, then the two branches, then the final activity3
+    assert [n.depends_on for n in nodes] == [[], [0], [1], [0], [3], [2, 4]]
+
+
+def test_plan_dataflow_orders_overwrites():
+    dsl_input = dacite.from_dict(
+        DSLInput,
+        {
+            "root": {
+                "sequence": {
+                    "elements": [
+                        {"activity": {"name": "a", "arguments": ["x"], "result": "r"}},
+                        {"activity": {"name": "b", "arguments": ["r"], "result": "y"}},
+                        # Must wait for b to read the first r
+                        {"activity": {"name": "c", "arguments": ["x"], "result": "r"}},
+                        {"activity": {"name": "d", "arguments": ["x"]}},
+                    ]
+                }
+            }
+        },
+    )
+    assert [n.depends_on for n in plan_dataflow(dsl_input.root)] == [
+        [],
+        [0],
+        [0, 1],
+        [],
+    ]
+
+
+def _parallel(policy: str, names: List[str], **kwargs: Any) -> DSLInput:
+    return dacite.from_dict(
+        DSLInput,
+        {
+            "root": {
+                "parallel": {
+                    "policy": policy,
+                    "branches": [
+                        {"activity": {"name": name, "arguments": ["x"], "result": name}}
+                        for name in names
+                    ],
+                    **kwargs,
+                }
+            },
+            "variables": {"x": "value"},
+        },
+    )
+
+
+def test_parallel_policies_other_than_fail_fast_are_planned_whole():
+    assert len(plan_dataflow(_parallel("fail_fast", ["a", "b"]).root)) == 2
+    nodes = plan_dataflow(_parallel("first_n", ["a", "b"], count=1).root)
+    assert len(nodes) == 1 and isinstance(nodes[0].statement, ParallelStatement)
+    with pytest.raises(dacite.WrongTypeError):
+        _parallel("fastest", ["a", "b"])
+
+
+def test_foreach_body_variables_are_its_own():
+    root = load_dsl("workflow3.yaml").root
+    assert statement_variables(root) == ({"orders", "prefix"}, {"results", "summary"})
+    # The final activity doesn't read what the foreach sets
+    nodes = plan_dataflow(root)
+    assert isinstance(nodes[0].statement, ForeachStatement)
+    assert [n.depends_on for n in nodes] == [[], []]
+
+
+async def test_dataflow_matches_tree(client: Client):
+    task_queue_name = str(uuid.uuid4())
+    activities = DSLActivities()
+    async with Worker(
+        client,
+        task_queue=task_queue_name,
+        workflows=[DSLWorkflow],
+        activities=[
+            activities.activity1,
+            activities.activity2,
+            activities.activity3,
+            activities.activity4,
+            activities.activity5,
+        ],
+    ):
+        dsl_input = load_dsl("workflow2.yaml")
+        results = [
+            await client.execute_workflow(
+                DSLWorkflow.run,
+                dataclasses.replace(
+                    dsl_input, dataflow=dataflow, max_concurrency=max_concurrency
+                ),
+                id=str(uuid.uuid4()),
+                task_queue=task_queue_name,
+            )
+            for dataflow, max_concurrency in [(False, 0), (True, 0), (True, 1)]
+        ]
+        assert results[0]["result6"]
+        assert results[0] == results[1] == results[2]
+
+
+@activity.defn(name="slow")
+async def slow_activity(arg: str) -> str:
+    while True:
+        activity.heartbeat()
+        await asyncio.sleep(0.1)
+
+
+@activity.defn(name="fail")
+async def fail_activity(arg: str) -> str:
+    raise ApplicationError("failed on purpose", non_retryable=True)
+
+
+@activity.defn(name="succeed")
+async def succeed_activity(arg: str) -> str:
+    return f"succeeded with {arg}"
+
+
+async def test_parallel_policies(client: Client):
+    task_queue_name = str(uuid.uuid4())
+
+    async def execute(dsl_input: DSLInput) -> WorkflowHandle:
+        handle = await client.start_workflow(
+            DSLWorkflow.run,
+            dsl_input,
+            id=str(uuid.uuid4()),
+            task_queue=task_queue_name,
+        )
+        try:
+            await handle.result()
+        except WorkflowFailureError:
+            pass
+        return handle
+
+    async def cancel_requests(handle: WorkflowHandle) -> int:
+        return len(
+            [
+                event
+                async for event in handle.fetch_history_events()
+                if event.HasField("activity_task_cancel_requested_event_attributes")
+            ]
+        )
+
+    async with Worker(
+        client,
+        task_queue=task_queue_name,
+        workflows=[DSLWorkflow],
+        activities=[slow_activity, fail_activity, succeed_activity],
+    ):
+        # The failure ends the block without waiting for the slow branch
+        handle = await execute(_parallel("fail_fast", ["slow", "fail"]))
+        assert (await handle.describe()).status == WorkflowExecutionStatus.FAILED
+        assert await cancel_requests(handle) == 1
+
+        handle = await execute(_parallel("wait_all", ["succeed", "fail", "fail"]))
+        with pytest.raises(WorkflowFailureError) as err:
+            await handle.result()
+        assert isinstance(err.value.cause, ApplicationError)
+        assert err.value.cause.type == "ParallelBranchesFailed"
+
+        handle = await execute(_parallel("first_n", ["succeed", "slow"], count=1))
+        result = await handle.result()
+        assert result["succeed"] == "succeeded with value" and "slow" not in result
+        assert await cancel_requests(handle) == 1
+
+
+async def test_foreach(client: Client):
+    task_queue_name = str(uuid.uuid4())
+    activities = DSLActivities()
+    async with Worker(
+        client,
+        task_queue=task_queue_name,
+        workflows=[DSLWorkflow],
+        activities=[activities.activity1, activities.activity2, activities.activity3],
+    ):
+        dsl_input = load_dsl("workflow3.yaml")
+        result = await client.execute_workflow(
+            DSLWorkflow.run,
+            dsl_input,
+            id=str(uuid.uuid4()),
+            task_queue=task_queue_name,
+        )
+        assert result["results"] == [
+            f"[result from activity3: processed [result from activity1: {order}]]"
+            for order in dsl_input.variables["orders"]
+        ]
+        assert "validated" not in result and result["summary"]
+
+        # The same in child workflows of 2 orders each
+        assert isinstance(dsl_input.root, SequenceStatement)
+        foreach = dsl_input.root.sequence.elements[0]
+        assert isinstance(foreach, ForeachStatement)
+        foreach.foreach.batch_size = 2
+        handle = await client.start_workflow(
+            DSLWorkflow.run,
+            dsl_input,
+            id=str(uuid.uuid4()),
+            task_queue=task_queue_name,
+        )
+        assert (await handle.result())["results"] == result["results"]
+        children = [
+            event
+            async for event in handle.fetch_history_events()
+            if event.HasField(
+                "start_child_workflow_execution_initiated_event_attributes"
+            )
+        ]
+        assert len(children) == 3
+
+
+async def test_continue_as_new(client: Client):
+    task_queue_name = str(uuid.uuid4())
+    # Every activity of the sequence and the foreach appends to the result
+    chain = [
+        {"activity": {"name": "succeed", "arguments": ["x"], "result": "x"}}
+        for _ in range(10)
+    ]
+    dsl_input = dacite.from_dict(
+        DSLInput,
+        {
+            "root": {
+                "sequence": {
+                    "elements": [
+                        *chain,
+                        {
+                            "foreach": {
+                                "items": "items",
+                                "item": "item",
+                                "body": {
+                                    "activity": {
+                                        "name": "succeed",
+                                        "arguments": ["item"],
+                                        "result": "out",
+                                    }
+                                },
+                                "max_concurrency": 2,
+                                "collect": "out",
+                                "result": "outs",
+                            }
+                        },
+                    ]
+                }
+            },
+            "variables": {"x": "value", "items": ["a", "b", "c", "d", "e"]},
+            "max_history_length": 20,
+        },
+    )
+    async with Worker(
+        client,
+        task_queue=task_queue_name,
+        workflows=[DSLWorkflow],
+        activities=[succeed_activity],
+    ):
+        handle = await client.start_workflow(
+            DSLWorkflow.run,
+            dsl_input,
+            id=str(uuid.uuid4()),
+            task_queue=task_queue_name,
+        )
+        result = await handle.result()
+        assert result["x"] == "succeeded with " * 10 + "value"
+        assert result["outs"] == [f"succeeded with {item}" for item in "abcde"]
+        # The handle describes the first run, which didn't get that far
+        assert (
+            await handle.describe()
+        ).status == WorkflowExecutionStatus.CONTINUED_AS_NEW
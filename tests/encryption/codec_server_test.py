@@ -0,0 +1,149 @@
+import multiprocessing
+import socket
+import time
+import urllib.request
+from typing import AsyncIterator
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from google.protobuf import json_format
+from temporalio.api.common.v1 import Payload, Payloads
+
+from encryption.codec import EncryptionCodec
+from encryption.codec_server import (
+    JSON,
+    PROTOBUF,
+    CodecServerOptions,
+    PayloadsBatch,
+    build_codec_server,
+    serve,
+)
+
+
+@pytest.fixture
+async def codec_client() -> AsyncIterator[TestClient]:
+    async with TestClient(TestServer(build_codec_server())) as client:
+        yield client
+
+
+def _payloads(*values: bytes) -> Payloads:
+    return Payloads(
+        payloads=[Payload(metadata={"encoding": b"json/plain"}, data=v) for v in values]
+    )
+
+
+async def _encrypted(*values: bytes) -> Payloads:
+    return Payloads(
+        payloads=await EncryptionCodec().encode(_payloads(*values).payloads)
+    )
+
+
+async def test_decode_negotiates_content_type(codec_client: TestClient):
+    encrypted = await _encrypted(b'"a"', b'"b"')
+    # JSON in, JSON out, as the UI sends it
+    resp = await codec_client.post(
+        "/decode",
+        data=json_format.MessageToJson(encrypted),
+        headers={"Content-Type": JSON},
+    )
+    assert resp.content_type == JSON
+    assert json_format.Parse(await resp.read(), Payloads()) == _payloads(b'"a"', b'"b"')
+
+    # Binary in, binary out unless the client asks otherwise
+    resp = await codec_client.post(
+        "/decode",
+        data=encrypted.SerializeToString(),
+        headers={"Content-Type": PROTOBUF},
+    )
+    assert resp.content_type == PROTOBUF
+    assert Payloads.FromString(await resp.read()) == _payloads(b'"a"', b'"b"')
+
+    resp = await codec_client.post(
+        "/decode",
+        data=encrypted.SerializeToString(),
+        headers={"Content-Type": PROTOBUF, "Accept": f"{PROTOBUF};q=0.5, {JSON}"},
+    )
+    assert resp.content_type == JSON
+
+    resp = await codec_client.post(
+        "/decode", data=b"payloads", headers={"Content-Type": "text/plain"}
+    )
+    assert resp.status == 415
+
+
+async def test_batch_decode_keeps_sets_apart(codec_client: TestClient):
+    batch = PayloadsBatch(
+        batch=[
+            await _encrypted(b'"a"'),
+            Payloads(),
+            await _encrypted(b'"b"', b'"c"'),
+        ]
+    )
+    expected = [_payloads(b'"a"'), Payloads(), _payloads(b'"b"', b'"c"')]
+    resp = await codec_client.post(
+        "/decode/batch",
+        data=batch.SerializeToString(),
+        headers={"Content-Type": PROTOBUF},
+    )
+    assert list(PayloadsBatch.FromString(await resp.read()).batch) == expected
+
+    resp = await codec_client.post(
+        "/decode/batch",
+        data=json_format.MessageToJson(batch),
+        headers={"Content-Type": JSON},
+    )
+    assert list(json_format.Parse(await resp.read(), PayloadsBatch()).batch) == expected
+
+
+async def test_metrics_count_decodes(codec_client: TestClient):
+    encrypted = await _encrypted(b'"a"', b'"b"')
+    for _ in range(3):
+        await codec_client.post(
+            "/decode",
+            data=encrypted.SerializeToString(),
+            headers={"Content-Type": PROTOBUF},
+        )
+    metrics = (await (await codec_client.get("/metrics")).text()).splitlines()
+    assert 'codec_server_request_duration_seconds_count{route="/decode"} 3' in metrics
+    assert "codec_server_decoded_payloads_total 6" in metrics
+    decoded_bytes = 3 * sum(len(p.data) for p in encrypted.payloads)
+    assert f"codec_server_decoded_bytes_total {decoded_bytes}" in metrics
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize("shared_socket", [False, True])
+def test_workers_share_port_and_metrics(shared_socket: bool):
+    options = CodecServerOptions(
+        port=_free_port(), workers=2, threads=2, shared_socket=shared_socket
+    )
+    launcher = multiprocessing.Process(target=serve, args=(options,))
+    launcher.start()
+    url = f"http://127.0.0.1:{options.port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(f"{url}/metrics")
+                break
+            except OSError:
+                assert time.monotonic() < deadline, "Codec server didn't start"
+                time.sleep(0.1)
+        body = json_format.MessageToJson(_payloads(b'"a"')).encode()
+        for _ in range(10):
+            urllib.request.urlopen(
+                urllib.request.Request(
+                    f"{url}/decode", data=body, headers={"Content-Type": JSON}
+                )
+            )
+        # Whichever worker answers, it reports the requests of all of them
+        for _ in range(4):
+            with urllib.request.urlopen(f"{url}/metrics") as resp:
+                assert "codec_server_decoded_payloads_total 10" in resp.read().decode()
+    finally:
+        launcher.terminate()
+        launcher.join()
@@ -0,0 +1,103 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from temporalio.api.common.v1 import Payload
+
+from encryption.codec import EncryptionCodec
+
+
+def _payload(size: int) -> Payload:
+    return Payload(metadata={"encoding": b"binary/plain"}, data=os.urandom(size))
+
+
+async def test_large_payloads_are_offloaded_in_order():
+    payloads = [_payload(10), _payload(5000), _payload(20), _payload(9000)]
+    offloaded = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):  # type: ignore[no-untyped-def, override]
+            offloaded.append(args[0].ByteSize())
+            return super().submit(fn, *args, **kwargs)
+
+    with RecordingExecutor(2) as executor:
+        codec = EncryptionCodec(offload_threshold=1024, executor=executor)
+        encoded = await codec.encode(payloads)
+        assert len(offloaded) == 2 and min(offloaded) >= 1024
+        assert all(p.metadata["encoding"] == b"binary/encrypted" for p in encoded)
+        # Inline and offloaded codecs read each other's output
+        assert await EncryptionCodec().decode(encoded) == payloads
+        assert await codec.decode(await EncryptionCodec().encode(payloads)) == payloads
+
+        unencrypted = _payload(2000)
+        assert await codec.decode([unencrypted]) == [unencrypted]
+
+
+async def test_unknown_key_fails_offloaded_decode():
+    codec = EncryptionCodec("other-key-id", offload_threshold=0)
+    encoded = await codec.encode([_payload(100)])
+    with pytest.raises(ValueError, match="Unrecognized key ID"):
+        await EncryptionCodec(offload_threshold=0).decode(encoded)
+
+
+async def test_compression_is_recorded_and_optional_on_decode():
+    text = Payload(metadata={"encoding": b"json/plain"}, data=b'{"a": 1}' * 500)
+    small = Payload(metadata={"encoding": b"json/plain"}, data=b'{"a": 1}')
+    codec = EncryptionCodec(compression="zlib", compression_threshold=100)
+    encoded = await codec.encode([text, small, _payload(2000)])
+    # Random bytes don't shrink, so they are stored uncompressed
+    assert [p.metadata.get("encryption-compression") for p in encoded] == [
+        b"zlib",
+        None,
+        None,
+    ]
+    assert encoded[0].ByteSize() < text.ByteSize() / 10
+    # Codecs without compression decode compressed payloads and vice versa
+    assert (await EncryptionCodec().decode(encoded))[:2] == [text, small]
+    assert await codec.decode(await EncryptionCodec().encode([text])) == [text]
+
+    with pytest.raises(ValueError):
+        EncryptionCodec(compression="lz4")
+
+
+async def test_compression_metadata_is_authenticated():
+    text = Payload(metadata={"encoding": b"json/plain"}, data=b'{"a": 1}' * 500)
+    codec = EncryptionCodec(compression="zstd", compression_threshold=100)
+    encoded = (await codec.encode([text]))[0]
+    assert encoded.metadata["encryption-compression"] == b"zstd"
+    assert await codec.decode([encoded]) == [text]
+
+    # Changing or dropping the algorithm fails decryption instead of
+    # decompressing the wrong way
+    for compression in [b"zlib", None]:
+        tampered = Payload()
+        tampered.CopyFrom(encoded)
+        if compression:
+            tampered.metadata["encryption-compression"] = compression
+        else:
+            del tampered.metadata["encryption-compression"]
+        with pytest.raises(InvalidTag):
+            await codec.decode([tampered])
+
+
+async def test_failed_payload_cancels_offloaded_work():
+    decoded = []
+
+    class RecordingCodec(EncryptionCodec):
+        def decode_payload(self, p: Payload) -> Payload:
+            decoded.append(p.ByteSize())
+            return super().decode_payload(p)
+
+    encoded = await EncryptionCodec().encode([_payload(5000), _payload(9000)])
+    encoded += await EncryptionCodec("other-key-id").encode([_payload(10)])
+    blocked = threading.Event()
+    with ThreadPoolExecutor(1) as executor:
+        # Keep the large payloads queued while the small one fails inline
+        executor.submit(blocked.wait)
+        codec = RecordingCodec(offload_threshold=1024, executor=executor)
+        with pytest.raises(ValueError, match="Unrecognized key ID"):
+            await codec.decode(encoded)
+        blocked.set()
+    assert len(decoded) == 1 and decoded[0] < 1024
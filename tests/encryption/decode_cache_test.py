@@ -0,0 +1,68 @@
+import os
+from typing import Iterable, List
+
+from temporalio.api.common.v1 import Payload
+
+from encryption.codec import EncryptionCodec
+from encryption.codec_server_metrics import CodecServerMetrics
+from encryption.decode_cache import ENTRY_OVERHEAD_BYTES, CachingCodec, DecodeCache
+
+
+class CountingCodec(EncryptionCodec):
+    def __init__(self) -> None:
+        super().__init__()
+        self.decoded = 0
+
+    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        payloads = list(payloads)
+        self.decoded += len(payloads)
+        return await super().decode(payloads)
+
+
+def _payload(size: int) -> Payload:
+    return Payload(metadata={"encoding": b"binary/plain"}, data=os.urandom(size))
+
+
+async def test_repeated_decodes_are_served_from_cache():
+    inner = CountingCodec()
+    metrics = CodecServerMetrics()
+    codec = CachingCodec(inner, DecodeCache(1024 * 1024, 60, metrics))
+    payloads = [_payload(100), _payload(200)]
+    encrypted = await inner.encode(payloads)
+    plain = _payload(100)
+
+    assert await codec.decode(encrypted + [plain]) == payloads + [plain]
+    assert await codec.decode([encrypted[1], plain, encrypted[0]]) == [
+        payloads[1],
+        plain,
+        payloads[0],
+    ]
+    # Only the unencrypted payload, which isn't cached, is decoded again
+    assert inner.decoded == 4
+    assert codec.cache.hit_rate == 2 / 6
+    assert metrics.get("codec_server_decode_cache_hits_total") == 2
+    assert metrics.get("codec_server_decode_cache_misses_total") == 4
+    assert metrics.get("codec_server_decode_cache_bytes") == codec.cache.size
+
+
+async def test_cache_is_bounded_by_memory_and_ttl():
+    payloads = [_payload(1000) for _ in range(5)]
+    cache = DecodeCache(4 * (payloads[0].ByteSize() + ENTRY_OVERHEAD_BYTES), 60)
+    codec = CachingCodec(EncryptionCodec(), cache)
+    encrypted = await EncryptionCodec().encode(payloads)
+    await codec.decode(encrypted)
+    # The oldest entry made room for the newest
+    assert len(cache) == 4 and cache.size == cache.max_bytes
+    await codec.decode(encrypted[1:])
+    assert cache.hits == 4
+
+    # Too large for a quarter of the cache
+    await codec.decode(await EncryptionCodec().encode([_payload(2000)]))
+    assert len(cache) == 4
+
+    metrics = CodecServerMetrics()
+    expiring = CachingCodec(EncryptionCodec(), DecodeCache(1024 * 1024, 0, metrics))
+    await expiring.decode(encrypted[:1])
+    await expiring.decode(encrypted[:1])
+    assert expiring.cache.hits == 0
+    assert metrics.get("codec_server_decode_cache_expirations_total") == 1
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from temporalio.api.common.v1 import Payload
+
+from encryption.codec import EncryptionCodec, default_key, default_key_id
+from encryption.keyring import (
+    FileKeyring,
+    Keyring,
+    KeyringEncryptionCodec,
+    cached_aesgcm,
+    rotate,
+)
+
+
+def _payload() -> Payload:
+    return Payload(metadata={"encoding": b"binary/plain"}, data=os.urandom(100))
+
+
+async def test_rotation_is_picked_up_without_restart(tmp_path):
+    path = str(tmp_path / "keyring.json")
+    first = rotate(path, "first")
+    codec = KeyringEncryptionCodec(FileKeyring(path, check_interval=0))
+    payload = _payload()
+    old = await codec.encode([payload])
+    assert old[0].metadata["encryption-key-id"] == b"first"
+
+    rotate(path, "second")
+    new = await codec.encode([payload])
+    assert new[0].metadata["encryption-key-id"] == b"second"
+    # Payloads encrypted with either key still decode
+    assert await codec.decode(old + new) == [payload, payload]
+
+    # A broken keyring file keeps the last good keyring
+    with open(path, "w") as f:
+        f.write("{")
+    assert await codec.decode(old) == [payload]
+
+    with open(path, "w") as f:
+        f.write(Keyring("first", {"first": first.keys["first"]}).to_json())
+    with pytest.raises(ValueError, match="Unrecognized key ID second"):
+        await codec.decode(new)
+
+
+async def test_keyring_codec_reads_single_key_codec_output(tmp_path):
+    path = str(tmp_path / "keyring.json")
+    with open(path, "w") as f:
+        f.write(Keyring(default_key_id, {default_key_id: default_key}).to_json())
+    codec = KeyringEncryptionCodec(FileKeyring(path), compression="zlib")
+    payload = _payload()
+    assert await codec.decode(await EncryptionCodec().encode([payload])) == [payload]
+    assert await EncryptionCodec().decode(await codec.encode([payload])) == [payload]
+
+    # Ciphers are constructed once per key
+    cached_aesgcm.cache_clear()
+    await codec.decode(await codec.encode([payload] * 10))
+    assert cached_aesgcm.cache_info().misses == 1
+
+
+def test_keyring_is_validated():
+    with pytest.raises(ValueError, match="not a known key"):
+        Keyring("missing", {"other": default_key})
+    with pytest.raises(ValueError, match="bit key"):
+        Keyring("short", {"short": b"too-short"})
+
+
+def test_raw_encrypt_and_decrypt_follow_rotation(tmp_path):
+    path = str(tmp_path / "keyring.json")
+    rotate(path, "first")
+    codec = KeyringEncryptionCodec(FileKeyring(path, check_interval=0))
+    old = codec.encrypt(b"data")
+
+    rotate(path, "second")
+    assert codec.key_id == "second"
+    new = codec.encrypt(b"data")
+    # Data encrypted after the rotation uses the new key
+    assert codec.decrypt(new) == b"data"
+    assert codec.decrypt(new, "second") == b"data"
+    with pytest.raises(InvalidTag):
+        codec.decrypt(new, "first")
+    # And data from before it still decrypts with the key it was encrypted with
+    assert codec.decrypt(old, "first") == b"data"